@@ -233,6 +233,83 @@ static PyObject* ceres_solver_option(PyObject* self, PyObject* args)
 }
 
 
+// The packed pixels corresponding buffer viewed by the depth map stitcher, referenced until the next alignment.
+static PyObject* pixels_corresponding_buffer = NULL;
+
+// Check the packed pixels corresponding array's type, dimensions and layout.
+static PyArrayObject* packed_array(PyObject* array_py, int type, int ndim, npy_intp cols, const char* name)
+{
+	char msg[256];
+	if (PyArray_Check(array_py) == false)
+	{
+		sprintf(msg, "The packed pixels corresponding %s is not a numpy array!\n", name);
+		PyErr_SetString(PyExc_TypeError, msg);
+		return NULL;
+	}
+	PyArrayObject* array = (PyArrayObject*)array_py;
+	if (PyArray_TYPE(array) != type || PyArray_NDIM(array) != ndim || !PyArray_IS_C_CONTIGUOUS(array)
+		|| (ndim == 2 && PyArray_DIM(array, 1) != cols))
+	{
+		sprintf(msg, "The packed pixels corresponding %s has the wrong data type, shape or layout!\n", name);
+		PyErr_SetString(PyExc_TypeError, msg);
+		return NULL;
+	}
+	return array;
+}
+
+// Parse the packed pixels corresponding (pairs, offsets, corr), see subimage.pack_pixels_corr.
+// Each face pair's cv::Mat views its rows of the corr buffer without copy, the pairs without rows are empty.
+static int packed2cv(PyObject* pixels_corresponding_packed, const std::vector<int>& depthmap_index,
+	std::map<int, std::map<int, cv::Mat>>& pixels_corresponding_list)
+{
+	if (PyTuple_Size(pixels_corresponding_packed) != 3)
+	{
+		PyErr_SetString(PyExc_TypeError, "The packed pixels corresponding should be (pairs, offsets, corr)!\n");
+		return -1;
+	}
+	PyArrayObject* pairs_array = packed_array(PyTuple_GetItem(pixels_corresponding_packed, 0), NPY_INT32, 2, 2, "pairs");
+	PyArrayObject* offsets_array = packed_array(PyTuple_GetItem(pixels_corresponding_packed, 1), NPY_INT64, 1, 0, "offsets");
+	PyArrayObject* corr_array = packed_array(PyTuple_GetItem(pixels_corresponding_packed, 2), NPY_FLOAT64, 2, 4, "corr");
+	if (pairs_array == NULL || offsets_array == NULL || corr_array == NULL)
+		return -1;
+
+	npy_intp pair_number = PyArray_DIM(pairs_array, 0);
+	npy_intp corr_number = PyArray_DIM(corr_array, 0);
+	if (PyArray_DIM(offsets_array, 0) != pair_number + 1)
+	{
+		PyErr_SetString(PyExc_ValueError, "The packed pixels corresponding offsets size is not the pairs number + 1!\n");
+		return -1;
+	}
+
+	for (int index_src : depthmap_index)
+		for (int index_tar : depthmap_index)
+			pixels_corresponding_list[index_src][index_tar] = cv::Mat(0, 4, CV_64FC1);
+
+	const npy_int32* pairs = (const npy_int32*)PyArray_DATA(pairs_array);
+	const npy_int64* offsets = (const npy_int64*)PyArray_DATA(offsets_array);
+	double* corr = (double*)PyArray_DATA(corr_array);
+	for (npy_intp pair_index = 0; pair_index < pair_number; pair_index++)
+	{
+		npy_int64 row_begin = offsets[pair_index];
+		npy_int64 row_end = offsets[pair_index + 1];
+		if (row_begin < 0 || row_begin > row_end || row_end > corr_number)
+		{
+			PyErr_SetString(PyExc_ValueError, "The packed pixels corresponding offsets are out of the corr rows!\n");
+			return -1;
+		}
+		int index_src = pairs[pair_index * 2];
+		int index_tar = pairs[pair_index * 2 + 1];
+		pixels_corresponding_list[index_src][index_tar] = cv::Mat(int(row_end - row_begin), 4, CV_64FC1, corr + row_begin * 4);
+	}
+
+	// keep the viewed buffer alive until the next alignment, the stitcher's error report reads it
+	PyObject* corr_py = PyTuple_GetItem(pixels_corresponding_packed, 2);
+	Py_INCREF(corr_py);
+	Py_XDECREF(pixels_corresponding_buffer);
+	pixels_corresponding_buffer = corr_py;
+	return 0;
+}
+
 static PyObject* depthmap_stitch(PyObject* self, PyObject* args)
 {
 	const char* root_dir;               // str
@@ -240,7 +317,7 @@ static PyObject* depthmap_stitch(PyObject* self, PyObject* args)
 	PyObject* terms_weight;             // list[float]
 	PyObject* depthmap_original_list;    // list[numpy]
 	PyObject* depthmap_original_ico_index;// list[int]
-	PyObject* pixels_corresponding_map; // dict{int:{int, numpy}}
+	PyObject* pixels_corresponding_map; // dict{int:{int, numpy}}, or the packed tuple (pairs, offsets, corr)
 	PyObject* align_coeff_initial_scale; // list[numpy]
 	PyObject* align_coeff_initial_offset; // list[numpy]
 
@@ -251,13 +328,13 @@ static PyObject* depthmap_stitch(PyObject* self, PyObject* args)
 	int reproj_perpixel_enable;
 	int smooth_pergrid_enable;
 
-	if (!PyArg_ParseTuple(args, "sO!O!O!iO!iiiiO!O!i",
+	if (!PyArg_ParseTuple(args, "sO!O!O!iOiiiiO!O!i",
 		&root_dir,
 		&PyList_Type, &terms_weight,
 		&PyList_Type, &depthmap_original_list,
 		&PyList_Type, &depthmap_original_ico_index,
 		&reference_depthmap_index,
-		&PyDict_Type, &pixels_corresponding_map,
+		&pixels_corresponding_map,
 		&align_coeff_grid_height,
 		&align_coeff_grid_width,
 		&reproj_perpixel_enable,
@@ -335,67 +412,77 @@ static PyObject* depthmap_stitch(PyObject* self, PyObject* args)
 
 	// pixels_corresponding_map
 	std::cout << "- Parsing pixels_corresponding_map" << std::endl;
-	if (PyDict_Check(pixels_corresponding_map) == false)
+	std::map<int, std::map<int, cv::Mat>> pixels_corresponding_list;
+	if (PyTuple_Check(pixels_corresponding_map))
 	{
-		PyErr_SetString(PyExc_RuntimeError, "pixels_corresponding_map is not a dictory object!\n");
-		return NULL;
+		if (packed2cv(pixels_corresponding_map, depthmap_original_index_cpp, pixels_corresponding_list) < 0)
+			return NULL;
 	}
-	Py_ssize_t dict_length = PyDict_Size(pixels_corresponding_map);
-	if (dict_length < (depthmap_original_list_size - 1))
+	else if (PyDict_Check(pixels_corresponding_map) == false)
 	{
-		PyErr_SetString(PyExc_RuntimeError, "pixels_corresponding_map source map length is wrong!\n");
+		PyErr_SetString(PyExc_RuntimeError, "pixels_corresponding_map is not a dictory or packed tuple object!\n");
 		return NULL;
 	}
-	std::map<int, std::map<int, cv::Mat>> pixels_corresponding_list;
-	PyObject* pixel_corr_srckeys_list = PyDict_Keys(pixels_corresponding_map);
-	int pixle_corr_srckeys_size = (int)PyList_Size(pixel_corr_srckeys_list);
-	for (int src_index = 0; src_index < pixle_corr_srckeys_size; src_index++)
-	{
-		PyObject* srckey_py = PyList_GetItem(pixel_corr_srckeys_list, Py_ssize_t(src_index));
-		long srckey_long = PyLong_AsLong(srckey_py);
-		PyObject* pixel_map_tar = PyDict_GetItem(pixels_corresponding_map, srckey_py);
-		if (pixel_map_tar == NULL)
-		{
-			char msg[128];
-			sprintf(msg, "The pixel corresponding relationship source index %ld is missing!\n", srckey_long);
-			PyErr_SetString(PyExc_RuntimeError, msg);
-			continue;
-		}
-
-		Py_ssize_t tar_length = PyDict_Size(pixel_map_tar);
-		if (tar_length < (depthmap_original_list_size - 1))
+	else
+	{
+		// the copied cv::Mat own their data
+		Py_CLEAR(pixels_corresponding_buffer);
+		Py_ssize_t dict_length = PyDict_Size(pixels_corresponding_map);
+		if (dict_length < (depthmap_original_list_size - 1))
 		{
-			PyErr_SetString(PyExc_RuntimeError, "pixels_corresponding_map tar map length is wrong!\n");
+			PyErr_SetString(PyExc_RuntimeError, "pixels_corresponding_map source map length is wrong!\n");
 			return NULL;
 		}
-
-		// convert target data list
-		std::map<int, cv::Mat> pixels_corresponding_list_tar;
-		PyObject* pixel_corr_tarkeys_list = PyDict_Keys(pixel_map_tar);
-		int pixle_corr_tarkeys_size = (int)PyList_Size(pixel_corr_tarkeys_list);
-		for (int tar_index = 0; tar_index < pixle_corr_tarkeys_size; tar_index++)
+		PyObject* pixel_corr_srckeys_list = PyDict_Keys(pixels_corresponding_map);
+		int pixle_corr_srckeys_size = (int)PyList_Size(pixel_corr_srckeys_list);
+		for (int src_index = 0; src_index < pixle_corr_srckeys_size; src_index++)
 		{
-			PyObject* tarkey_py = PyList_GetItem(pixel_corr_tarkeys_list, Py_ssize_t(tar_index));
-			long tarkey_long = PyLong_AsLong(tarkey_py);
-			PyObject* map_mat = PyDict_GetItem(pixel_map_tar, tarkey_py);
-			if (map_mat == NULL)
+			PyObject* srckey_py = PyList_GetItem(pixel_corr_srckeys_list, Py_ssize_t(src_index));
+			long srckey_long = PyLong_AsLong(srckey_py);
+			PyObject* pixel_map_tar = PyDict_GetItem(pixels_corresponding_map, srckey_py);
+			if (pixel_map_tar == NULL)
 			{
 				char msg[128];
-				sprintf(msg, "The pixel corresponding relationship target index %ld is missing!\n", tarkey_long);
+				sprintf(msg, "The pixel corresponding relationship source index %ld is missing!\n", srckey_long);
 				PyErr_SetString(PyExc_RuntimeError, msg);
 				continue;
 			}
-			cv::Mat mat_data;
-			// std::cout << mat_data << std::endl;
-			if (numpy2cv(map_mat, mat_data) < 0)
+
+			Py_ssize_t tar_length = PyDict_Size(pixel_map_tar);
+			if (tar_length < (depthmap_original_list_size - 1))
 			{
-				PyErr_SetString(PyExc_RuntimeError, "The pixel corresponding mat is empty!\n");
+				PyErr_SetString(PyExc_RuntimeError, "pixels_corresponding_map tar map length is wrong!\n");
 				return NULL;
 			}
-			else
-				pixels_corresponding_list_tar[tarkey_long] = mat_data;
+
+			// convert target data list
+			std::map<int, cv::Mat> pixels_corresponding_list_tar;
+			PyObject* pixel_corr_tarkeys_list = PyDict_Keys(pixel_map_tar);
+			int pixle_corr_tarkeys_size = (int)PyList_Size(pixel_corr_tarkeys_list);
+			for (int tar_index = 0; tar_index < pixle_corr_tarkeys_size; tar_index++)
+			{
+				PyObject* tarkey_py = PyList_GetItem(pixel_corr_tarkeys_list, Py_ssize_t(tar_index));
+				long tarkey_long = PyLong_AsLong(tarkey_py);
+				PyObject* map_mat = PyDict_GetItem(pixel_map_tar, tarkey_py);
+				if (map_mat == NULL)
+				{
+					char msg[128];
+					sprintf(msg, "The pixel corresponding relationship target index %ld is missing!\n", tarkey_long);
+					PyErr_SetString(PyExc_RuntimeError, msg);
+					continue;
+				}
+				cv::Mat mat_data;
+				// std::cout << mat_data << std::endl;
+				if (numpy2cv(map_mat, mat_data) < 0)
+				{
+					PyErr_SetString(PyExc_RuntimeError, "The pixel corresponding mat is empty!\n");
+					return NULL;
+				}
+				else
+					pixels_corresponding_list_tar[tarkey_long] = mat_data;
+			}
+			pixels_corresponding_list[srckey_long] = pixels_corresponding_list_tar;
 		}
-		pixels_corresponding_list[srckey_long] = pixels_corresponding_list_tar;
 	}
 
 	// alignment coefficients
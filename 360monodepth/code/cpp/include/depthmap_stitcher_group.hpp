@@ -30,7 +30,7 @@ public:
 
 private:
 
-	struct ReprojectionResidual;
+	class ReprojectionPairResidual;
 	struct ReprojectionResidual_fixed;
 
 	struct SmoothnessResidual;
@@ -7,12 +7,91 @@
 #include<Eigen/SparseLU>
 #include<Eigen/IterativeLinearSolvers>
 #include <iostream>
+#include <fstream>
 #include <memory>
+#include <algorithm>
+#include <cmath>
+#include <stdexcept>
 #include <glog/logging.h>
 #include "chrono"
 #include <iomanip>
 #include "pybind11/pybind11.h"
 #include "pybind11/eigen.h"
+#include "pybind11/numpy.h"
+
+#ifdef _WIN32
+#define NOMINMAX
+#include <windows.h>
+#include <psapi.h>
+#pragma comment(lib, "psapi.lib")
+#else
+#include <unistd.h>
+#include <sys/resource.h>
+#endif
+
+// The available physical memory in bytes, 0 if it's unknown.
+double availableMemory()
+{
+#ifdef _WIN32
+    MEMORYSTATUSEX status;
+    status.dwLength = sizeof(status);
+    if (GlobalMemoryStatusEx(&status))
+        return static_cast<double>(status.ullAvailPhys);
+    return 0.0;
+#else
+    // MemAvailable includes the reclaimable page cache, the free pages do not
+    std::ifstream meminfo("/proc/meminfo");
+    std::string name;
+    double value;
+    std::string unit;
+    while (meminfo >> name >> value >> unit)
+    {
+        if (name == "MemAvailable:")
+            return value * 1024.0;
+    }
+    long pages = sysconf(_SC_AVPHYS_PAGES);
+    long page_size = sysconf(_SC_PAGE_SIZE);
+    if (pages > 0 && page_size > 0)
+        return static_cast<double>(pages) * static_cast<double>(page_size);
+    return 0.0;
+#endif
+}
+
+// The peak resident memory of the process in bytes.
+double peakResidentMemory()
+{
+#ifdef _WIN32
+    PROCESS_MEMORY_COUNTERS counters;
+    if (GetProcessMemoryInfo(GetCurrentProcess(), &counters, sizeof(counters)))
+        return static_cast<double>(counters.PeakWorkingSetSize);
+    return 0.0;
+#else
+    struct rusage usage;
+    getrusage(RUSAGE_SELF, &usage);
+#ifdef __APPLE__
+    return static_cast<double>(usage.ru_maxrss);
+#else
+    return static_cast<double>(usage.ru_maxrss) * 1024.0;
+#endif
+#endif
+}
+
+// The statistics of the last factorization and solve.
+struct SolverStats
+{
+    std::string solver;          // the solver method, the selected one for Auto
+    std::string reason;          // why Auto selected the method, empty for the other methods
+    double setup_time = 0.0;     // the factorization or preconditioner setup time in seconds
+    double solve_time = 0.0;     // the last solve time in seconds
+    long iterations = 0;         // the iterations of the iterative solvers, the maximum over the right-hand sides
+    double residual = 0.0;       // the relative residual |b - A x| / |b|
+    long nnz = 0;                // the nonzeros of the factors, or the preconditioner size of the iterative solvers
+    double memory = 0.0;         // the estimated bytes of the matrix, factors and work vectors
+    double peak_memory = 0.0;    // the peak resident memory of the process in bytes
+};
+
+// The CSC matrix view of the owned or the caller's buffers
+typedef Eigen::Map<const Eigen::SparseMatrix<double>> SparseMatrixView;
 
 class LinearSolver
 {
@@ -26,16 +105,26 @@ public:
         SparseLU,
         ConjugateGradient,
         LeastSquaresConjugateGradient,
-        BiCGSTAB
+        BiCGSTAB,
+        Auto  // select a method from the problem size and the available memory
     };
 
+    // Auto selects the direct Cholesky factorization up to this many unknowns when its factor fits in the memory
+    long auto_direct_max_size = 1 << 20;
+    // The fraction of the available memory the Auto direct factor may use
+    double auto_memory_fraction = 0.5;
+
     // Constructors
     LinearSolver(const Eigen::SparseMatrix<double>& A, solverType type) : A(A), type(type) {
+        auto_select = type == Auto;
+        viewOwnedMatrix();
         factorize();
     };
 
     LinearSolver(const Eigen::SparseMatrix<double>& A, solverType type, int maxiters, double tol) :
             A(A), type(type), maxiters(maxiters), tol(tol) {
+        auto_select = type == Auto;
+        viewOwnedMatrix();
         factorize();
     };
 
@@ -43,91 +132,217 @@ public:
         type = solverType::BiCGSTAB;
     }
 
-    explicit LinearSolver(solverType type) : type(type){ }
+    explicit LinearSolver(solverType type) : type(type){
+        auto_select = type == Auto;
+    }
 
     ~LinearSolver() = default;
 
+    // The estimated nonzeros of the Cholesky factor with the minimum degree ordering, fitted to the ERP blending
+    // systems of 8K to 131K unknowns, it's 211K to 6.1M nonzeros.
+    static double estimateCholeskyNonzeros(const SparseMatrixView& A) {
+        return 3.8 * std::pow(static_cast<double>(A.rows()), 1.21);
+    }
+
+    // Select the solver method of Auto, the method is kept for the next factorizations of the same type.
+    solverType selectSolver() {
+        double factor_bytes = estimateCholeskyNonzeros(*A_view) * (sizeof(double) + sizeof(int));
+        double available_bytes = availableMemory();
+        std::stringstream stream;
+        stream << std::setprecision(3) << A_view->rows() << " unknowns, estimated Cholesky factor "
+               << factor_bytes / (1 << 20) << " MB, available memory " << available_bytes / (1 << 20) << " MB: ";
+        solverType selected;
+        if (A_view->rows() > auto_direct_max_size) {
+            stream << "more than " << auto_direct_max_size << " unknowns, use the iterative solver";
+            selected = ConjugateGradient;
+        } else if (available_bytes > 0 && factor_bytes > auto_memory_fraction * available_bytes) {
+            stream << "the factor does not fit in " << auto_memory_fraction << " of the memory, "
+                   << "use the iterative solver";
+            selected = ConjugateGradient;
+        } else {
+            stream << "use the direct solver";
+            selected = SimplicialLLT;
+        }
+        auto_reason = stream.str();
+        LOG(INFO) << "Auto solver: " << auto_reason << std::endl;
+        return selected;
+    }
+
     // Compute Factorization of A matrix as soon as the object is created.
+    // The direct solvers factorize a permuted copy of the matrix, the iterative solvers reference the matrix view.
     void factorize(){
+        if (!A_view) {
+            LOG(ERROR) << "The matrix A is not set." << std::endl;
+            return;
+        }
+        auto start_time = std::chrono::system_clock::now();
+        if (auto_select) {
+            type = selectSolver();
+        }
+        stats = SolverStats();
+        stats.reason = auto_reason;
+        bool success = true;
         switch (type) {
             case SimplicialLLT:
                 solverLLT = std::make_unique<Eigen::SimplicialLLT<Eigen::SparseMatrix<double>>>();
-                solverLLT->compute(A);
+                solverLLT->compute(*A_view);
+                success = solverLLT->info() == Eigen::Success;
+                stats.nnz = solverLLT->matrixL().nestedExpression().nonZeros();
                 break;
             case SimplicialLDLT:
                 solverLDLT = std::make_unique<Eigen::SimplicialLDLT<Eigen::SparseMatrix<double>>>();
-                solverLDLT->compute(A);
+                solverLDLT->compute(*A_view);
+                success = solverLDLT->info() == Eigen::Success;
+                stats.nnz = solverLDLT->matrixL().nestedExpression().nonZeros() + A_view->rows();
                 break;
             case SparseLU:
                 solverLU = std::make_unique<Eigen::SparseLU<Eigen::SparseMatrix<double>>>();
-                solverLU->compute(A);
+                solverLU->compute(*A_view);
+                success = solverLU->info() == Eigen::Success;
+                stats.nnz = solverLU->nnzL() + solverLU->nnzU();
                 break;
             case ConjugateGradient:
                 solverCG = std::make_unique<Eigen::ConjugateGradient<Eigen::SparseMatrix<double>>>();
                 solverCG->setMaxIterations(maxiters);
                 solverCG->setTolerance(tol);
-                solverCG->compute(A);
+                solverCG->compute(*A_view);
+                stats.nnz = A_view->rows();  // the Jacobi preconditioner
                 break;
             case LeastSquaresConjugateGradient:
                 solverLSCG = std::make_unique<Eigen::LeastSquaresConjugateGradient<Eigen::SparseMatrix<double>>>();
                 solverLSCG->setMaxIterations(maxiters);
                 solverLSCG->setTolerance(tol);
-                solverLSCG->compute(A);
+                solverLSCG->compute(*A_view);
+                stats.nnz = A_view->cols();
                 break;
             case BiCGSTAB:
                 solverBiCGSTAB = std::make_unique<Eigen::BiCGSTAB<Eigen::SparseMatrix<double>>>();
                 solverBiCGSTAB->setMaxIterations(maxiters);
                 solverBiCGSTAB->setTolerance(tol);
-                solverBiCGSTAB->compute(A);
+                solverBiCGSTAB->compute(*A_view);
+                stats.nnz = A_view->rows();
+                break;
+            case Auto:
                 break;
         }
+        std::chrono::duration<double> elapsed_time = std::chrono::system_clock::now() - start_time;
+        stats.solver = getType();
+        stats.setup_time = elapsed_time.count();
+        if (!success) {
+            LOG(WARNING) << getType() << " factorization failed." << std::endl;
+        }
     }
 
-    // Solve the system for an arbitrary b vector
-    Eigen::VectorXd solve(const Eigen::VectorXd& b) {
-        Eigen::VectorXd x;
+    // The work vectors of the iterative solvers' each right-hand side
+    int workVectors() const {
+        switch (type) {
+            case ConjugateGradient:             return 4;
+            case LeastSquaresConjugateGradient: return 4;
+            case BiCGSTAB:                      return 8;
+            default:                            return 0;
+        }
+    }
+
+    // Solve the right-hand sides one by one with the iterative solver and record the maximum iterations
+    template<typename Solver, typename Rhs, typename Dest>
+    void iterativeSolve(Solver& solver, const Rhs& B, Dest& X) {
+        for (Eigen::Index col = 0; col < B.cols(); ++col) {
+            X.col(col) = solver.solve(B.col(col));
+            stats.iterations = std::max<long>(stats.iterations, solver.iterations());
+        }
+    }
+
+    // Update the statistics after solving the right-hand sides
+    void updateStats(Eigen::Index rhs_number, double solving_time) {
+        stats.solve_time = solving_time;
+        stats.residual = rel_error;
+        double index_bytes = sizeof(int);
+        double value_bytes = sizeof(double);
+        stats.memory = A_view->nonZeros() * (value_bytes + index_bytes) + (A_view->outerSize() + 1) * index_bytes +
+                       stats.nnz * (value_bytes + index_bytes) +
+                       static_cast<double>(workVectors() + 2 * rhs_number) * A_view->rows() * value_bytes;
+        stats.peak_memory = peakResidentMemory();
+    }
+
+    // Solve the columns of B to X, the columns share the factorization or the preconditioner.
+    // X may be a view of the caller's buffer, the solution is written to it without a temporary copy.
+    template<typename Rhs, typename Dest>
+    void solveInto(const Rhs& B, Dest& X) {
+        if (!A_view) {
+            LOG(ERROR) << "The matrix A is not set." << std::endl;
+            return;
+        }
+        if (B.rows() != A_view->rows() || X.rows() != A_view->cols() || X.cols() != B.cols()) {
+            LOG(ERROR) << "The right-hand side " << B.rows() << "x" << B.cols() << " or the solution "
+                       << X.rows() << "x" << X.cols() << " does not match the matrix " << A_view->rows() << "x"
+                       << A_view->cols() << std::endl;
+            return;
+        }
+        if (B.cols() == 1)
+            LOG(INFO) << "Solving with " << getType() << " ... \n";
+        else
+            LOG(INFO) << "Solving " << B.cols() << " right-hand sides with " << getType() << std::endl;
+
         auto start_time = std::chrono::system_clock::now();
+        stats.iterations = 0;
         switch (LinearSolver::type) {
             case SimplicialLLT:
-                LOG(INFO) << "Solving with SimplicialLLT ... \n";
-                x = solverLLT->solve(b);
+                X = solverLLT->solve(B);
                 break;
             case SimplicialLDLT:
-                LOG(INFO) << "Solving with SimplicialLDLT ... \n";
-                x = solverLDLT->solve(b);
+                X = solverLDLT->solve(B);
                 break;
             case SparseLU:
-                LOG(INFO) << "Solving with Sparse LU ... \n";
-                x = solverLU->solve(b);
+                X = solverLU->solve(B);
                 break;
             case ConjugateGradient:
-                LOG(INFO) << "Solving with Conjugate Gradient ... \n";
-                x = solverCG->solve(b);
+                iterativeSolve(*solverCG, B, X);
                 break;
             case LeastSquaresConjugateGradient:
-                LOG(INFO) << "Solving with LeastSquaresConjugateGradient ... \n";
-                x = solverLSCG->solve(b);
+                iterativeSolve(*solverLSCG, B, X);
                 break;
             case BiCGSTAB:
-                LOG(INFO) << "Solving with BiCGSTAB ... \n";
-                x = solverBiCGSTAB->solve(b);
+                iterativeSolve(*solverBiCGSTAB, B, X);
+                break;
+            case Auto:
                 break;
         }
 
         std::chrono::duration<double> elapsed_time = std::chrono::system_clock::now() - start_time;
-        double solving_time = elapsed_time.count();
-        std::stringstream stream;
-        stream << std::fixed << std::setprecision(5) << solving_time;
-        std::string solving_time_str = stream.str();
-        Eigen::Matrix<double, Eigen::Dynamic, 1> temp = A * x;
-        rel_error = (b-temp).norm()/b.norm();
-        LOG(INFO) << "Solving time   = " << solving_time_str << std::endl;
+        rel_error = (B - (*A_view) * X).norm() / B.norm();
+        updateStats(B.cols(), elapsed_time.count());
+        LOG(INFO) << "Solving time   = " << std::fixed << std::setprecision(5) << elapsed_time.count() << std::endl;
         LOG(INFO) << "Relative error = " << rel_error << std::endl;
+        if (stats.iterations > 0)
+            LOG(INFO) << "Iterations     = " << stats.iterations << std::endl;
+    }
+
+    // Solve the system for an arbitrary b vector
+    Eigen::VectorXd solve(const Eigen::Ref<const Eigen::VectorXd>& b) {
+        Eigen::VectorXd x = Eigen::VectorXd::Zero(A_view ? A_view->cols() : 0);
+        solveInto(b, x);
         return x;
     }
 
+    // Solve the system for all columns of B, the columns share the factorization or the preconditioner
+    Eigen::MatrixXd solve_batch(const Eigen::Ref<const Eigen::MatrixXd>& B) {
+        Eigen::MatrixXd X = Eigen::MatrixXd::Zero(A_view ? A_view->cols() : 0, B.cols());
+        solveInto(B, X);
+        return X;
+    }
+
+    // Solve to the caller's float64 buffer x
+    void solve_into(const Eigen::Ref<const Eigen::VectorXd>& b, Eigen::Ref<Eigen::VectorXd> x) {
+        solveInto(b, x);
+    }
+
+    // Solve to the caller's float64 column-major (Fortran order) buffer X
+    void solve_batch_into(const Eigen::Ref<const Eigen::MatrixXd>& B, Eigen::Ref<Eigen::MatrixXd> X) {
+        solveInto(B, X);
+    }
+
     void setIters(int iters){
-        maxiters = iters;
+        maxiters = iters;  // applied by factorize if the solver is not created yet
         switch (type) {
             case SimplicialLLT:
                 LOG(WARNING) << "SimplicialLLT does not use maxiters";
@@ -139,19 +354,21 @@ public:
                 LOG(WARNING) << "SparseLU does not use maxiters";
                 return;
             case ConjugateGradient:
-                solverCG->setMaxIterations(maxiters);
+                if (solverCG) solverCG->setMaxIterations(maxiters);
                 return;
             case LeastSquaresConjugateGradient:
-                solverLSCG->setMaxIterations(maxiters);
+                if (solverLSCG) solverLSCG->setMaxIterations(maxiters);
                 return;
             case BiCGSTAB:
-                solverBiCGSTAB->setMaxIterations(maxiters);
+                if (solverBiCGSTAB) solverBiCGSTAB->setMaxIterations(maxiters);
+                return;
+            case Auto:
                 return;
         }
     }
 
     void setTol(const double& new_tol) {
-        tol = new_tol;
+        tol = new_tol;  // applied by factorize if the solver is not created yet
         switch (type) {
             case SimplicialLLT:
                 LOG(WARNING) << "SimplicialLLT does not use tol";
@@ -163,13 +380,15 @@ public:
                 LOG(WARNING) << "SparseLU does not use tol";
                 return;
             case ConjugateGradient:
-                solverCG->setTolerance(tol);
+                if (solverCG) solverCG->setTolerance(tol);
                 return;
             case LeastSquaresConjugateGradient:
-                solverLSCG->setTolerance(tol);
+                if (solverLSCG) solverLSCG->setTolerance(tol);
                 return;
             case BiCGSTAB:
-                solverBiCGSTAB->setTolerance(tol);
+                if (solverBiCGSTAB) solverBiCGSTAB->setTolerance(tol);
+                return;
+            case Auto:
                 return;
         }
     }
@@ -183,27 +402,79 @@ public:
             case ConjugateGradient:             return "ConjugateGradient";
             case LeastSquaresConjugateGradient: return "LeastSquaresConjugateGradient";
             case BiCGSTAB:                      return "BiCGSTAB";
+            case Auto:                          return "Auto";
             default:                            return "NO SOLVER SELECTED";
         }
     }
 
+    pybind11::dict getStats() const {
+        pybind11::dict stats_dict;
+        stats_dict["solver"] = stats.solver;
+        stats_dict["reason"] = stats.reason;
+        stats_dict["setup_time"] = stats.setup_time;
+        stats_dict["solve_time"] = stats.solve_time;
+        stats_dict["iterations"] = stats.iterations;
+        stats_dict["residual"] = stats.residual;
+        stats_dict["nnz"] = stats.nnz;
+        stats_dict["memory"] = stats.memory;
+        stats_dict["peak_memory"] = stats.peak_memory;
+        return stats_dict;
+    }
+
     double getTol() const { return tol; }
     int getMaxIters() const { return maxiters; }
-    Eigen::SparseMatrix<double> getA() const { return A; }
+    Eigen::SparseMatrix<double> getA() const {
+        return A_view ? Eigen::SparseMatrix<double>(*A_view) : Eigen::SparseMatrix<double>();
+    }
     void setA (const Eigen::SparseMatrix<double>& new_A){
         A = new_A;
+        viewOwnedMatrix();
+        factorize();
+    }
+
+    // Set the matrix to the caller's CSC buffers without copying them, which are kept alive until the next matrix.
+    // The CSR buffers of a symmetric matrix, e.g. scipy's csr_matrix of the normal matrix, are its CSC buffers.
+    void setBuffers(const pybind11::array_t<int, pybind11::array::c_style>& indptr,
+                    const pybind11::array_t<int, pybind11::array::c_style>& indices,
+                    const pybind11::array_t<double, pybind11::array::c_style>& data, long rows, long cols) {
+        if (indptr.size() != cols + 1 || indices.size() != data.size() ||
+            indptr.data()[cols] > static_cast<long>(data.size())) {
+            throw std::invalid_argument("The CSC buffers do not match the matrix size.");
+        }
+        A = Eigen::SparseMatrix<double>();
+        // the reference of the buffers is type erased, as the pybind11 types are hidden in the module
+        buffers = std::shared_ptr<void>(new pybind11::object(pybind11::make_tuple(indptr, indices, data)),
+                                        [](void* buffers_tuple) {
+                                            pybind11::gil_scoped_acquire acquire;
+                                            delete static_cast<pybind11::object*>(buffers_tuple);
+                                        });
+        A_view = std::make_unique<SparseMatrixView>(rows, cols, indptr.data()[cols], indptr.data(), indices.data(),
+                                                    data.data());
         factorize();
     }
 
 private:
+    // View the owned matrix A
+    void viewOwnedMatrix() {
+        A.makeCompressed();
+        buffers.reset();
+        A_view = std::make_unique<SparseMatrixView>(A.rows(), A.cols(), A.nonZeros(), A.outerIndexPtr(),
+                                                    A.innerIndexPtr(), A.valuePtr());
+    }
+
     solverType type;
     double rel_error = 0.0;
+    SolverStats stats;
+    bool auto_select = false;  // the type is selected by Auto on each factorization
+    std::string auto_reason;
 
     //Only used for iterative solvers
     int maxiters = 100;
     double tol = 1e-08;
 
-    Eigen::SparseMatrix<double> A;
+    Eigen::SparseMatrix<double> A;  // the matrix copied from the caller, empty when viewing the caller's buffers
+    std::shared_ptr<void> buffers;  // the reference of the caller's CSC buffers of the matrix view
+    std::unique_ptr<SparseMatrixView> A_view;  // the view of A or of the caller's buffers
 //    std::shared_ptr<Eigen::internal::noncopyable> *solver;
     std::unique_ptr<Eigen::SimplicialLLT<Eigen::SparseMatrix<double>>> solverLLT;
     std::unique_ptr<Eigen::SimplicialLDLT<Eigen::SparseMatrix<double>>> solverLDLT;
@@ -225,10 +496,16 @@ PYBIND11_MODULE(EigenSolvers, m) {
     linearSolver.def(py::init<>()); //ctor
     linearSolver.def(py::init<LinearSolver::solverType>()); //ctor
     linearSolver.def("solve", &LinearSolver::solve);
+    linearSolver.def("solve_batch", &LinearSolver::solve_batch);
+    linearSolver.def("solve_into", &LinearSolver::solve_into, py::arg("b"), py::arg("x").noconvert());
+    linearSolver.def("solve_batch_into", &LinearSolver::solve_batch_into, py::arg("B"), py::arg("X").noconvert());
+    linearSolver.def("set_csc_buffers", &LinearSolver::setBuffers, py::arg("indptr").noconvert(),
+                     py::arg("indices").noconvert(), py::arg("data").noconvert(), py::arg("rows"), py::arg("cols"));
     linearSolver.def_property("maxiters", &LinearSolver::getMaxIters, &LinearSolver::setIters);
     linearSolver.def_property("tol", &LinearSolver::getTol, &LinearSolver::setTol);
     linearSolver.def_property("A", &LinearSolver::getA, &LinearSolver::setA);
     linearSolver.def_property_readonly("solver_type", &LinearSolver::getType);
+    linearSolver.def_property_readonly("stats", &LinearSolver::getStats);
 
     py::enum_<LinearSolver::solverType>(linearSolver, "solverType") //enum type
             .value("SimplicialLLT", LinearSolver::solverType::SimplicialLLT)
@@ -237,5 +514,6 @@ PYBIND11_MODULE(EigenSolvers, m) {
             .value("ConjugateGradient", LinearSolver::solverType::ConjugateGradient)
             .value("LeastSquaresConjugateGradient", LinearSolver::solverType::LeastSquaresConjugateGradient)
             .value("BiCGSTAB", LinearSolver::solverType::BiCGSTAB)
+            .value("Auto", LinearSolver::solverType::Auto)
             .export_values();
 }
\ No newline at end of file
@@ -7,6 +7,8 @@
 #include <vector>
 #include <map>
 #include <string>
+#include <algorithm>
+#include <utility>
 
 DepthmapStitcherGroup::DepthmapStitcherGroup() {}
 
@@ -46,50 +48,104 @@ DepthmapStitcherGroup::~DepthmapStitcherGroup() {}
 //	const int grid_height_; // the weight grid along the y axis
 //};
 
-// TODO capsule more function to refer Ceres demo. 
-struct DepthmapStitcherGroup::ReprojectionResidual {
-	ReprojectionResidual(double* bilinear_weight_list_tar, double* bilinear_weight_list_src,
-		double depth_value_tar, double depth_value_src,
-		int grid_width, int grid_height) :
-		bilinear_weight_list_tar_(bilinear_weight_list_tar), bilinear_weight_list_src_(bilinear_weight_list_src),
-		depth_value_tar_(depth_value_tar), depth_value_src_(depth_value_src),
-		grid_width_(grid_width), grid_height_(grid_height) {}
-
-	template <typename T>
-	bool operator()(T const* const* scale_offset_list, T* residual) const
+// The re-projection residuals of all pixels corresponding of a depth map pair, @see hedman2018instant:equ_5.
+// Each residual is the squared difference of the pixel pair's adjusted depth values, the Jacobian is computed
+// analytically from the pixels' bilinear weights, which are non-zero for at most 4 grid points.
+class DepthmapStitcherGroup::ReprojectionPairResidual : public ceres::CostFunction {
+public:
+	static const int weight_number = 4; // the non-zero bilinear weights number of a pixel
+
+	ReprojectionPairResidual(const int grid_size,
+		std::vector<double>&& depth_value_src, std::vector<double>&& depth_value_tar,
+		std::vector<int>&& weight_index_src, std::vector<double>&& weight_src,
+		std::vector<int>&& weight_index_tar, std::vector<double>&& weight_tar) :
+		grid_size_(grid_size),
+		depth_value_src_(std::move(depth_value_src)), depth_value_tar_(std::move(depth_value_tar)),
+		weight_index_src_(std::move(weight_index_src)), weight_src_(std::move(weight_src)),
+		weight_index_tar_(std::move(weight_index_tar)), weight_tar_(std::move(weight_tar))
 	{
-		const T* scale_list_src = scale_offset_list[0];
-		const T* offset_list_src = scale_offset_list[1];
-
-		const T* scale_list_tar = scale_offset_list[2];
-		const T* offset_list_tar = scale_offset_list[3];
-
-		T scale_src(0);
-		T offset_src(0);
-		T scale_tar(0);
-		T offset_tar(0);
+		set_num_residuals(depth_value_src_.size());
+		// the source scale and offset, the target scale and offset
+		for (int index = 0; index < 4; index++)
+			mutable_parameter_block_sizes()->push_back(grid_size_);
+	}
 
-		for (int index = 0; index < grid_width_ * grid_height_; index++)
+	bool Evaluate(double const* const* parameters, double* residuals, double** jacobians) const override
+	{
+		const double* scale_list_src = parameters[0];
+		const double* offset_list_src = parameters[1];
+		const double* scale_list_tar = parameters[2];
+		const double* offset_list_tar = parameters[3];
+
+		// the Jacobian is row-major, the constant parameter blocks have no Jacobian
+		if (jacobians != nullptr)
+			for (int block_index = 0; block_index < 4; block_index++)
+				if (jacobians[block_index] != nullptr)
+					std::fill(jacobians[block_index], jacobians[block_index] + num_residuals() * grid_size_, 0.0);
+
+		for (int residual_index = 0; residual_index < num_residuals(); residual_index++)
 		{
-			scale_src += scale_list_src[index] * bilinear_weight_list_src_[index];
-			offset_src += offset_list_src[index] * bilinear_weight_list_src_[index];
+			const int* index_src = weight_index_src_.data() + residual_index * weight_number;
+			const double* weight_src = weight_src_.data() + residual_index * weight_number;
+			const int* index_tar = weight_index_tar_.data() + residual_index * weight_number;
+			const double* weight_tar = weight_tar_.data() + residual_index * weight_number;
+
+			double scale_src = 0;
+			double offset_src = 0;
+			double scale_tar = 0;
+			double offset_tar = 0;
+			for (int index = 0; index < weight_number; index++)
+			{
+				scale_src += scale_list_src[index_src[index]] * weight_src[index];
+				offset_src += offset_list_src[index_src[index]] * weight_src[index];
+				scale_tar += scale_list_tar[index_tar[index]] * weight_tar[index];
+				offset_tar += offset_list_tar[index_tar[index]] * weight_tar[index];
+			}
+			const double depth_value_src = depth_value_src_[residual_index];
+			const double depth_value_tar = depth_value_tar_[residual_index];
+			const double temp = (depth_value_tar * scale_tar + offset_tar) - (depth_value_src * scale_src + offset_src);
+			residuals[residual_index] = temp * temp;
 
-			scale_tar += scale_list_tar[index] * bilinear_weight_list_tar_[index];
-			offset_tar += offset_list_tar[index] * bilinear_weight_list_tar_[index];
+			if (jacobians == nullptr)
+				continue;
+			// d(temp^2) = 2 * temp * d(temp)
+			const double residual_derivative = 2.0 * temp;
+			for (int index = 0; index < weight_number; index++)
+			{
+				double* jacobian_row = nullptr;
+				if (jacobians[0] != nullptr)
+				{
+					jacobian_row = jacobians[0] + residual_index * grid_size_;
+					jacobian_row[index_src[index]] -= residual_derivative * depth_value_src * weight_src[index];
+				}
+				if (jacobians[1] != nullptr)
+				{
+					jacobian_row = jacobians[1] + residual_index * grid_size_;
+					jacobian_row[index_src[index]] -= residual_derivative * weight_src[index];
+				}
+				if (jacobians[2] != nullptr)
+				{
+					jacobian_row = jacobians[2] + residual_index * grid_size_;
+					jacobian_row[index_tar[index]] += residual_derivative * depth_value_tar * weight_tar[index];
+				}
+				if (jacobians[3] != nullptr)
+				{
+					jacobian_row = jacobians[3] + residual_index * grid_size_;
+					jacobian_row[index_tar[index]] += residual_derivative * weight_tar[index];
+				}
+			}
 		}
-		T temp = (depth_value_tar_ * scale_tar + offset_tar) - (depth_value_src_ * scale_src + offset_src);
-		//T temp = (depth_value_tar_ * scale_tar + offset_tar) - depth_value_src_ ;
-		residual[0] = temp * temp;
 		return true;
 	}
 
 private:
-	const double depth_value_src_; // the depth value of source depth map
-	const double depth_value_tar_; // the depth value of corresponding pixel in reference depth map
-	const double* bilinear_weight_list_tar_; // weight of S and A, length is grid_x * grid_y
-	const double* bilinear_weight_list_src_; // weight of S and A, length is grid_x * grid_y
-	const int grid_width_; // the weight grid along the x axis
-	const int grid_height_; // the weight grid along the y axis
+	const int grid_size_; // the scale and offset grid size, grid_x * grid_y
+	const std::vector<double> depth_value_src_; // the depth value of source depth map
+	const std::vector<double> depth_value_tar_; // the depth value of corresponding pixel in target depth map
+	const std::vector<int> weight_index_src_; // the grid index of the source pixels' non-zero bilinear weights
+	const std::vector<double> weight_src_; // the source pixels' non-zero bilinear weights, the others are 0
+	const std::vector<int> weight_index_tar_; // the grid index of the target pixels' non-zero bilinear weights
+	const std::vector<double> weight_tar_; // the target pixels' non-zero bilinear weights, the others are 0
 };
 
 // @see hedman2018instant:equ_6
@@ -292,15 +348,20 @@ void DepthmapStitcherGroup::compute_align_coeff()
 	}
 
 	// adjusted depth map register to reference depth map to compute the scale and offset
-	int omp_num_threads = omp_get_max_threads() - 2;
+	// each depth map pair is one residual block, the blocks are built in parallel and added in order
+	const int depthmap_number = depthmap_original.size();
+	const int grid_size = grid_width * grid_height;
+	std::vector<ReprojectionPairResidual*> reprojection_residual_list(depthmap_number * depthmap_number, nullptr);
+	int omp_num_threads = std::max(omp_get_max_threads() - 2, 1);
 	LOG(INFO) << "Build ceres problem with " << omp_num_threads << " threads.";
-	#pragma omp parallel for ordered schedule(dynamic) num_threads(omp_num_threads)
-	for (int depthmap_index_src = 0; depthmap_index_src < depthmap_original.size(); depthmap_index_src++)
+	#pragma omp parallel for schedule(dynamic) num_threads(omp_num_threads)
+	for (int depthmap_index_src = 0; depthmap_index_src < depthmap_number; depthmap_index_src++)
 	{
 		DLOG(INFO) << "Adding the " << depthmap_index_src << " depth alignment information to problem."; 
 		const cv::Mat& depth_map_src = depthmap_original[depthmap_index_src];
-		//LOG(INFO) << "Target depth map" << depthmap_index_tar;
-		for (int depthmap_index_tar = 0; depthmap_index_tar < depthmap_original.size(); depthmap_index_tar++)
+		// the dense bilinear weights of one pixel, row-major
+		std::vector<double> bilinear_weight(grid_size);
+		for (int depthmap_index_tar = 0; depthmap_index_tar < depthmap_number; depthmap_index_tar++)
 		{
 			if (depthmap_index_tar == depthmap_index_src)
 				continue;
@@ -319,21 +380,15 @@ void DepthmapStitcherGroup::compute_align_coeff()
 
 			// adjusted depth map
 			const cv::Mat& depth_map_tar = depthmap_original[depthmap_index_tar];
-			//LOG(INFO) << "Source depth map:" << depthmap_index_src;
 
-			// grid interpolation weight for each pixel, row-major
-			double* bilinear_weight_list_src = (double*)malloc(grid_width * grid_height * observation_pairs_number * sizeof(double));
-			// memset(bilinear_weight_list_src, 0, grid_width * grid_height * observation_pairs_number * sizeof(double));
-			double* bilinear_weight_list_tar = (double*)malloc(grid_width * grid_height * observation_pairs_number * sizeof(double));
-			// memset(bilinear_weight_list_tar, 0, grid_width * grid_height * observation_pairs_number * sizeof(double));
-
-			#pragma omp critical(bilinear_weight_list_mem)
-			{
-				bilinear_weight_list_mem.push_back((void*)bilinear_weight_list_src);
-				bilinear_weight_list_mem.push_back((void*)bilinear_weight_list_tar);
-			}
-
-			// add the depth value and weight value
+			// the depth values and the non-zero bilinear weights of each pixel
+			const int weight_number = ReprojectionPairResidual::weight_number;
+			std::vector<double> depth_value_src(observation_pairs_number);
+			std::vector<double> depth_value_tar(observation_pairs_number);
+			std::vector<int> weight_index_src(observation_pairs_number * weight_number, 0);
+			std::vector<double> weight_src(observation_pairs_number * weight_number, 0.0);
+			std::vector<int> weight_index_tar(observation_pairs_number * weight_number, 0);
+			std::vector<double> weight_tar(observation_pairs_number * weight_number, 0.0);
 			for (int observations_index = 0; observations_index < observation_pairs_number; observations_index++)
 			{
 				const double y_src = pixels_corresponding.at<double>(observations_index, 0);
@@ -341,78 +396,53 @@ void DepthmapStitcherGroup::compute_align_coeff()
 				const double y_tar = pixels_corresponding.at<double>(observations_index, 2);
 				const double x_tar = pixels_corresponding.at<double>(observations_index, 3);
 
-				double depth_value_src = getColorSubpix(depth_map_src, cv::Point2f(x_src, y_src));
-				double depth_value_tar = getColorSubpix(depth_map_tar, cv::Point2f(x_tar, y_tar));
-
-				// compute the bilinear weights;
-				double* bilinear_weight_src = bilinear_weight_list_src + grid_width * grid_height * observations_index;
-				get_bilinear_weight(bilinear_weight_src, image_width, image_height, grid_height, grid_width, x_src, y_src);
-				double* bilinear_weight_tar = bilinear_weight_list_tar + grid_width * grid_height * observations_index;
-				get_bilinear_weight(bilinear_weight_tar, image_width, image_height, grid_height, grid_width, x_tar, y_tar);
+				depth_value_src[observations_index] = getColorSubpix(depth_map_src, cv::Point2f(x_src, y_src));
+				depth_value_tar[observations_index] = getColorSubpix(depth_map_tar, cv::Point2f(x_tar, y_tar));
 
-				//// for debug visuzlize the cv::Mat
-				//cv::Mat bilinear_weight_list_mat_src(cv::Size( coeff_so.coeff_cols, coeff_so.coeff_rows), CV_64FC1, bilinear_weight_src);
-				//cv::Mat bilinear_weight_list_mat_tar(cv::Size(coeff_so.coeff_cols, coeff_so.coeff_rows), CV_64FC1, bilinear_weight_tar);
-
-				// add residual block 
-				//if (depthmap_index_tar != depthmap_ref_intidx && depthmap_index_src != depthmap_ref_intidx)
-				{
-					// TODO The cauchyless is made bad result. figure our reason.
-					//ceres::LossFunction* reprojectionLoss = new ceres::ScaledLoss(new ceres::CauchyLoss(1), weight_re-projection, ceres::TAKE_OWNERSHIP);
-					ceres::LossFunction* reprojectionLoss = new ceres::ScaledLoss(nullptr, weight_reprojection, ceres::TAKE_OWNERSHIP);
-					ceres::DynamicAutoDiffCostFunction<ReprojectionResidual, 4>* reprojectionCoast =
-						new ceres::DynamicAutoDiffCostFunction<ReprojectionResidual, 4>(
-							new ReprojectionResidual(bilinear_weight_tar, bilinear_weight_src,
-								depth_value_tar, depth_value_src,
-								grid_width, grid_height));
-
-					// separate each depth map coefficients to reduce the Jacobian matrix scale
-					reprojectionCoast->AddParameterBlock(grid_width * grid_height);
-					reprojectionCoast->AddParameterBlock(grid_width * grid_height);
-					reprojectionCoast->AddParameterBlock(grid_width * grid_height);
-					reprojectionCoast->AddParameterBlock(grid_width * grid_height);
-					reprojectionCoast->SetNumResiduals(1);
-
-					#pragma omp critical(problem)
+				// compute the bilinear weights, and keep the non-zero weights in the grid index order
+				get_bilinear_weight(bilinear_weight.data(), image_width, image_height, grid_height, grid_width, x_src, y_src);
+				int weight_counter = observations_index * weight_number;
+				for (int grid_index = 0; grid_index < grid_size; grid_index++)
+					if (bilinear_weight[grid_index] != 0.0)
 					{
-						problem.AddResidualBlock(
-							reprojectionCoast,
-							reprojectionLoss,
-							(s_ij_list + depthmap_index_src * grid_width * grid_height),
-							(o_ij_list + depthmap_index_src * grid_width * grid_height),
-							(s_ij_list + depthmap_index_tar * grid_width * grid_height),
-							(o_ij_list + depthmap_index_tar * grid_width * grid_height));
+						weight_index_src[weight_counter] = grid_index;
+						weight_src[weight_counter++] = bilinear_weight[grid_index];
+					}
+				get_bilinear_weight(bilinear_weight.data(), image_width, image_height, grid_height, grid_width, x_tar, y_tar);
+				weight_counter = observations_index * weight_number;
+				for (int grid_index = 0; grid_index < grid_size; grid_index++)
+					if (bilinear_weight[grid_index] != 0.0)
+					{
+						weight_index_tar[weight_counter] = grid_index;
+						weight_tar[weight_counter++] = bilinear_weight[grid_index];
 					}
-				}
-				//else if(depthmap_index_src == depthmap_ref_intidx){
-				//	ceres::LossFunction* reprojectionLoss = new ceres::ScaledLoss(nullptr, weight_reprojection, ceres::TAKE_OWNERSHIP);
-				//	//ceres::LossFunction* reprojectionLoss = new ceres::ScaledLoss(new ceres::CauchyLoss(1), weight_reprojection, ceres::TAKE_OWNERSHIP);
-				//	ceres::DynamicAutoDiffCostFunction<ReprojectionResidual_fixed, 4>* reprojectionCoast =
-				//		new ceres::DynamicAutoDiffCostFunction<ReprojectionResidual_fixed, 4>(
-				//			new ReprojectionResidual_fixed(bilinear_weight_tar,
-				//				depth_value_tar, depth_value_src, grid_width, grid_height));
-
-				//	// separate each depth map coefficients to reduce the Jacobian matrix scale
-				//	reprojectionCoast->AddParameterBlock(grid_width * grid_height);
-				//	reprojectionCoast->AddParameterBlock(grid_width * grid_height);
-				//	reprojectionCoast->SetNumResiduals(1);
-
-				//	problem.AddResidualBlock(
-				//		reprojectionCoast,
-				//		reprojectionLoss,
-				//		(s_ij_list + depthmap_index_tar * grid_width * grid_height),
-				//		(o_ij_list + depthmap_index_tar * grid_width * grid_height));
-				//	//problem.AddResidualBlock(
-				//	//	reprojectionCoast,
-				//	//	nullptr,
-				//	//	(s_ij_list + depthmap_index_tar * grid_width * grid_height),
-				//	//	(o_ij_list + depthmap_index_tar * grid_width * grid_height));
-				//}
 			}
 
+			reprojection_residual_list[depthmap_index_src * depthmap_number + depthmap_index_tar] =
+				new ReprojectionPairResidual(grid_size,
+					std::move(depth_value_src), std::move(depth_value_tar),
+					std::move(weight_index_src), std::move(weight_src),
+					std::move(weight_index_tar), std::move(weight_tar));
 		}// End of depthmap_counter_adjust
 	}// End of depthmap_counter_ref
 
+	for (int depthmap_index_src = 0; depthmap_index_src < depthmap_number; depthmap_index_src++)
+		for (int depthmap_index_tar = 0; depthmap_index_tar < depthmap_number; depthmap_index_tar++)
+		{
+			ReprojectionPairResidual* reprojectionCoast = reprojection_residual_list[depthmap_index_src * depthmap_number + depthmap_index_tar];
+			if (reprojectionCoast == nullptr)
+				continue;
+			// TODO The cauchyless is made bad result. figure our reason.
+			ceres::LossFunction* reprojectionLoss = new ceres::ScaledLoss(nullptr, weight_reprojection, ceres::TAKE_OWNERSHIP);
+			problem.AddResidualBlock(
+				reprojectionCoast,
+				reprojectionLoss,
+				(s_ij_list + depthmap_index_src * grid_size),
+				(o_ij_list + depthmap_index_src * grid_size),
+				(s_ij_list + depthmap_index_tar * grid_size),
+				(o_ij_list + depthmap_index_tar * grid_size));
+		}
+
 	// report the overlap 0 image pairs.
 	if (ignore_image_pair.size() != 0)
 	{
@@ -11,13 +11,17 @@ import numpy as np
 from PIL import Image
 import shutil
 import argparse
+import copy
+from concurrent.futures import ThreadPoolExecutor
+from skimage.transform import resize
 
 from utility import depthmap_align, image_io
 from utility import depthmap_utils, metrics
 from utility import blending
 from utility import serialization
-from utility import projection_icosahedron as proj_ico
+from utility import projection
 from utility import MAIN_DATA_DIR
+from utility.face_sequence import FaceSequenceCache
 
 from utility.logger import Logger
 
@@ -45,19 +49,29 @@ class Options():
         self.grid_search = False
 
         # 1) subimage generation option
+        self.projection = "icosahedron"  # the tangent faces projection, "icosahedron" 20 faces or "cubemap" 6 faces
         self.subimage_available_list = list(range(0, 20))
         self.subimage_padding_size = 0.3
         self.subimage_tangent_image_width = 400
         self.persp_monodepth = "midas2"
+        self.persp_monodepth_batch_size = None  # the faces number of each MiDaS forward pass, None for all faces
+        self.persp_monodepth_memory_limit = None  # the MiDaS peak memory limit of each forward pass in MB
+        self.persp_monodepth_weights_dir = None  # the local Torch Hub directory of the depth models, see model_registry
+        self.persp_monodepth_backend = "eager"  # the inference backend, "eager", "torchscript" or "onnx"
+        self.persp_monodepth_threads = None  # the CPU threads number of the inference, None for the default
+        self.persp_monodepth_quantization = "none"  # the int8 quantization, "none", "dynamic" or "static"
+        self.persp_monodepth_calibration_number = 8  # the faces number of the quantization calibration
+        self.quantization_report = False  # compare the quantized inference speed and depth maps with the float one
 
         # 3) subimage depthmap alignment parameters
-        self.dispalign_corr_thread_number = 10
         self.dispalign_pyramid_layer_number = 1
         self.multi_res_grid = False
         self.dispalign_pixelcorr_downsample_ratio = 0.001
+        self.dispalign_pixelcorr_cache_dir = None  # the cache of the faces' pixels corresponding, None for memory only
         self.dispalign_iter_num = 100
         self.dispalign_ceres_max_linear_solver_iterations = 10
         self.dispalign_method = "group"
+        self.dispalign_solver = "ceres"  # the alignment solver, "ceres" or "direct" to start ceres from the linear solution
         self.dispalign_weight_project = 1.0
         self.dispalign_weight_smooth = 40.
         self.dispalign_weight_scale = 0.007
@@ -69,6 +83,10 @@ class Options():
 
         # 2) subimage blending option
         self.blending_method = None
+        self.blending_cache_dir = None  # the cache of the blending weights and linear system, None to disable
+        self.poisson_solver = "eigen"  # the Poisson blending solver, "eigen", "cg" or "multigrid"
+        self.eigen_solver = "BiCGSTAB"  # the Eigen solver method of the "eigen" Poisson solver, "Auto" to select it
+        self.poisson_band_tolerance = None  # solve the Poisson blending near the overlaps within it, None for all
 
         # 3) debug option
         self.debug_enable = False
@@ -83,6 +101,19 @@ class Options():
         self.dataset_matterport_blur_area_height = 0
         self.dataset_matterport_blurarea_shape = "circle"  # "hexagon",  "circle"
 
+        # 6) numerical precision of the projection, alignment and blending arrays, solvers always use float64
+        self.precision = "float64"
+        self.precision_report = False  # compare float32 results with float64 pipeline
+
+        # 7) progressive output, write the coarse preview first and refine in background
+        self.progressive = False
+        self.progressive_preview_width = 128
+
+        # 8) 360 video sequence, reuse the previous frame's results of the unchanged tangent faces
+        self.sequence = False
+        self.sequence_change_method = "pixel"  # the face change detection, "pixel" or "hash"
+        self.sequence_change_threshold = None  # None for the method's default threshold
+
     def parser_arguments(self, parser):
         self.parser = parser
 
@@ -90,14 +121,64 @@ class Options():
         parser.add_argument("--expname", type=str, default="monodepth", help="experiment name")
         parser.add_argument("--blending_method", type=str, default="poisson",
                             choices=['poisson', 'frustum', 'radial', 'nn', 'mean', 'all'])
+        parser.add_argument("--poisson_solver", type=str, default="eigen", choices=["eigen", "cg", "multigrid"],
+                            help="The linear solver of the Poisson blending")
+        parser.add_argument("--eigen_solver", type=str, default="BiCGSTAB",
+                            choices=["SimplicialLLT", "SimplicialLDLT", "SparseLU", "ConjugateGradient",
+                                     "LeastSquaresConjugateGradient", "BiCGSTAB", "Auto"],
+                            help="The Eigen solver method of the eigen Poisson solver, Auto selects it from the "
+                                 "unknowns number and the available memory")
+        parser.add_argument("--poisson_band_tolerance", type=float, default=-1,
+                            help="Solve the Poisson blending only near the faces' overlaps and seams and copy the "
+                                 "single face pixels, the band margin keeps the result within this tolerance of the "
+                                 "full solve relative to its range, e.g. 1e-6. It needs the padding 0, with the "
+                                 "padding all pixels are in overlaps. Negative to solve all pixels")
+        parser.add_argument("--blending_cache_dir", type=str, default=os.path.join(MAIN_DATA_DIR, "cache/blending/"),
+                            help="Cache directory of the blending weights and linear system, empty to disable")
+        parser.add_argument("--pixelcorr_cache_dir", type=str,
+                            default=os.path.join(MAIN_DATA_DIR, "cache/pixelcorr/"),
+                            help="Cache directory of the faces' pixels corresponding of each geometry, empty to cache "
+                                 "them in memory only")
+        parser.add_argument("--align_solver", type=str, default="ceres", choices=["ceres", "direct"],
+                            help="The depth maps alignment solver, direct starts ceres from the solution of the "
+                                 "linear least-squares counterpart of its energy, solved in one sparse factorization")
         parser.add_argument("--data", type=str, default="../../../data/erp_00_data.txt",
                             help="The format of this file needs to be one line per sample as following: "
                                  "/path/to/rgb.[png,jpg] /path/to/depth_gt.dpt")
+        parser.add_argument("--projection", type=str, default="icosahedron", choices=projection.PROJECTIONS,
+                            help="The tangent faces of the ERP image, the icosahedron's 20 faces or the cubemap's "
+                                 "6 faces. The cubemap runs about 3x less monocular depth inference and is faster "
+                                 "to align and blend, with more distorted face borders and narrower overlaps, "
+                                 "so the seams are more visible")
         parser.add_argument("--grid_size", type=grid_size_type, default="8x7", help="width x height")
         parser.add_argument("--padding", type=float, default="0.3")
         parser.add_argument("--multires_levels", type=int, default=1, help="Levels of multi-resolution pyramid. If > 1"
                                                                            "then --grid_size is the lowest resolution")
-        parser.add_argument("--persp_monodepth", type=str, default="midas2", choices=["midas2", "midas3", "boost", "zoedepth"])
+        parser.add_argument("--persp_monodepth", type=str, default="midas2", choices=["midas2", "midas3", "boost", "zoedepth", "stub"],
+                            help="The perspective depth model, stub is a tiny model without weights to test offline")
+        parser.add_argument("--monodepth_batch_size", type=int, default=0,
+                            help="The tangent faces number of each MiDaS forward pass, 0 for all faces, and the "
+                                 "patches number of each boost forward pass, 0 for 4")
+        parser.add_argument("--monodepth_memory_limit", type=float, default=0,
+                            help="The MiDaS peak memory limit of each forward pass in MB, reduces the batch size, "
+                                 "0 for no limit")
+        parser.add_argument("--weights_dir", type=str, default="",
+                            help="The local Torch Hub directory of the depth models' code and weights, loaded without "
+                                 "network access, defaults to the Torch Hub directory")
+        parser.add_argument("--monodepth_backend", type=str, default="eager",
+                            choices=["eager", "torchscript", "onnx"],
+                            help="The inference backend of the MiDaS and stub models, torchscript and onnx export the "
+                                 "model once and run it on CPU")
+        parser.add_argument("--monodepth_threads", type=int, default=0,
+                            help="The CPU threads number of the depth inference, 0 for the default")
+        parser.add_argument("--monodepth_quantization", type=str, default="none",
+                            choices=["none", "dynamic", "static"],
+                            help="The int8 quantization of the MiDaS and stub models on CPU, static also quantizes "
+                                 "the activations calibrated on the first image's faces")
+        parser.add_argument("--calibration_number", type=int, default=8,
+                            help="The faces number of the static quantization calibration")
+        parser.add_argument("--quantization_report", default=False, action='store_true',
+                            help="Report the speed and the disparity error of each quantization against the float model")
         parser.add_argument('--depthalignstep', type=int, nargs='+', default=[1, 2, 3, 4])
         parser.add_argument("--rm_debug_folder", default=True, action='store_false')
         parser.add_argument("--intermediate_data", default=False, action='store_true', help="save intermediate data"
@@ -105,17 +186,47 @@ class Options():
                                                                                             "pipeline")
         parser.add_argument("--grid_search", default=False, action='store_true')
         parser.add_argument("--sample_size", type=int, default=0, help="Sample a subset from --data")
+        parser.add_argument("--precision", type=str, default="float64", choices=["float32", "float64"],
+                            help="Data type of the projection, alignment and blending arrays")
+        parser.add_argument("--precision_report", default=False, action='store_true',
+                            help="Also run the float64 pipeline and report the difference of the results")
+        parser.add_argument("--progressive", default=False, action='store_true',
+                            help="Output a coarse preview of each image first, then refine it in background")
+        parser.add_argument("--preview_width", type=int, default=128,
+                            help="The tangent image width of the progressive preview")
+        parser.add_argument("--sequence", default=False, action='store_true',
+                            help="The images are the frames of a 360 video, reuse the previous frame's results of "
+                                 "the unchanged tangent faces")
+        parser.add_argument("--sequence_change_method", type=str, default="pixel", choices=["pixel", "hash"],
+                            help="The face change detection of the sequence, the mean absolute pixel difference or "
+                                 "the difference hash")
+        parser.add_argument("--sequence_change_threshold", type=float, default=-1,
+                            help="The face is changed when the difference is larger than it, negative for the "
+                                 "method's default, 2.0 gray levels of pixel and 4 bits of hash")
         opt_arguments = parser.parse_args()
 
         # 2) update options
         self.expname = opt_arguments.expname
         self.blending_method = opt_arguments.blending_method
+        self.poisson_solver = opt_arguments.poisson_solver
+        self.eigen_solver = opt_arguments.eigen_solver
+        self.poisson_band_tolerance = opt_arguments.poisson_band_tolerance \
+            if opt_arguments.poisson_band_tolerance > 0 else None
+        self.blending_cache_dir = opt_arguments.blending_cache_dir if opt_arguments.blending_cache_dir else None
+        self.dispalign_pixelcorr_cache_dir = \
+            opt_arguments.pixelcorr_cache_dir if opt_arguments.pixelcorr_cache_dir else None
+        self.dispalign_solver = opt_arguments.align_solver
         self.data_fns = opt_arguments.data
         self.rm_debug_folder = opt_arguments.rm_debug_folder
         self.grid_search = opt_arguments.grid_search
         self.debug_enable = opt_arguments.intermediate_data
         self.dispalign_debug_enable = opt_arguments.intermediate_data
         self.subimage_padding_size = opt_arguments.padding
+        if self.poisson_band_tolerance is not None and self.subimage_padding_size > 0:
+            log.error("The Poisson band needs the padding 0, with the padding {} all pixels are in the faces' "
+                      "overlaps.".format(self.subimage_padding_size))
+        self.projection = opt_arguments.projection
+        self.subimage_available_list = list(range(0, projection.face_number(self.projection)))
         self.dispalign_align_coeff_grid_width = int(opt_arguments.grid_size.lower().split("x")[0])
         self.dispalign_align_coeff_grid_height = int(opt_arguments.grid_size.lower().split("x")[1])
         self.dispalign_pyramid_layer_number = opt_arguments.multires_levels
@@ -123,8 +234,26 @@ class Options():
             self.dispalign_iter_num = 50
             self.multi_res_grid = True
         self.persp_monodepth = opt_arguments.persp_monodepth
+        self.persp_monodepth_batch_size = opt_arguments.monodepth_batch_size \
+            if opt_arguments.monodepth_batch_size > 0 else None
+        self.persp_monodepth_memory_limit = opt_arguments.monodepth_memory_limit \
+            if opt_arguments.monodepth_memory_limit > 0 else None
+        self.persp_monodepth_weights_dir = opt_arguments.weights_dir if opt_arguments.weights_dir else None
+        self.persp_monodepth_backend = opt_arguments.monodepth_backend
+        self.persp_monodepth_threads = opt_arguments.monodepth_threads if opt_arguments.monodepth_threads > 0 else None
+        self.persp_monodepth_quantization = opt_arguments.monodepth_quantization
+        self.persp_monodepth_calibration_number = opt_arguments.calibration_number
+        self.quantization_report = opt_arguments.quantization_report
         self.available_steps = opt_arguments.depthalignstep
         self.sample_size = opt_arguments.sample_size
+        self.precision = opt_arguments.precision
+        self.precision_report = opt_arguments.precision_report
+        self.progressive = opt_arguments.progressive
+        self.progressive_preview_width = opt_arguments.preview_width
+        self.sequence = opt_arguments.sequence
+        self.sequence_change_method = opt_arguments.sequence_change_method
+        self.sequence_change_threshold = opt_arguments.sequence_change_threshold \
+            if opt_arguments.sequence_change_threshold >= 0 else None
 
         self.print()
 
@@ -141,7 +270,7 @@ class Options():
         print(message)
 
 
-def depthmap_estimation(erp_rgb_image_data, fnc, opt, blendIt, idx=1):
+def depthmap_estimation(erp_rgb_image_data, fnc, opt, blendIt, idx=1, sequence_cache=None):
     """ Estimate the ERP image depth map from ERP rgb image.
 
     :param erp_rgb_image_data: RGB image data, [height, width, 3]
@@ -153,8 +282,10 @@ def depthmap_estimation(erp_rgb_image_data, fnc, opt, blendIt, idx=1):
     """
     times = []  # Per stage
     total_time = 0.0
+    dtype = np.dtype(opt.precision)
 
     erp_image_height = erp_rgb_image_data.shape[0]
+    face_number = projection.face_number(opt.projection)
     subimage_dispmap_erp_list = []
     subimage_depthmap_erp_list = []  # the depth map in ERP image space
     subimage_rgb_list = []
@@ -162,15 +293,15 @@ def depthmap_estimation(erp_rgb_image_data, fnc, opt, blendIt, idx=1):
     subimage_cam_param_list = []
     tangent_image_gnomo_xy = []  # to convert the perspective image to ERP image
 
-    # 1) load ERP image & project to 20 face images
+    # 1) load ERP image & project to the tangent face images
     if 1 in opt.available_steps:
-        log.info("1) load ERP image & project to 20 face images")
+        log.info("1) load ERP image & project to the tangent face images")
         tic = time.perf_counter()
-        # project to 20 images
-        subimage_rgb_list, _, points_gnomocoord = proj_ico.erp2ico_image(erp_rgb_image_data,
-                                                                         opt.subimage_tangent_image_width,
-                                                                         opt.subimage_padding_size,
-                                                                         full_face_image=True)
+        # project to the tangent images
+        subimage_rgb_list, _, points_gnomocoord = projection.erp2face_image(opt.projection, erp_rgb_image_data,
+                                                                            opt.subimage_tangent_image_width,
+                                                                            opt.subimage_padding_size,
+                                                                            full_face_image=True, dtype=dtype)
         tangent_image_gnomo_xy = points_gnomocoord[1]
 
         if opt.debug_enable:
@@ -196,40 +327,50 @@ def depthmap_estimation(erp_rgb_image_data, fnc, opt, blendIt, idx=1):
         # load subimage rgb data from disk
         if not subimage_rgb_list or not tangent_image_gnomo_xy:
             log.info("load subimage's rgb data from disk.")
-            for index in list(range(0, 20)):
+            for index in list(range(0, face_number)):
                 src_image_output_path = fnc.subimage_rgb_filename_expression.format(index)
                 subimage_rgb_list.append(np.asarray(Image.open(src_image_output_path)))
             log.info("generate face gnomonic coordinate")
-            _, _, points_gnomocoord = proj_ico.erp2ico_image(erp_rgb_image_data, opt.subimage_tangent_image_width,
-                                                             opt.subimage_padding_size, full_face_image=True)
+            _, _, points_gnomocoord = projection.erp2face_image(opt.projection, erp_rgb_image_data,
+                                                                opt.subimage_tangent_image_width,
+                                                                opt.subimage_padding_size, full_face_image=True,
+                                                                dtype=dtype)
             tangent_image_gnomo_xy = points_gnomocoord[1]
 
         tic = time.perf_counter()
-        subimage_depthmap_persp_list = []
-        # estimate disparity map
-        subimage_dispmap_persp_list = depthmap_utils.run_persp_monodepth(subimage_rgb_list, opt.persp_monodepth)
+        # estimate disparity map, the face tensors convert all subimages at once
+        if sequence_cache is None:
+            subimage_dispmap_persp_list = depthmap_utils.run_persp_monodepth(
+                subimage_rgb_list, opt.persp_monodepth, batch_size=opt.persp_monodepth_batch_size,
+                memory_limit=opt.persp_monodepth_memory_limit)
+        else:
+            # only the changed faces of the video frame are estimated
+            subimage_dispmap_persp_list = sequence_cache.run_persp_monodepth(
+                subimage_rgb_list, opt.persp_monodepth, batch_size=opt.persp_monodepth_batch_size,
+                memory_limit=opt.persp_monodepth_memory_limit)
         # convert disparity map to depth map
-        for dispmap_persp in subimage_dispmap_persp_list:
-            subimage_depthmap_persp_list.append(depthmap_utils.disparity2depth(dispmap_persp))
+        subimage_depthmap_persp_list = depthmap_utils.disparity2depth(subimage_dispmap_persp_list, dtype=dtype)
         # convert each subimage's perspective depth map to ERP depth map.
-        for depthmap_persp in subimage_depthmap_persp_list:
-            subimage_depthmap_erp_list.append(
-                depthmap_utils.subdepthmap_tang2erp(depthmap_persp, tangent_image_gnomo_xy))
+        subimage_depthmap_erp_list = depthmap_utils.subdepthmap_tang2erp(subimage_depthmap_persp_list,
+                                                                         tangent_image_gnomo_xy)
         # convert each subimage's from ERP depth map to perspective map.
-        for depthmap_erp in subimage_depthmap_erp_list:
-            subimage_dispmap_erp_list.append(depthmap_utils.depth2disparity(depthmap_erp).astype(np.float32))
+        subimage_dispmap_erp_list = depthmap_utils.depth2disparity(subimage_depthmap_erp_list, dtype=np.float32)
 
         # output disparity map and visualized result.
         if opt.debug_enable:
             # output disparity map array
             dispmap_array_filename = fnc.subimage_dispmap_persp_filename_expression.format(999)
-            depthmap_utils.depth_ico_visual_save(subimage_dispmap_persp_list, dispmap_array_filename + ".jpg")
+            depthmap_utils.depth_ico_visual_save(subimage_dispmap_persp_list, dispmap_array_filename + ".jpg",
+                                                 face_number=face_number)
             depthmap_persp_array_filename = fnc.subimage_depthmap_persp_filename_expression.format(999)
-            depthmap_utils.depth_ico_visual_save(subimage_depthmap_persp_list, depthmap_persp_array_filename + ".jpg")
+            depthmap_utils.depth_ico_visual_save(subimage_depthmap_persp_list, depthmap_persp_array_filename + ".jpg",
+                                                 face_number=face_number)
             depthmap_erp_array_filename = fnc.subimage_depthmap_erp_filename_expression.format(999)
-            depthmap_utils.depth_ico_visual_save(subimage_depthmap_erp_list, depthmap_erp_array_filename + ".jpg")
+            depthmap_utils.depth_ico_visual_save(subimage_depthmap_erp_list, depthmap_erp_array_filename + ".jpg",
+                                                 face_number=face_number)
             subimage_dispmap_erp_filepath = fnc.subimage_dispmap_erp_filename_expression.format(999)
-            depthmap_utils.depth_ico_visual_save(subimage_dispmap_erp_list, subimage_dispmap_erp_filepath + ".jpg")
+            depthmap_utils.depth_ico_visual_save(subimage_dispmap_erp_list, subimage_dispmap_erp_filepath + ".jpg",
+                                                 face_number=face_number)
 
             # output disparity map
             for index in range(0, len(subimage_rgb_list)):
@@ -243,13 +384,19 @@ def depthmap_estimation(erp_rgb_image_data, fnc, opt, blendIt, idx=1):
         total_time += toc - tic
         times.append(toc-tic)
 
+        # outside of the step's time
+        if opt.quantization_report:
+            depthmap_utils.quantization_report(subimage_rgb_list, opt.persp_monodepth,
+                                               batch_size=opt.persp_monodepth_batch_size,
+                                               memory_limit=opt.persp_monodepth_memory_limit)
+
     # 3) align disparity maps
     if 3 in opt.available_steps:
         log.info("3) align disparity maps")
         # load subimage disparity map from disk
         if not subimage_dispmap_erp_list or not subimage_rgb_list:
             log.info("load subimage's MiDaS disparity maps from disk.")
-            for index in list(range(0, 20)):
+            for index in list(range(0, face_number)):
                 src_image_output_path = fnc.subimage_rgb_filename_expression.format(index)
                 subimage_rgb_list.append(np.asarray(Image.open(src_image_output_path)))
                 depth_filename = fnc.subimage_dispmap_erp_filename_expression.format(index)
@@ -263,7 +410,9 @@ def depthmap_estimation(erp_rgb_image_data, fnc, opt, blendIt, idx=1):
         depthmap_aligner.pyramid_layer_number = opt.dispalign_pyramid_layer_number
         depthmap_aligner.multi_res_grid = opt.multi_res_grid
         depthmap_aligner.downsample_pixelcorr_ratio = opt.dispalign_pixelcorr_downsample_ratio
+        depthmap_aligner.pixelcorr_cache_dir = opt.dispalign_pixelcorr_cache_dir
         depthmap_aligner.align_method = opt.dispalign_method
+        depthmap_aligner.align_solver = opt.dispalign_solver
         depthmap_aligner.ceres_max_num_iterations = opt.dispalign_iter_num
         depthmap_aligner.weight_project = opt.dispalign_weight_project
         depthmap_aligner.weight_smooth = opt.dispalign_weight_smooth
@@ -272,6 +421,8 @@ def depthmap_estimation(erp_rgb_image_data, fnc, opt, blendIt, idx=1):
         depthmap_aligner.align_coeff_grid_width = opt.dispalign_align_coeff_grid_width
         depthmap_aligner.align_coeff_grid_height = opt.dispalign_align_coeff_grid_height
         depthmap_aligner.ceres_max_linear_solver_iterations = opt.dispalign_ceres_max_linear_solver_iterations
+        depthmap_aligner.dtype = dtype
+        depthmap_aligner.projection = opt.projection
         if opt.dispalign_output_dir is not None:
             depthmap_aligner.output_dir = opt.dispalign_output_dir  # output cpp module alignment coefficient
         else:
@@ -287,9 +438,21 @@ def depthmap_estimation(erp_rgb_image_data, fnc, opt, blendIt, idx=1):
         # depthmap_aligner.subimage_depthmap_aligning_filepath_expression = fnc.subimage_alignment_depthmap_input_filename_expression
 
         subimage_dispmap_list_sub = [subimage_dispmap_erp_list[i] for i in opt.subimage_available_list]
-        dispmap_aligned_list, coeffs_scale, coeffs_offset, subimage_cam_param_list = \
-            depthmap_aligner.align_multi_res(erp_rgb_image_data, subimage_dispmap_list_sub, opt.subimage_padding_size,
-                                             opt.subimage_available_list)
+        if sequence_cache is not None and sequence_cache.unchanged() and sequence_cache.alignment is not None:
+            log.info("No face changed, reuse the previous frame's alignment.")
+            dispmap_aligned_list, coeffs_scale, coeffs_offset, subimage_cam_param_list = sequence_cache.alignment
+            sequence_cache.blend_changed_faces = []
+        else:
+            # the faces are aligned jointly, starting from the previous frame's coefficients
+            if sequence_cache is not None:
+                depthmap_aligner.align_coeff_initial_scale_list, depthmap_aligner.align_coeff_initial_offset_list = \
+                    sequence_cache.align_coeff_initial()
+            dispmap_aligned_list, coeffs_scale, coeffs_offset, subimage_cam_param_list = \
+                depthmap_aligner.align_multi_res(erp_rgb_image_data, subimage_dispmap_list_sub,
+                                                 opt.subimage_padding_size, opt.subimage_available_list)
+            if sequence_cache is not None:
+                dispmap_aligned_list, _ = sequence_cache.detect_aligned_changes(dispmap_aligned_list)
+                sequence_cache.alignment = (dispmap_aligned_list, coeffs_scale, coeffs_offset, subimage_cam_param_list)
 
         if opt.debug_enable:
             # visualized cpp module output aligned subimage's disparity map
@@ -307,10 +470,10 @@ def depthmap_estimation(erp_rgb_image_data, fnc, opt, blendIt, idx=1):
             # visualize align coefficients to image files
             depthmap_utils.depth_ico_visual_save(coeffs_scale,
                                                  fnc.subimage_dispmap_aligned_coeffs_filename_expression + "_scale.jpg",
-                                                 opt.subimage_available_list)
+                                                 opt.subimage_available_list, face_number)
             depthmap_utils.depth_ico_visual_save(coeffs_offset,
                                                  fnc.subimage_dispmap_aligned_coeffs_filename_expression + "_offset.jpg",
-                                                 opt.subimage_available_list)
+                                                 opt.subimage_available_list, face_number)
 
             # output the camera parameters to json files
             serialization.save_cam_params(fnc.subimage_camsparams_list_filename_expression, opt.subimage_available_list,
@@ -319,7 +482,7 @@ def depthmap_estimation(erp_rgb_image_data, fnc, opt, blendIt, idx=1):
             # output alignment disparity map array image
             depth_array_filename = fnc.subimage_dispmap_aligned_filename_expression.format(999)
             depthmap_utils.depth_ico_visual_save(dispmap_aligned_list, depth_array_filename + ".jpg",
-                                                 opt.subimage_available_list)
+                                                 opt.subimage_available_list, face_number)
 
             # output visualized alignment disparity map
             for index in range(0, len(dispmap_aligned_list)):
@@ -351,21 +514,52 @@ def depthmap_estimation(erp_rgb_image_data, fnc, opt, blendIt, idx=1):
         tic = time.perf_counter()
 
         erp_dispmap_blend = None
-        if len(opt.subimage_available_list) == 20:
+        if len(opt.subimage_available_list) == face_number:
             if idx == 0:
-                blendIt.tangent_images_coordinates(erp_image_height, dispmap_aligned_list[0].shape)
-                blendIt.erp_blendweights(subimage_cam_param_list, erp_image_height, dispmap_aligned_list[0].shape)
-                blendIt.compute_linear_system_matrices(erp_image_height, erp_image_height * 2, blendIt.frustum_blendweights)
-
-            erp_dispmap_blend = blendIt.blend(dispmap_aligned_list, erp_image_height)
+                tangent_img_size = dispmap_aligned_list[0].shape
+                if opt.blending_cache_dir is None or not blendIt.load_cache(
+                        opt.blending_cache_dir, erp_image_height, tangent_img_size, subimage_cam_param_list):
+                    blendIt.tangent_images_coordinates(erp_image_height, tangent_img_size)
+                    blendIt.erp_blendweights(subimage_cam_param_list, erp_image_height, tangent_img_size)
+                    blendIt.compute_linear_system_matrices(erp_image_height, erp_image_height * 2,
+                                                           blendIt.frustum_blendweights)
+                    if opt.blending_cache_dir is not None:
+                        blendIt.save_cache(opt.blending_cache_dir, erp_image_height, tangent_img_size,
+                                           subimage_cam_param_list)
+
+            if sequence_cache is not None and sequence_cache.unchanged() and sequence_cache.blended is not None:
+                log.info("No face changed, reuse the previous frame's blended disparity map.")
+                erp_dispmap_blend = dict(sequence_cache.blended)
+            else:
+                # the previous frame's Poisson blending is close to this frame's
+                initial_guess = None
+                if sequence_cache is not None and sequence_cache.blended is not None:
+                    initial_guess = sequence_cache.blended.get("poisson")
+                if sequence_cache is not None and sequence_cache.blend_changed_faces is not None:
+                    # only the faces whose aligned disparity maps changed are projected to the ERP tiles again
+                    erp_dispmap_blend, sequence_cache.blend_state = blendIt.blend_faces(
+                        dispmap_aligned_list, erp_image_height, sequence_cache.blend_changed_faces,
+                        sequence_cache.blend_state, initial_guess)
+                else:
+                    erp_dispmap_blend = blendIt.blend(dispmap_aligned_list, erp_image_height, initial_guess)
+                if sequence_cache is not None:
+                    sequence_cache.blended = dict(erp_dispmap_blend)
+                if "poisson" in erp_dispmap_blend:
+                    stats = blendIt.solver_stats
+                    log.info("Poisson blending with {}: setup {:.3f}s, solve {:.3f}s, {} iterations, residual {:.2e}, "
+                             "{:.1f} MB, {:.0%} of the pixels solved".format(
+                                 stats["solver"], stats["setup_time"], stats["solve_time"], stats["iterations"],
+                                 stats["residual"], stats["memory"] / 2 ** 20, stats["band"]))
+                    if stats["reason"]:
+                        log.info("Poisson blending solver selection: {}".format(stats["reason"]))
         else:
-            # available faces number is not 20, output subimages linear blend result
+            # available faces number is not all faces, output subimages linear blend result
             log.warn("Linear blend {} subimages.".format(len(opt.subimage_available_list)))
             # file with blank depth
             dispmap_aligned_list_filled = depthmap_utils.fill_ico_subimage(dispmap_aligned_list,
-                                                                           opt.subimage_available_list)
-            erp_dispmap_blend = proj_ico.ico2erp_image(dispmap_aligned_list_filled, erp_image_height,
-                                                       opt.subimage_padding_size, blender_method="mean")
+                                                                           opt.subimage_available_list, face_number)
+            erp_dispmap_blend = projection.face2erp_image(opt.projection, dispmap_aligned_list_filled, erp_image_height,
+                                                          opt.subimage_padding_size, blender_method="mean")
 
         if opt.debug_enable:
             if opt.blending_method == 'all':
@@ -388,6 +582,48 @@ def depthmap_estimation(erp_rgb_image_data, fnc, opt, blendIt, idx=1):
         return erp_dispmap_blend, times
 
 
+def depthmap_preview(erp_rgb_image_data, opt):
+    """ Estimate the coarse ERP disparity map from the low resolution tangent images.
+
+    The faces are not aligned, each face's disparity map is normalized by its mean and the overlap area is averaged.
+    The small monodepth model is used, and the ERP disparity map is blended at low resolution and upsampled.
+
+    :param erp_rgb_image_data: RGB image data, [height, width, 3]
+    :type erp_rgb_image_data: numpy
+    :return: the preview disparity map, [height, width]
+    :rtype: dict
+    """
+    tic = time.perf_counter()
+    dtype = np.dtype(opt.precision)
+    erp_image_height = erp_rgb_image_data.shape[0]
+
+    subimage_rgb_list, _, points_gnomocoord = projection.erp2face_image(opt.projection, erp_rgb_image_data,
+                                                                        opt.progressive_preview_width,
+                                                                        opt.subimage_padding_size,
+                                                                        full_face_image=True, dtype=dtype)
+    subimage_dispmap_persp_list = depthmap_utils.run_persp_monodepth(subimage_rgb_list, opt.persp_monodepth,
+                                                                     use_large_model=False,
+                                                                     batch_size=opt.persp_monodepth_batch_size,
+                                                                     memory_limit=opt.persp_monodepth_memory_limit)
+    subimage_depthmap_persp_list = depthmap_utils.disparity2depth(subimage_dispmap_persp_list, dtype=dtype)
+    subimage_depthmap_erp_list = depthmap_utils.subdepthmap_tang2erp(subimage_depthmap_persp_list,
+                                                                     points_gnomocoord[1])
+    subimage_dispmap_erp_list = depthmap_utils.depth2disparity(subimage_depthmap_erp_list, dtype=dtype)
+    dispmap_mean = np.mean(subimage_dispmap_erp_list.data, axis=(1, 2), keepdims=True)
+    subimage_dispmap_erp_list = subimage_dispmap_erp_list.like(subimage_dispmap_erp_list.data / dispmap_mean)
+
+    preview_erp_height = min(erp_image_height, opt.progressive_preview_width * 2)
+    erp_dispmap_preview = projection.face2erp_image(opt.projection, subimage_dispmap_erp_list.tolist(),
+                                                    preview_erp_height, opt.subimage_padding_size,
+                                                    blender_method="mean")[:, :, 0]
+    erp_dispmap_preview = resize(erp_dispmap_preview, (erp_image_height, erp_image_height * 2), order=1,
+                                 preserve_range=True).astype(dtype)
+
+    toc = time.perf_counter()
+    log.info(f"Estimate the preview disparity map in {toc - tic:0.4f} seconds.")
+    return {"preview": erp_dispmap_preview}
+
+
 def error_metric(depthmap_estimated, erp_gt_depthmap):
     """ Metric the error of the depthmap.
 
@@ -406,6 +642,77 @@ def error_metric(depthmap_estimated, erp_gt_depthmap):
     return pred_metrics
 
 
+def precision_error_metric(erp_rgb_image_data, fnc, opt, blend_it_reference, depthmap_estimated, idx=1):
+    """ Run the float64 pipeline and report how far the estimated depth map differs from it.
+
+    :param blend_it_reference: The float64 BlendIt object.
+    :type blend_it_reference: BlendIt
+    :param depthmap_estimated: The estimated depth maps of each blending method.
+    :type depthmap_estimated: dict
+    """
+    precision = opt.precision
+    opt.precision = "float64"
+    depthmap_reference, _ = depthmap_estimation(erp_rgb_image_data, fnc, opt, blend_it_reference, idx)
+    opt.precision = precision
+
+    precision_metrics = []
+    for key in depthmap_estimated.keys():
+        precision_metrics.append(metrics.report_precision_error(depthmap_reference[key], depthmap_estimated[key]))
+        log.info("{} precision difference to float64: {}".format(key, precision_metrics[-1]))
+
+    return precision_metrics
+
+
+def output_estimation(erp_rgb_image_data, erp_gt_filepath, fnc, opt, estimation, blend_it_reference, output_folder,
+                      times_header, idx, iter):
+    """ Report the error metrics and output the estimated depth map of one image.
+
+    :param estimation: The estimated depth maps of each blending method and the time of each step.
+    :type estimation: tuple
+    :param blend_it_reference: The float64 BlendIt object to report the precision difference, None to skip.
+    :type blend_it_reference: BlendIt
+    :return: The error metrics of each blending method, None if there is no ground truth.
+    :rtype: list
+    """
+    estimated_depthmap, times = estimation
+    output_results_file = os.path.join(output_folder, "{}.txt".format(opt.expname))
+    output_precision_file = os.path.join(output_folder, "{}_precision.txt".format(opt.expname))
+
+    if blend_it_reference is not None:
+        precision_metrics = precision_error_metric(erp_rgb_image_data, fnc, opt, blend_it_reference,
+                                                   estimated_depthmap, iter)
+        serialization.save_metrics(output_precision_file, precision_metrics, [], [],
+                                   idx, list(estimated_depthmap.keys()))
+
+    # get error fo ERP depth map
+    erp_gt_depthmap = depthmap_utils.read_dpt(erp_gt_filepath) if erp_gt_filepath != "" else None
+    pred_metrics = error_metric(estimated_depthmap, erp_gt_depthmap) if erp_gt_filepath != "" else None
+
+    serialization.save_predictions(output_folder, erp_gt_depthmap, erp_rgb_image_data, estimated_depthmap,
+                                   opt.persp_monodepth, idx=idx)
+
+    if not opt.grid_search:
+        serialization.save_metrics(output_results_file, pred_metrics, times, times_header,
+                                   idx, list(estimated_depthmap.keys()))
+    return pred_metrics
+
+
+def refine_progressive(erp_rgb_image_data, erp_gt_filepath, fnc, opt, blend_it, blend_it_reference, output_folder,
+                       times_header, idx, iter, sequence_cache=None):
+    """ Run the full pipeline of one progressive preview in background, and output the result as soon as it completes.
+
+    The result is written once by output_estimation, beside the preview written by serialization.save_progressive.
+
+    :param opt: The copy of this image's options, not shared with the following images.
+    :type opt: Options
+    :return: The error metrics of each blending method, None if there is no ground truth.
+    :rtype: list
+    """
+    estimation = depthmap_estimation(erp_rgb_image_data, fnc, opt, blend_it, iter, sequence_cache)
+    return output_estimation(erp_rgb_image_data, erp_gt_filepath, fnc, opt, estimation, blend_it_reference,
+                             output_folder, times_header, idx, iter)
+
+
 def monodepth_360(opt):
     """Pipeline."""
     # 0) settting parameters
@@ -421,6 +728,13 @@ def monodepth_360(opt):
         np.random.seed(1337)
         data_fns = np.random.choice(data_fns, size=opt.sample_size, replace=False)
 
+    # the depth models are loaded once and reused by all images and grid search iterations, depthmap_utils imports the
+    # registry module from the utility folder
+    depthmap_utils.model_registry.registry.set_weights_dir(opt.persp_monodepth_weights_dir)
+    depthmap_utils.model_registry.registry.set_backend(opt.persp_monodepth_backend, opt.persp_monodepth_threads)
+    depthmap_utils.model_registry.registry.set_quantization(opt.persp_monodepth_quantization,
+                                                            opt.persp_monodepth_calibration_number)
+
     # Grid Search
     if opt.grid_search:
         energy_weights = grid_search(fidelity_term=True)
@@ -428,9 +742,23 @@ def monodepth_360(opt):
         energy_weights = np.array([opt.dispalign_weight_smooth, opt.dispalign_weight_scale])[None, ...]
 
     # BlendIt object. Equation 7 of the paper
-    blend_it = blending.BlendIt(opt.subimage_padding_size, len(opt.subimage_available_list), opt.blending_method)
+    blend_it = blending.BlendIt(opt.subimage_padding_size, len(opt.subimage_available_list), opt.blending_method,
+                                np.dtype(opt.precision), opt.poisson_solver, opt.poisson_band_tolerance, opt.eigen_solver,
+                                opt.projection)
     blend_it.fidelity_weight = 0.1
 
+    # float64 reference to report the difference of the lower precision
+    blend_it_reference = None
+    if opt.precision_report and opt.precision != "float64":
+        blend_it_reference = blending.BlendIt(opt.subimage_padding_size, len(opt.subimage_available_list),
+                                              opt.blending_method, poisson_solver=opt.poisson_solver,
+                                              poisson_band_tolerance=opt.poisson_band_tolerance,
+                                              eigen_solver_type=opt.eigen_solver,
+                                              projection_name=opt.projection)
+
+    # the full pipeline refines the progressive previews in background, one image at a time
+    refine_executor = ThreadPoolExecutor(max_workers=1) if opt.progressive else None
+
     for weights in energy_weights:
         if isinstance(weights, np.ndarray):
             opt.dispalign_weight_smooth = weights[0]
@@ -438,10 +766,12 @@ def monodepth_360(opt):
             if opt.dispalign_weight_scale > 0:
                 opt.coeff_fixed_face_index = -1
             else:
-                opt.coeff_fixed_face_index = 7
+                opt.coeff_fixed_face_index = projection.reference_face(opt.projection)
         else:
             weights = np.array([weights])
             blend_it.fidelity_weight = weights[0]
+        if blend_it_reference is not None:
+            blend_it_reference.fidelity_weight = blend_it.fidelity_weight
 
         if opt.grid_search:
             if check_weights_processed(output_results_file, weights):
@@ -453,6 +783,10 @@ def monodepth_360(opt):
         times_header.append("t_total(s)")
 
         metrics_list = []
+        refinements = []  # the progressive refinement of each image
+        # the data are the frames of a 360 video in order, each frame reuses the previous frames' face results
+        sequence_cache = FaceSequenceCache(opt.sequence_change_method, opt.sequence_change_threshold) \
+            if opt.sequence else None
         iter = 0
         for idx, line in enumerate(data_fns):
 
@@ -485,26 +819,40 @@ def monodepth_360(opt):
 
             # load ERP rgb image and estimate the ERP depth map
             erp_rgb_image_data = image_io.image_read(erp_image_filepath)
-            # Load matrices for blending linear system
-            estimated_depthmap, times = depthmap_estimation(erp_rgb_image_data, fnc, opt, blend_it, iter)
-
-            # get error fo ERP depth map
-            erp_gt_depthmap = depthmap_utils.read_dpt(erp_gt_filepath) if erp_gt_filepath != "" else None
-            pred_metrics = error_metric(estimated_depthmap, erp_gt_depthmap) if erp_gt_filepath != "" else None
-
-            serialization.save_predictions(output_folder, erp_gt_depthmap, erp_rgb_image_data, estimated_depthmap,
-                                           opt.persp_monodepth, idx=idx)
+            if refine_executor is None:
+                # Load matrices for blending linear system
+                estimation = depthmap_estimation(erp_rgb_image_data, fnc, opt, blend_it, iter, sequence_cache)
+                pred_metrics = output_estimation(erp_rgb_image_data, erp_gt_filepath, fnc, opt, estimation,
+                                                 blend_it_reference, output_folder, times_header, idx, iter)
+                if opt.grid_search:
+                    metrics_list.append(list(weights) + [item for dic in pred_metrics for item in dic.values()])
+
+                # Remove temporal storage folder
+                if opt.rm_debug_folder and os.path.isdir(debug_output_dir):
+                    shutil.rmtree(debug_output_dir)
+            else:
+                # output the preview at once, the full pipeline runs in background with a copy of this image's options
+                serialization.save_progressive(output_folder, depthmap_preview(erp_rgb_image_data, opt),
+                                               opt.persp_monodepth, idx)
+                # the argparse parser is shared, the options are not
+                image_opt = copy.deepcopy(opt, {id(opt.parser): opt.parser})
+                refinement = refine_executor.submit(refine_progressive, erp_rgb_image_data, erp_gt_filepath, fnc,
+                                                    image_opt, blend_it, blend_it_reference, output_folder,
+                                                    times_header, idx, iter, sequence_cache)
+                refinements.append((refinement, debug_output_dir))
+            iter += 1
 
+        # the refinements are output by the background worker, wait for them in order to collect the metrics
+        for refinement, _ in refinements:
+            pred_metrics = refinement.result()
             if opt.grid_search:
                 metrics_list.append(list(weights) + [item for dic in pred_metrics for item in dic.values()])
-            else:
-                serialization.save_metrics(output_results_file, pred_metrics, times, times_header,
-                                           idx, list(estimated_depthmap.keys()))
 
-            # Remove temporal storage folder
-            if opt.rm_debug_folder and os.path.isdir(debug_output_dir):
-                shutil.rmtree(debug_output_dir)
-            iter += 1
+        # the images in the same folder share the debug folder, remove it after all refinements
+        if opt.rm_debug_folder:
+            for debug_output_dir in set(debug_output_dir for _, debug_output_dir in refinements):
+                if os.path.isdir(debug_output_dir):
+                    shutil.rmtree(debug_output_dir)
 
         if opt.grid_search:
             metrics_list = np.array(metrics_list)
@@ -512,6 +860,9 @@ def monodepth_360(opt):
             with open(output_results_file, 'a') as f:
                 np.savetxt(f, metrics_list.reshape(1, -1), delimiter=',', fmt='%1.11f')
 
+    if refine_executor is not None:
+        refine_executor.shutdown()
+
 
 def grid_search(fidelity_term=False):
     if not fidelity_term:
@@ -0,0 +1,102 @@
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+
+from utility import spherical_coordinates as sc
+from utility import gnomonic_projection as gp
+
+from utility.logger import Logger
+
+log = Logger(__name__)
+log.logger.propagate = False
+
+
+def kernel_calls(erp_height):
+    """The coordinate kernels of the ERP to tangent image projection, called on a full ERP grid.
+
+    Each item is (name, allocating call, out buffer call, out buffer allocation).
+    The out buffer calls write into the given buffers in place, the allocating calls return new arrays.
+    """
+    erp_width = erp_height * 2
+    erp_x, erp_y = np.meshgrid(np.arange(erp_width, dtype=np.float64), np.arange(erp_height, dtype=np.float64))
+    erp_points = np.stack((erp_x, erp_y))
+    theta, phi = sc.erp2sph(erp_points, erp_height)
+    gnom_x, gnom_y = gp.gnomonic_projection(theta, phi, 0.3, 0.5)
+    gnom_range = [-1.0, 1.0, -1.0, 1.0]
+    tangent_size = erp_height // 2
+
+    def buffers_2():
+        return np.empty((2,) + theta.shape)
+
+    def buffers_3():
+        return np.empty((3,) + theta.shape)
+
+    def tuple_2(buffers):
+        return (buffers[0], buffers[1])
+
+    return [
+        ("erp2sph",
+         lambda: sc.erp2sph(erp_points, erp_height),
+         lambda out: sc.erp2sph(erp_points, erp_height, out=out),
+         buffers_2),
+        ("sph2erp",
+         lambda: sc.sph2erp(theta, phi, erp_height, True),
+         lambda out: sc.sph2erp(theta, phi, erp_height, True, out=tuple_2(out)),
+         buffers_2),
+        ("sph2car",
+         lambda: sc.sph2car(theta, phi),
+         lambda out: sc.sph2car(theta, phi, out=out),
+         buffers_3),
+        ("gnomonic_projection",
+         lambda: gp.gnomonic_projection(theta, phi, 0.3, 0.5),
+         lambda out: gp.gnomonic_projection(theta, phi, 0.3, 0.5, out=tuple_2(out)),
+         buffers_2),
+        ("reverse_gnomonic_projection",
+         lambda: gp.reverse_gnomonic_projection(gnom_x, gnom_y, 0.3, 0.5),
+         lambda out: gp.reverse_gnomonic_projection(gnom_x, gnom_y, 0.3, 0.5, out=tuple_2(out)),
+         buffers_2),
+        ("pixel2gnomonic",
+         lambda: gp.pixel2gnomonic(erp_x, erp_y, 0.1, tangent_size, tangent_size, gnom_range),
+         lambda out: gp.pixel2gnomonic(erp_x, erp_y, 0.1, tangent_size, tangent_size, gnom_range, out=tuple_2(out)),
+         buffers_2),
+    ]
+
+
+def measure(function, repeat):
+    """Return the best run time in seconds and the peak traced memory in bytes of the function."""
+    run_time = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        run_time.append(time.perf_counter() - start)
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(run_time), peak
+
+
+def benchmark(erp_height, repeat):
+    log.info("ERP grid {}x{}:".format(erp_height * 2, erp_height))
+    log.info("{:<30}{:>14}{:>14}{:>14}{:>14}".format("kernel", "alloc (ms)", "out= (ms)", "alloc (MB)", "out= (MB)"))
+    pixel_number = erp_height * erp_height * 2
+    for name, alloc_call, out_call, out_buffers in kernel_calls(erp_height):
+        out = out_buffers()
+        alloc_time, alloc_peak = measure(alloc_call, repeat)
+        out_time, out_peak = measure(lambda: out_call(out), repeat)
+        log.info("{:<30}{:>14.1f}{:>14.1f}{:>14.1f}{:>14.1f}".format(
+            name, alloc_time * 1e3, out_time * 1e3, alloc_peak / 2 ** 20, out_peak / 2 ** 20))
+        log.debug("{}: {:.1f} Mpixel/s with out= buffers.".format(name, pixel_number / out_time * 1e-6))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the spherical and gnomonic coordinate kernels, "
+                                                 "with and without the out= buffers.")
+    parser.add_argument("--erp_height", type=int, nargs="+", default=[2048, 4096],
+                        help="The ERP image heights of the benchmark grids, 2048 is 4K and 4096 is 8K.")
+    parser.add_argument("--repeat", type=int, default=3, help="The number of timed runs, the best one is reported.")
+    args = parser.parse_args()
+    for erp_height in args.erp_height:
+        benchmark(erp_height, args.repeat)
@@ -1,7 +1,8 @@
 import depthmap_utils
-import projection_icosahedron as proj_ico
+import projection
 import gnomonic_projection as gp
 import spherical_coordinates as sc
+from face_tensor import FaceTensor
 
 from instaOmniDepth import EigenSolvers
 LinearSolver = EigenSolvers.LinearSolver
@@ -20,8 +21,11 @@ import scipy.sparse
 import matplotlib.pyplot as plt
 
 import json
+import os
 
 import numpy as np
+import serialization
+from multigrid import MultigridSolver
 
 from logger import Logger
 
@@ -29,9 +33,210 @@ log = Logger(__name__)
 log.logger.propagate = False
 import time
 
+# The blending methods of BlendIt.blend
+BLEND_METHODS = ["poisson", "frustum", "radial", "nn", "mean"]
+
+# The version of the BlendIt cache file layout, the cache entries of the other versions are rejected
+BLEND_CACHE_VERSION = 1
+
+
+class FaceTile:
+    """The bounding region of a tangent face on the ERP image.
+
+    The face data is stored in a (height, width) tile whose top-left pixel is (row_start, col_start) of the ERP image.
+    The tile columns are unwrapped, the columns past the ERP image right border continue from the ERP column 0.
+    """
+
+    def __init__(self, row_start, col_start, height, width, erp_size):
+        self.row_start = row_start
+        self.col_start = col_start
+        self.height = height
+        self.width = width
+        self.erp_size = erp_size
+
+    @classmethod
+    def from_erp_pixels(cls, erp_xv, erp_yv, erp_size):
+        """Create the smallest tile covering the ERP pixels, the covered columns may wrap around the ERP image.
+
+        :param erp_xv: The ERP pixels' x coordinate.
+        :type erp_xv: numpy
+        :param erp_yv: The ERP pixels' y coordinate.
+        :type erp_yv: numpy
+        :param erp_size: The ERP image size, [height, width].
+        :type erp_size: tuple
+        """
+        erp_image_height, erp_image_width = erp_size
+        rows = erp_yv.astype(int)
+        cols = np.unique(erp_xv.astype(int))
+        if len(cols) == erp_image_width:
+            col_start = 0
+            width = erp_image_width
+        else:
+            # the tile starts after the largest uncovered column gap
+            gaps = np.diff(np.append(cols, cols[0] + erp_image_width))
+            gap_index = np.argmax(gaps)
+            col_start = cols[(gap_index + 1) % len(cols)]
+            width = erp_image_width - gaps[gap_index] + 1
+        row_start = np.amin(rows)
+        height = np.amax(rows) - row_start + 1
+        return cls(int(row_start), int(col_start), int(height), int(width), erp_size)
+
+    def local_index(self, erp_xv, erp_yv):
+        """Convert ERP pixel coordinates to the tile's (row, col) index."""
+        rows = erp_yv.astype(int) - self.row_start
+        cols = np.remainder(erp_xv.astype(int) - self.col_start, self.erp_size[1])
+        return rows, cols
+
+    def new(self, fill_value, dtype=np.float64):
+        return np.full((self.height, self.width), fill_value, dtype)
+
+    def segments(self):
+        """The (tile column slice, ERP column slice) pairs, at most two when the tile wraps around."""
+        erp_image_width = self.erp_size[1]
+        first_width = min(self.width, erp_image_width - self.col_start)
+        segments = [(slice(0, first_width), slice(self.col_start, self.col_start + first_width))]
+        if first_width < self.width:
+            segments.append((slice(first_width, self.width), slice(0, self.width - first_width)))
+        return segments
+
+    def add_to(self, erp_image, tile_data):
+        """Accumulate the tile data to the ERP image in place."""
+        row_slice = slice(self.row_start, self.row_start + self.height)
+        for tile_cols, erp_cols in self.segments():
+            erp_image[row_slice, erp_cols] += tile_data[:, tile_cols]
+
+    def extract(self, erp_image):
+        """Copy the tile region of the ERP image to a new tile."""
+        row_slice = slice(self.row_start, self.row_start + self.height)
+        tile_data = np.empty((self.height, self.width), erp_image.dtype)
+        for tile_cols, erp_cols in self.segments():
+            tile_data[:, tile_cols] = erp_image[row_slice, erp_cols]
+        return tile_data
+
+    def wraps_full_width(self):
+        return self.width == self.erp_size[1]
+
+
+class GradientFidelityOperator:
+    """The matrix-free normal operator A^T A of the weighted gradient-fidelity system.
+
+    A^T A x = Gx^T D Gx x + Gy^T D Gy x + fidelity^2 x, where Gx and Gy are the forward differences with the
+    longitude wrap around and D is the sum of the faces' squared blend weights. It's applied as a stencil on the
+    ERP image, so the memory is proportional to the pixels number.
+    """
+
+    def __init__(self, weights_sq_sum, fidelity_weight, scale=None):
+        """
+        :param weights_sq_sum: The sum of the faces' squared blend weights, [rows, cols].
+        :type weights_sq_sum: numpy
+        :param fidelity_weight: The fidelity term weight.
+        :type fidelity_weight: float
+        :param scale: The symmetric diagonal scaling of the operator, S A^T A S, [rows * cols], defaults to None.
+        :type scale: numpy, optional
+        """
+        self.weights_sq_sum = weights_sq_sum
+        self.fidelity_weight = fidelity_weight
+        self.scale = scale
+        self.shape = (weights_sq_sum.size, weights_sq_sum.size)
+        self.dtype = np.dtype(np.float64)
+
+    def scaled(self, scale):
+        """The operator S A^T A S with the diagonal scaling S = diag(scale)."""
+        return GradientFidelityOperator(self.weights_sq_sum, self.fidelity_weight, scale)
+
+    def diagonal(self):
+        weights = self.weights_sq_sum
+        diagonal = 2 * weights + np.roll(weights, 1, axis=1) + self.fidelity_weight * self.fidelity_weight
+        diagonal[1:] += weights[:-1]
+        diagonal = diagonal.ravel()
+        if self.scale is not None:
+            diagonal *= self.scale * self.scale
+        return diagonal
+
+    def __matmul__(self, x):
+        """Apply the operator to x, [rows * cols] or [rows * cols, k]."""
+        rows, cols = self.weights_sq_sum.shape
+        image = x.reshape((rows, cols, -1))
+        weights = self.weights_sq_sum[:, :, None]
+        if self.scale is not None:
+            scale = self.scale.reshape((rows, cols, 1))
+            image = image * scale
+
+        # the weighted forward differences, the row after the last row is 0
+        grad_x = np.roll(image, -1, axis=1) - image
+        grad_x *= weights
+        grad_y = np.negative(image)
+        grad_y[:-1] += image[1:]
+        grad_y *= weights
+
+        # the transposed forward differences
+        result = np.roll(grad_x, 1, axis=1)
+        result -= grad_x
+        result -= grad_y
+        result[1:] += grad_y[:-1]
+        result += (self.fidelity_weight * self.fidelity_weight) * image
+        if self.scale is not None:
+            result *= scale
+        return result.reshape(x.shape)
+
+
+def batch_conjugate_gradient(A, b, tol=1e-05, maxiter=None, stats=None):
+    """Solve the symmetric positive definite system for all columns of b with the Jacobi preconditioned CG.
+
+    The columns are iterated together, so each iteration multiplies the sparse matrix once with all search
+    directions. The Jacobi preconditioner is applied by scaling the system once, A_s = D^-1/2 A D^-1/2,
+    and the converged columns are not updated anymore.
+
+    :param A: The system matrix, [n, n], or the matrix-free GradientFidelityOperator.
+    :type A: scipy.sparse.csr_matrix
+    :param b: The right-hand sides, [n, k].
+    :type b: numpy
+    :param tol: The relative residual tolerance of each column.
+    :type tol: float
+    :param maxiter: The maximum iteration number, defaults to 10 * n.
+    :type maxiter: int, optional
+    :param stats: Output the iteration number and the largest relative residual of the scaled system to it.
+    :type stats: dict, optional
+    :return: The solutions, [n, k].
+    :rtype: numpy
+    """
+    maxiter = 10 * A.shape[0] if maxiter is None else maxiter
+    scale = 1.0 / np.sqrt(A.diagonal())
+    if scipy.sparse.issparse(A):
+        scale_mat = scipy.sparse.diags(scale)
+        A_scaled = (scale_mat @ A @ scale_mat).tocsr()
+    else:
+        A_scaled = A.scaled(scale)
+
+    r = b * scale[:, None]
+    y = np.zeros_like(r)
+    p = r.copy()
+    rr = np.einsum("ij,ij->j", r, r)
+    rr_initial = np.where(rr > 0, rr, 1.0)
+    threshold = tol * tol * rr
+    active = rr > threshold
+    iterations = 0
+    for iterations in range(maxiter + 1):
+        if not np.any(active) or iterations == maxiter:
+            break
+        Ap = A_scaled @ p
+        alpha = np.where(active, rr / np.where(active, np.einsum("ij,ij->j", p, Ap), 1.0), 0.0)
+        y += p * alpha
+        r -= Ap * alpha
+        rr_new = np.einsum("ij,ij->j", r, r)
+        active &= rr_new > threshold
+        beta = np.where(active, rr_new / np.where(active, rr, 1.0), 0.0)
+        p = r + p * beta
+        rr = rr_new
+    if stats is not None:
+        stats["iterations"] = iterations
+        stats["residual"] = float(np.sqrt(np.max(rr / rr_initial)))
+    return y * scale[:, None]
+
 
 class BlendIt:
-    def __init__(self, padding, n_subimages, blending_method):
+    def __init__(self, padding, n_subimages, blending_method, dtype=np.float64, poisson_solver="eigen",
+                 poisson_band_tolerance=None, eigen_solver_type="BiCGSTAB", projection_name="icosahedron"):
         # sub-image number
         self.fidelity_weight = 1.0
         self.inflection_point = 10  # point where slope starts to affect the radial blendweights
@@ -39,94 +244,318 @@ class BlendIt:
         self.n_subimages = n_subimages
         self.blending_method = blending_method
         self.padding = padding
+        self.projection_name = projection_name  # the tangent faces projection, "icosahedron" or "cubemap"
+        self.face_number = projection.face_number(projection_name)
+        self.dtype = dtype  # data type of the weights and blended images, the linear system is always float64
         self.triangle_coordinates_erp = []  # Pixel coordinates of the triangular tangent face in equirect image
         self.triangle_coordinates_tangent = []
         self.squared_coordinates_erp = []  # Pixel coordinates of the squared (plane) tangent face in equirect image
         self.squared_coordinates_tangent = []
-        self.radial_blendweights = None
-        self.frustum_blendweights = None
-        self.A = None
+        self.squared_coordinates_tile = []  # Pixel coordinates of the squared tangent face in its ERP tile
+        self.face_tiles = []  # The FaceTile of each tangent face, the per-face ERP data are stored in these tiles
+        self.radial_blendweights = None  # list of per-face weight tiles
+        self.frustum_blendweights = None  # list of per-face weight tiles
+        self.normalized_weights = {}  # the weight tiles divided by their sum over the faces, computed on first use
+        self.AtA = None
         self.x_grad_mat = None
         self.y_grad_mat = None
-        if blending_method == "all" or blending_method == "poisson":
+        # The Poisson blending solver: "eigen", "cg" the batched conjugate gradient, or "multigrid"
+        self.poisson_solver = poisson_solver
+        self.multigrid_solver = None
+        # The Poisson system is solved only within a band around the faces' overlaps and seams, whose margin keeps
+        # the relative difference to the full solve below this tolerance, see poisson_band_margin. None to solve
+        # all pixels. The other pixels are covered by one face and copied from it.
+        self.poisson_band_tolerance = poisson_band_tolerance
+        self.band_mask = None  # the unknown pixels of the band restricted system, [rows * cols]
+        self.band_AtA = None  # the normal matrix of the band pixels
+        self.band_coupling = None  # the normal matrix rows of the band pixels, columns of the copied pixels
+        # The statistics of the last Poisson solve: the solver, setup and solve time, iterations, relative residual,
+        # the nonzeros of the factors or the multigrid levels and the estimated memory bytes
+        self.solver_stats = {}
+        self.setup_time = 0.0
+        if poisson_solver not in ["eigen", "cg", "multigrid"]:
+            log.error("The Poisson blending solver {} is not supported.".format(poisson_solver))
+        if poisson_band_tolerance is not None and poisson_solver == "multigrid":
+            log.warn("The multigrid solver needs the full ERP grid, the Poisson band is ignored.")
+        if (blending_method == "all" or blending_method == "poisson") and poisson_solver == "eigen":
             # Supported solvers: [SimplicialLLT, SimplicialLDLT, SparseLU, ConjugateGradient,
-            #                     LeastSquaresConjugateGradient, BiCGSTAB]
-            self.eigen_solver = LinearSolver(LinearSolver.solverType.BiCGSTAB)
+            #                     LeastSquaresConjugateGradient, BiCGSTAB, Auto]
+            # Auto selects the direct or iterative solver from the unknowns number and the available memory
+            if not hasattr(LinearSolver.solverType, eigen_solver_type):
+                log.error("The Eigen solver {} is not supported.".format(eigen_solver_type))
+            self.eigen_solver = LinearSolver(getattr(LinearSolver.solverType, eigen_solver_type))
         else:
             self.eigen_solver = None
 
-    def blend(self, subimage_dispmap, erp_image_height):
-        """Blending the 20 face disparity map to ERP disparity map.
+    def blend(self, subimage_dispmap, erp_image_height, initial_guess=None, methods=None):
+        """Blending the 20 face, or 6 cubemap face, disparity map to ERP disparity map.
 
         This function use data in CPU memory, which have been pre-loaded or generated.
         To reduce the time of load data from disk.
 
-        :param subimage_dispmap: A list store the subimage dispartiy data .
+        :param subimage_dispmap: A list or FaceTensor store the subimage dispartiy data .
         :type subimage_dispmap: list
         :param sub_image_param: The subimage camera parameter.
         :type sub_image_param: dict
         :param erp_image_height: The height of output image.
         :type erp_image_height: float
+        :param initial_guess: The initial guess of the multigrid Poisson solver, e.g. the previous frame's result.
+        :type initial_guess: numpy, optional
+        :param methods: The blending methods to compute, defaults to the blending_method's.
+        :type methods: list, optional
         """
         tangent_disp_imgs = []
         if isinstance(subimage_dispmap, str):
-            for index in range(0, 20):
+            for index in range(0, self.face_number):
                 tangent_disp_imgs.append(depthmap_utils.read_pfm(subimage_dispmap.format(index))[0])
-        elif isinstance(subimage_dispmap, list):
+        elif isinstance(subimage_dispmap, (list, FaceTensor)):
             tangent_disp_imgs = subimage_dispmap
         else:
             log.error("Disparity map type error. {}".format(type(subimage_dispmap)))
 
-        if len(subimage_dispmap) != 20:
-            log.error("The blending input subimage size is not 20.")
+        initial_guess_list = None if initial_guess is None else [initial_guess]
+        return self.blend_batch([tangent_disp_imgs], erp_image_height, initial_guess_list, methods)[0]
+
+    def blend_batch(self, subimage_dispmap_list, erp_image_height, initial_guess_list=None, methods=None):
+        """Blend the face disparity maps of several same size ERP images.
+
+        The Poisson blending right-hand sides of all images are solved together, as they share the linear system.
+
+        :param subimage_dispmap_list: The list of the images' face disparity maps, each is a list or FaceTensor.
+        :type subimage_dispmap_list: list
+        :param erp_image_height: The height of output images.
+        :type erp_image_height: int
+        :param initial_guess_list: The initial guess of each image's multigrid Poisson solve,
+            defaults to the frustum blended images.
+        :type initial_guess_list: list, optional
+        :param methods: The blending methods to compute, only these are computed, defaults to the blending_method's.
+            The "poisson" method needs the linear system of the blending_method "poisson" or "all".
+        :type methods: list, optional
+        :return: The blended ERP disparity maps of each image, each is a dict of the blending methods' results.
+        :rtype: list
+        """
+        if methods is None:
+            methods = BLEND_METHODS if self.blending_method == "all" else [self.blending_method]
+        for method in methods:
+            if method not in BLEND_METHODS:
+                log.error("The blending method {} is not supported.".format(method))
+        if "poisson" in methods and self.AtA is None:
+            log.error("The Poisson blending linear system is not computed.")
+
+        for subimage_dispmap in subimage_dispmap_list:
+            if not isinstance(subimage_dispmap, (list, FaceTensor)):
+                log.error("Disparity map type error. {}".format(type(subimage_dispmap)))
+            if len(subimage_dispmap) != self.face_number:
+                log.error("The blending input subimage size is not {}.".format(self.face_number))
 
         # 0) get tangent image information
         erp_image_width = erp_image_height * 2
         erp_size = (erp_image_height, erp_image_width)
-        tangent_image_size = subimage_dispmap[0].shape
 
-        # Get erp depth image with as many channels as tangent images along with nearest neighbour (nn) blended image.
-        # Also, get erp weight images with the same channels.
-        equirect_depth_tensor, nn_blending = self.misc_data(tangent_disp_imgs, erp_size)
-
-        # Normalize
-        norm_radial_blendweights = np.divide(self.radial_blendweights,
-                                             np.sum(self.radial_blendweights, axis=2)[..., None],
-                                             where=(np.sum(self.radial_blendweights, axis=2) > 0)[..., None])
-
-        norm_frustum_blendweights = np.divide(self.frustum_blendweights,
-                                              np.sum(self.frustum_blendweights, axis=2)[..., None],
-                                              where=(np.sum(self.frustum_blendweights, axis=2) > 0)[..., None])
-
-        radial_blended = np.nansum(norm_radial_blendweights * equirect_depth_tensor, axis=2)
-        frustum_blended = np.nansum(norm_frustum_blendweights * equirect_depth_tensor, axis=2)
-        mean_blended = np.nanmean(equirect_depth_tensor, axis=2)
+        blended_img_list = []
+        erp_depth_tiles_list = []
+        nn_blending_list = []
+        frustum_blended_list = []
+        for tangent_disp_imgs in subimage_dispmap_list:
+            # Get the per-face erp depth tiles along with nearest neighbour (nn) blended image.
+            erp_depth_tiles, nn_blending = self.misc_data(tangent_disp_imgs, erp_size)
+            erp_depth_tiles_list.append(erp_depth_tiles)
+            nn_blending_list.append(nn_blending)
+
+            blended_img = dict()
+            if 'poisson' in methods:
+                blended_img['poisson'] = None  # solved with all images below
+            if 'frustum' in methods or \
+                    ('poisson' in methods and self.multigrid_solver is not None and initial_guess_list is None):
+                frustum_blended_list.append(self.weighted_blending(erp_depth_tiles,
+                                                                   self.normalized_blendweights("frustum"), erp_size))
+            if 'frustum' in methods:
+                blended_img['frustum'] = frustum_blended_list[-1]
+            if 'radial' in methods:
+                blended_img['radial'] = self.weighted_blending(erp_depth_tiles,
+                                                               self.normalized_blendweights("radial"), erp_size)
+            if 'nn' in methods:
+                blended_img['nn'] = nn_blending
+            if 'mean' in methods:
+                blended_img['mean'] = self.mean_blending(erp_depth_tiles, erp_size)
+            blended_img_list.append(blended_img)
+
+        if 'poisson' in methods:
+            if initial_guess_list is None and self.multigrid_solver is not None:
+                initial_guess_list = frustum_blended_list
+            poisson_blended_list = self.gradient_blending_batch(erp_depth_tiles_list, self.frustum_blendweights,
+                                                                nn_blending_list, initial_guess_list)
+            for blended_img, poisson_blended in zip(blended_img_list, poisson_blended_list):
+                blended_img['poisson'] = poisson_blended
+
+        return blended_img_list
+
+    def blend_faces(self, subimage_dispmap, erp_image_height, changed_faces, face_state=None, initial_guess=None,
+                    methods=None):
+        """Blend a sequence frame's face disparity maps, only the changed faces' tiles and contributions are
+        recomputed.
+
+        The face state keeps the previous frame's per-face ERP tiles and their contributions to the blending methods
+        and to the Poisson right-hand side. The unchanged faces' contributions are reused and all faces'
+        contributions are summed in the face order, so the result is the same as blend's of the same face maps.
+
+        :param subimage_dispmap: The face disparity maps, a list or FaceTensor.
+        :type subimage_dispmap: list
+        :param erp_image_height: The height of output image.
+        :type erp_image_height: int
+        :param changed_faces: The faces whose disparity maps changed since the face state's frame.
+        :type changed_faces: list
+        :param face_state: The face state returned by the previous frame's blend_faces, None to compute all faces.
+        :type face_state: dict, optional
+        :param initial_guess: The initial guess of the multigrid Poisson solver, e.g. the previous frame's result.
+        :type initial_guess: numpy, optional
+        :param methods: The blending methods to compute, defaults to the blending_method's.
+        :type methods: list, optional
+        :return: The blended ERP disparity maps dict, and the face state of the next frame.
+        :rtype: tuple
+        """
+        if methods is None:
+            methods = BLEND_METHODS if self.blending_method == "all" else [self.blending_method]
+        for method in methods:
+            if method not in BLEND_METHODS:
+                log.error("The blending method {} is not supported.".format(method))
+        if "poisson" in methods and self.AtA is None:
+            log.error("The Poisson blending linear system is not computed.")
+        if len(subimage_dispmap) != self.face_number:
+            log.error("The blending input subimage size is not {}.".format(self.face_number))
+
+        erp_size = (erp_image_height, erp_image_height * 2)
+        # the frustum blending is the multigrid solver's default initial guess
+        contribution_methods = [method for method in methods if method != "nn"]
+        if "poisson" in methods and self.multigrid_solver is not None and initial_guess is None and \
+                "frustum" not in methods:
+            contribution_methods.append("frustum")
+        if face_state is None or face_state["methods"] != contribution_methods or \
+                face_state["erp_size"] != erp_size:
+            face_state = {"methods": contribution_methods, "erp_size": erp_size,
+                          "nn_values": [None] * self.face_number, "contributions": [None] * self.face_number}
+            changed_faces = range(self.face_number)
+        else:
+            face_state = {"methods": contribution_methods, "erp_size": erp_size,
+                          "nn_values": list(face_state["nn_values"]),
+                          "contributions": list(face_state["contributions"])}
+
+        for face_index in changed_faces:
+            erp_depth_tile, nn_values = self.face_erp_data(face_index, subimage_dispmap[face_index])
+            face_state["nn_values"][face_index] = nn_values
+            face_state["contributions"][face_index] = self.face_contributions(face_index, erp_depth_tile,
+                                                                              contribution_methods)
+        log.debug("Blend {} of {} faces' tiles.".format(len(changed_faces), self.face_number))
+
+        # sum the faces' contributions in the face order
+        nn_blending = np.zeros(erp_size, self.dtype)
+        for face_index, nn_values in enumerate(face_state["nn_values"]):
+            erp_tri_xv, erp_tri_yv = self.triangle_coordinates_erp[face_index]
+            nn_blending[erp_tri_yv.astype(int), erp_tri_xv.astype(int)] = nn_values
+        sums = {}
+        for method in contribution_methods:
+            sums[method] = [np.zeros(erp_size, np.float64 if method == "poisson" else self.dtype)
+                            for _ in face_state["contributions"][0][method]]
+            for tile, contributions in zip(self.face_tiles, face_state["contributions"]):
+                for erp_sum, contribution in zip(sums[method], contributions[method]):
+                    tile.add_to(erp_sum, contribution)
 
         blended_img = dict()
-        if self.blending_method == 'poisson':
-            blended_img[self.blending_method] = self.gradient_blending(equirect_depth_tensor, self.frustum_blendweights,
-                                                                       nn_blending)
-        if self.blending_method == 'frustum':
-            blended_img[self.blending_method] = frustum_blended
-
-        if self.blending_method == 'radial':
-            blended_img[self.blending_method] = radial_blended
-
-        if self.blending_method == 'nn':
-            blended_img[self.blending_method] = nn_blending
+        if "poisson" in methods:
+            b = np.asfortranarray(self.gradient_sums_rhs(sums["poisson"][0], sums["poisson"][1],
+                                                         nn_blending)[:, None])
+            if initial_guess is None and self.multigrid_solver is not None:
+                initial_guess = sums["frustum"][0]
+            initial_guess_list = None if initial_guess is None else [initial_guess]
+            blended_img["poisson"] = self.gradient_blending_solve(b, [nn_blending], initial_guess_list)[0]
+        if "frustum" in methods:
+            blended_img["frustum"] = sums["frustum"][0]
+        if "radial" in methods:
+            blended_img["radial"] = sums["radial"][0]
+        if "nn" in methods:
+            blended_img["nn"] = nn_blending
+        if "mean" in methods:
+            depth_sum, depth_count = sums["mean"]
+            blended_img["mean"] = np.divide(depth_sum, depth_count, out=np.full(erp_size, np.nan, self.dtype),
+                                            where=depth_count > 0)
+        return blended_img, face_state
+
+    def face_contributions(self, face_index, erp_depth_tile, methods):
+        """A face's contributions to the ERP sums of the blending methods, see blend_faces.
+
+        :param face_index: The face index.
+        :type face_index: int
+        :param erp_depth_tile: The face's ERP depth tile, the pixels out of the face are NaN.
+        :type erp_depth_tile: numpy
+        :param methods: The blending methods, except "nn".
+        :type methods: list
+        :return: The tiles added to each method's sums, the weighted depth of "frustum" and "radial", the depth
+            and the count of "mean", and the weighted forward differences of "poisson".
+        :rtype: dict
+        """
+        contributions = {}
+        for method in methods:
+            if method == "poisson":
+                contributions[method] = self.face_gradients(self.face_tiles[face_index], erp_depth_tile,
+                                                            self.frustum_blendweights[face_index])
+            elif method == "mean":
+                available = ~np.isnan(erp_depth_tile)
+                contributions[method] = (np.where(available, erp_depth_tile, 0), available)
+            else:
+                weights = self.normalized_blendweights(method)[face_index]
+                contributions[method] = (np.where(np.isnan(erp_depth_tile), 0, erp_depth_tile * weights),)
+        return contributions
+
+    def weighted_blending(self, erp_depth_tiles, normalized_weight_tiles, erp_size):
+        """Blend the face tiles with the weights normalized over all faces.
+
+        :param erp_depth_tiles: The per-face depth tiles, the pixels out of the face are NaN.
+        :type erp_depth_tiles: list
+        :param normalized_weight_tiles: The per-face blend weight tiles normalized over all faces,
+            see normalized_blendweights.
+        :type normalized_weight_tiles: list
+        :param erp_size: The ERP image size, [height, width].
+        :type erp_size: tuple
+        :return: The blended ERP image, the pixels without weight are 0.
+        :rtype: numpy
+        """
+        weighted_depth_sum = np.zeros(erp_size, self.dtype)
+        for tile, depth, weights in zip(self.face_tiles, erp_depth_tiles, normalized_weight_tiles):
+            tile.add_to(weighted_depth_sum, np.where(np.isnan(depth), 0, depth * weights))
+        return weighted_depth_sum
 
-        if self.blending_method == 'mean':
-            blended_img[self.blending_method] = mean_blended
+    def normalized_blendweights(self, name):
+        """The per-face weight tiles divided by the weight sum of all faces.
 
-        if self.blending_method == 'all':
-            blended_img['poisson'] = self.gradient_blending(equirect_depth_tensor, self.frustum_blendweights,
-                                                            nn_blending)
-            blended_img['frustum'] = frustum_blended
-            blended_img['radial'] = radial_blended
-            blended_img['nn'] = nn_blending
-            blended_img['mean'] = mean_blended
+        The normalization only depends on the geometry, it's computed on the first use and reused by all images.
 
-        return blended_img
+        :param name: The blend weights, "frustum" or "radial".
+        :type name: str
+        :return: The normalized weight tiles, the pixels without weight are 0.
+        :rtype: list
+        """
+        if name not in self.normalized_weights:
+            erp_weight_tiles = getattr(self, "{}_blendweights".format(name))
+            weight_sum = np.zeros(self.face_tiles[0].erp_size, self.dtype)
+            for tile, weights in zip(self.face_tiles, erp_weight_tiles):
+                tile.add_to(weight_sum, weights)
+            normalized_weight_tiles = []
+            for tile, weights in zip(self.face_tiles, erp_weight_tiles):
+                tile_weight_sum = tile.extract(weight_sum)
+                normalized_weight_tiles.append(np.divide(weights, tile_weight_sum, out=np.zeros_like(weights),
+                                                         where=tile_weight_sum > 0))
+            self.normalized_weights[name] = normalized_weight_tiles
+        return self.normalized_weights[name]
+
+    def mean_blending(self, erp_depth_tiles, erp_size):
+        """Average the face tiles, the pixels without any face are NaN."""
+        depth_sum = np.zeros(erp_size, self.dtype)
+        depth_count = np.zeros(erp_size, self.dtype)
+        for tile, depth in zip(self.face_tiles, erp_depth_tiles):
+            available = ~np.isnan(depth)
+            tile.add_to(depth_sum, np.where(available, depth, 0))
+            tile.add_to(depth_count, available)
+        return np.divide(depth_sum, depth_count, out=np.full(erp_size, np.nan, self.dtype), where=depth_count > 0)
 
     def tangent_images_coordinates(self, erp_image_height, tangent_img_size):
         """
@@ -142,10 +571,17 @@ class BlendIt:
         if erp_image_width != erp_image_height * 2:
             raise Exception("the ERP image dimession is {}x{}".format(erp_image_height, erp_image_width))
 
+        self.triangle_coordinates_erp = []
+        self.triangle_coordinates_tangent = []
+        self.squared_coordinates_erp = []
+        self.squared_coordinates_tangent = []
+        self.squared_coordinates_tile = []
+        self.face_tiles = []
+
         # stitch all tangnet images to ERP image
-        for triangle_index in range(0, 20):
+        for triangle_index in range(0, self.face_number):
             log.debug("stitch the tangent image {}".format(triangle_index))
-            triangle_param = proj_ico.get_icosahedron_parameters(triangle_index, self.padding)
+            triangle_param = projection.get_face_parameters(self.projection_name, triangle_index, self.padding)
 
             # 1) get all tangent triangle's available pixels coordinate
             availied_ERP_area = triangle_param["availied_ERP_area"]
@@ -218,7 +654,12 @@ class BlendIt:
             self.triangle_coordinates_erp.append([triangle_xv[inside_tri_pixels_list], triangle_yv[inside_tri_pixels_list]])
             self.squared_coordinates_erp.append([triangle_xv[inside_square_pixels_list], triangle_yv[inside_square_pixels_list]])
 
-    def erp_blendweights(self, sub_image_param_expression, erp_image_height, tangent_img_size, n_images=20):
+            # the tile only covers the squared face's ERP pixels
+            face_tile = FaceTile.from_erp_pixels(*self.squared_coordinates_erp[-1], (erp_image_height, erp_image_width))
+            self.face_tiles.append(face_tile)
+            self.squared_coordinates_tile.append(face_tile.local_index(*self.squared_coordinates_erp[-1]))
+
+    def erp_blendweights(self, sub_image_param_expression, erp_image_height, tangent_img_size, n_images=None):
         erp_image_width = 2 * erp_image_height
         if erp_image_width != erp_image_height * 2:
             raise Exception("the ERP image dimession is {}x{}".format(erp_image_height, erp_image_width))
@@ -231,8 +672,8 @@ class BlendIt:
         else:
             log.error("Camera parameter type error. {}".format(type(sub_image_param_expression)))
 
-        erp_radial_weights = np.full([erp_image_height, erp_image_width, n_images], 0, np.float64)
-        erp_frustum_weights = np.full([erp_image_height, erp_image_width, n_images], 0, np.float64)
+        erp_radial_weights = []
+        erp_frustum_weights = []
 
         tangent_img_blend_radial_weights = self.get_radial_blendweights(tangent_cam_params, tangent_img_size)
 
@@ -242,6 +683,9 @@ class BlendIt:
                                   tangent_cam_params['intrinsics']['focal_length_x']])
         min_f_length = np.argmax(focal_lengths)
         fov = np.degrees(np.arctan(tangent_img_size[min_f_length] * 0.5 / focal_lengths[min_f_length]))
+        if self.projection_name == "cubemap":
+            # the cube's vertices are farther from the face centers than the face edges, use the face corners' angle
+            fov = np.amax(tangent_img_blend_radial_weights)
         slope = -1 / (fov - self.inflection_point)
         bias = -self.inflection_point * slope + 1
 
@@ -250,9 +694,10 @@ class BlendIt:
 
         tangent_img_blend_frustum_weights = self.get_frustum_blendweights(tangent_img_size)
 
-        for triangle_index in range(0, n_images):
+        for triangle_index in range(0, self.face_number if n_images is None else n_images):
             tangent_sq_xv, tangent_sq_yv = self.squared_coordinates_tangent[triangle_index]
-            erp_sq_xv, erp_sq_yv = self.squared_coordinates_erp[triangle_index]
+            tile_sq_yv, tile_sq_xv = self.squared_coordinates_tile[triangle_index]
+            face_tile = self.face_tiles[triangle_index]
 
             erp_face_radial_weights = ndimage.map_coordinates(tangent_img_blend_radial_weights,
                                                               [tangent_sq_yv, tangent_sq_xv],
@@ -262,48 +707,61 @@ class BlendIt:
                                                                [tangent_sq_yv, tangent_sq_xv],
                                                                order=1, mode='constant', cval=0.)
 
-            erp_radial_weights[erp_sq_yv.astype(int), erp_sq_xv.astype(int), triangle_index] = erp_face_radial_weights
+            erp_radial_weights.append(face_tile.new(0, self.dtype))
+            erp_radial_weights[-1][tile_sq_yv, tile_sq_xv] = erp_face_radial_weights
 
-            erp_frustum_weights[erp_sq_yv.astype(int), erp_sq_xv.astype(int),
-                                triangle_index] = erp_face_frustum_weights
+            erp_frustum_weights.append(face_tile.new(0, self.dtype))
+            erp_frustum_weights[-1][tile_sq_yv, tile_sq_xv] = erp_face_frustum_weights
 
         self.frustum_blendweights = erp_frustum_weights
         self.radial_blendweights = erp_radial_weights
+        self.normalized_weights = {}
 
     def misc_data(self, tangent_images, erp_size):
         """
         Based on Mingze's erp2ico_image method in projection_icosahedron.py
         :param tangent_images:
-        :param sub_image_param_expression:
         :param erp_size:
-        :param tangent_img_size:
+        :return: The per-face ERP depth tiles, which are NaN out of the face, and the nn blended image.
         """
         erp_image_height, erp_image_width = erp_size
 
-        erp_depth_tensor = np.full([erp_image_height, erp_image_width, len(tangent_images)], np.nan, np.float64)
-        nn_blending = np.zeros(erp_size)
+        erp_depth_tiles = []
+        nn_blending = np.zeros(erp_size, self.dtype)
 
         if erp_image_width != erp_image_height * 2:
-            raise Exception("the ERP image dimession is {}".format(np.shape(erp_depth_tensor)))
+            raise Exception("the ERP image dimession is {}".format(erp_size))
 
         # stitch all tangent images to ERP image
-        for triangle_index in range(0, 20):
-            tangent_tri_xv, tangent_tri_yv = self.triangle_coordinates_tangent[triangle_index]
-            tangent_sq_xv, tangent_sq_yv = self.squared_coordinates_tangent[triangle_index]
+        for triangle_index in range(0, self.face_number):
+            erp_depth_tile, nn_values = self.face_erp_data(triangle_index, tangent_images[triangle_index])
             erp_tri_xv, erp_tri_yv = self.triangle_coordinates_erp[triangle_index]
-            erp_sq_xv, erp_sq_yv = self.squared_coordinates_erp[triangle_index]
+            nn_blending[erp_tri_yv.astype(int), erp_tri_xv.astype(int)] = nn_values
+            erp_depth_tiles.append(erp_depth_tile)
 
-            erp_face_image = ndimage.map_coordinates(tangent_images[triangle_index], [tangent_sq_yv, tangent_sq_xv],
-                                                     order=1, mode='constant', cval=0.)
+        return erp_depth_tiles, nn_blending
 
-            nn_blending[erp_tri_yv.astype(int), erp_tri_xv.astype(int)] = \
-                ndimage.map_coordinates(tangent_images[triangle_index], [tangent_tri_yv, tangent_tri_xv],
-                                        order=1, mode='constant', cval=0.)
+    def face_erp_data(self, face_index, tangent_image):
+        """Project a tangent face's image to its ERP tile and to its triangle's pixels.
 
-            erp_depth_tensor[erp_sq_yv.astype(int), erp_sq_xv.astype(int),
-                             triangle_index] = erp_face_image.astype(np.float64)
+        :param face_index: The face index.
+        :type face_index: int
+        :param tangent_image: The face's image.
+        :type tangent_image: numpy
+        :return: The ERP depth tile, which is NaN out of the face, and the values of the triangle_coordinates_erp
+            pixels of the nn blending.
+        :rtype: tuple
+        """
+        tangent_tri_xv, tangent_tri_yv = self.triangle_coordinates_tangent[face_index]
+        tangent_sq_xv, tangent_sq_yv = self.squared_coordinates_tangent[face_index]
+        tile_sq_yv, tile_sq_xv = self.squared_coordinates_tile[face_index]
 
-        return erp_depth_tensor, nn_blending
+        erp_depth_tile = self.face_tiles[face_index].new(np.nan, self.dtype)
+        erp_depth_tile[tile_sq_yv, tile_sq_xv] = ndimage.map_coordinates(
+            tangent_image, [tangent_sq_yv, tangent_sq_xv], order=1, mode='constant', cval=0.)
+        nn_values = ndimage.map_coordinates(tangent_image, [tangent_tri_yv, tangent_tri_xv],
+                                            order=1, mode='constant', cval=0.)
+        return erp_depth_tile, nn_values
 
     def get_radial_blendweights(self, img_params, size):
         # Weights for each tangent image. Angular distance wrt to the principal point
@@ -417,44 +875,192 @@ class BlendIt:
         data = np.concatenate(data)
         return scipy.sparse.coo_matrix((data, (row_indices, col_indices)))
 
-    def gradient_blending(self, equirect_tangent_imgs, equirect_weights, color_blended, eigen_solver=None):
-        n_images = equirect_tangent_imgs.shape[2]
-        equirect_tangent_imgs[np.isnan(equirect_tangent_imgs)] = 0
-        t0 = time.time()
+    def gradient_blending(self, erp_tangent_tiles, erp_weight_tiles, color_blended, eigen_solver=None):
+        """Solve the weighted gradient-fidelity system with the per-face tiles.
+
+        :param erp_tangent_tiles: The per-face depth tiles, the pixels out of the face are NaN.
+        :type erp_tangent_tiles: list
+        :param erp_weight_tiles: The per-face blend weight tiles.
+        :type erp_weight_tiles: list
+        :param color_blended: The fidelity term image, nn blended image.
+        :type color_blended: numpy
+        :return: The blended image.
+        :rtype: numpy
+        """
+        return self.gradient_blending_batch([erp_tangent_tiles], erp_weight_tiles, [color_blended])[0]
 
-        rows, cols = equirect_tangent_imgs[..., 0].shape
+    def gradient_blending_rhs(self, erp_tangent_tiles, erp_weight_tiles, color_blended):
+        """The right-hand side A^T b of the weighted gradient-fidelity system's normal equation.
 
-        # matrices = self.get_linear_system_matrices(rows, cols, equirect_weights)
+        The system is A = [w_1 x_ffd, w_1 y_ffd, ... , w_n x_ffd, w_n y_ffd, fidelity * I], A^T b is accumulated
+        face by face, so the stacked b is never allocated.
 
-        b = []
-        for i in range(0, n_images):
-            img = equirect_tangent_imgs[..., i]
-            weights = equirect_weights[..., i]
+        :return: The right-hand side, [rows * cols], float64.
+        :rtype: numpy
+        """
+        rows, cols = color_blended.shape
+
+        # Sum of the weighted forward differences, w_i^2 * ffd(img_i), in float64 for the solver
+        grad_x_sum = np.zeros((rows, cols), np.float64)
+        grad_y_sum = np.zeros((rows, cols), np.float64)
+        for tile, img, weights in zip(self.face_tiles, erp_tangent_tiles, erp_weight_tiles):
+            grad_x, grad_y = self.face_gradients(tile, img, weights)
+            tile.add_to(grad_x_sum, grad_x)
+            tile.add_to(grad_y_sum, grad_y)
+        return self.gradient_sums_rhs(grad_x_sum, grad_y_sum, color_blended)
+
+    def face_gradients(self, tile, img, weights):
+        """The weighted forward differences of a face, w_i^2 * ffd(img_i), in float64.
+
+        :param tile: The face's FaceTile.
+        :type tile: FaceTile
+        :param img: The face's depth tile, the pixels out of the face are NaN.
+        :type img: numpy
+        :param weights: The face's blend weight tile.
+        :type weights: numpy
+        :return: The horizontal and vertical weighted differences tiles.
+        :rtype: tuple
+        """
+        img = np.nan_to_num(img.astype(np.float64), copy=False)
+        weights = weights.astype(np.float64, copy=False)
+        if tile.wraps_full_width():
+            next_col = img[:, 0, None]
+        else:
+            next_col = np.zeros_like(img[:, 0, None])
+        grad_x = np.diff(img, axis=1, append=next_col) * weights * weights
+        grad_y = np.diff(img, axis=0, append=np.zeros_like(img[None, 0])) * weights * weights
+        return grad_x, grad_y
 
-            # grad_x = self.x_grad_mat.dot(img.ravel()).reshape((rows, cols)) * weights
-            # grad_y = self.y_grad_mat.dot(img.ravel()).reshape((rows, cols)) * weights
-            grad_x = np.diff(img, axis=1, append=img[:, 0, None]) * weights
-            grad_y = np.diff(img, axis=0, append=np.zeros_like(img[None, 0])) * weights
-            b.append(np.concatenate((grad_x.flatten(), grad_y.flatten())))
+    def gradient_sums_rhs(self, grad_x_sum, grad_y_sum, color_blended):
+        """The right-hand side A^T b from the ERP sums of the faces' weighted forward differences.
 
-        b.append(self.fidelity_weight * color_blended.ravel())
-        b = np.concatenate(b)
+        :return: The right-hand side, [rows * cols], float64.
+        :rtype: numpy
+        """
+        # Apply the transposed forward differences
+        b = np.roll(grad_x_sum, 1, axis=1) - grad_x_sum - grad_y_sum
+        b[1:] += grad_y_sum[:-1]
+        b += self.fidelity_weight * self.fidelity_weight * color_blended
+        return b.ravel()
+
+    def gradient_blending_batch(self, erp_tangent_tiles_list, erp_weight_tiles, color_blended_list,
+                                initial_guess_list=None):
+        """Solve the weighted gradient-fidelity systems of several images together.
+
+        The images share the system matrix A^T A, so their right-hand sides are stacked to the columns of one
+        matrix and solved with one Eigen factorization, the multigrid solver or the batched conjugate gradient.
+
+        :param erp_tangent_tiles_list: The per-face depth tiles of each image.
+        :type erp_tangent_tiles_list: list
+        :param erp_weight_tiles: The per-face blend weight tiles, shared by all images.
+        :type erp_weight_tiles: list
+        :param color_blended_list: The fidelity term image of each image, nn blended image.
+        :type color_blended_list: list
+        :param initial_guess_list: The initial guess of each image, only used by the multigrid solver.
+        :type initial_guess_list: list, optional
+        :return: The blended image of each image.
+        :rtype: list
+        """
+        rows, cols = color_blended_list[0].shape
+        # the columns are contiguous (Fortran order), so the Eigen solver reads and writes them without copies
+        b = np.empty((rows * cols, len(color_blended_list)), np.float64, order="F")
+        for index, (erp_tangent_tiles, color_blended) in enumerate(zip(erp_tangent_tiles_list, color_blended_list)):
+            b[:, index] = self.gradient_blending_rhs(erp_tangent_tiles, erp_weight_tiles, color_blended)
+        return self.gradient_blending_solve(b, color_blended_list, initial_guess_list)
+
+    def gradient_blending_solve(self, b, color_blended_list, initial_guess_list=None):
+        """Solve the weighted gradient-fidelity systems of the stacked right-hand sides.
+
+        :param b: The right-hand sides, [rows * cols, images], Fortran order.
+        :type b: numpy
+        :param color_blended_list: The fidelity term image of each image, nn blended image.
+        :type color_blended_list: list
+        :param initial_guess_list: The initial guess of each image, only used by the multigrid solver.
+        :type initial_guess_list: list, optional
+        :return: The blended image of each image.
+        :rtype: list
+        """
+        t0 = time.time()
 
-        if self.eigen_solver is not None:
-            x = self.eigen_solver.solve(self.A.transpose().dot(b))
+        rows, cols = color_blended_list[0].shape
+        if self.band_mask is not None:
+            # the single face pixels are the Dirichlet boundary of the band, move them to the right-hand side
+            x_copied = np.stack([np.asarray(color_blended, np.float64).ravel()[~self.band_mask]
+                                 for color_blended in color_blended_list], axis=1)
+            b = np.asfortranarray(b[self.band_mask] - self.band_coupling @ x_copied)
+
+        t_solve = time.time()
+        if self.multigrid_solver is not None:
+            x0 = None
+            if initial_guess_list is not None:
+                x0 = np.stack([np.nan_to_num(np.asarray(initial_guess, np.float64)).ravel()
+                               for initial_guess in initial_guess_list], axis=1)
+            x = self.multigrid_solver.solve(b, x0)
+            self.solver_stats = {"solver": "multigrid", "reason": "", "setup_time": self.setup_time,
+                                 "solve_time": time.time() - t_solve,
+                                 "iterations": self.multigrid_solver.cycle_number,
+                                 "residual": float(self.multigrid_solver.residual),
+                                 "nnz": self.multigrid_solver.nnz,
+                                 "memory": self.multigrid_solver.memory + 4 * b.size * b.itemsize}
+        elif self.eigen_solver is not None:
+            x = np.empty_like(b, order="F")
+            if b.shape[1] == 1:
+                self.eigen_solver.solve_into(b[:, 0], x[:, 0])
+            else:
+                self.eigen_solver.solve_batch_into(b, x)
+            self.solver_stats = dict(self.eigen_solver.stats)
+            self.solver_stats["setup_time"] += self.setup_time
         else:
-            x, _ = scipy.sparse.linalg.cg(self.A.transpose().dot(self.A), self.A.transpose().dot(b))
-            # x = scipy.sparse.linalg.spsolve(self.A.transpose().dot(self.A), self.A.transpose().dot(b))
+            A = self.AtA if self.band_mask is None else self.band_AtA
+            cg_stats = {}
+            x = batch_conjugate_gradient(A, b, stats=cg_stats)
+            # the matrix-free operator only stores the weights
+            matrix_nnz = A.nnz if scipy.sparse.issparse(A) else 0
+            self.solver_stats = {"solver": "cg", "reason": "", "setup_time": self.setup_time,
+                                 "solve_time": time.time() - t_solve,
+                                 "iterations": cg_stats["iterations"], "residual": cg_stats["residual"],
+                                 "nnz": matrix_nnz, "memory": matrix_nnz * (b.itemsize + 4) + 5 * b.size * b.itemsize}
+
+        # the solved fraction of the pixels
+        self.solver_stats["band"] = 1.0 if self.band_mask is None else float(np.mean(self.band_mask))
+        if self.band_mask is not None:
+            x_band = x
+            x = np.empty((rows * cols, b.shape[1]), np.float64)
+            x[self.band_mask] = x_band
+            x[~self.band_mask] = x_copied
 
         t1 = time.time()
         total = t1 - t0
-        print("Blending time = {:3f} (s)".format(total))
-        return x.reshape((rows, cols))
+        print("Blending time = {:3f} (s) for {} images".format(total, b.shape[1]))
+        log.debug("Poisson blending solver stats: {}".format(self.solver_stats))
+        return [x[:, index].reshape((rows, cols)).astype(self.dtype, copy=False) for index in range(b.shape[1])]
+
+    def compute_linear_system_matrices(self, rows, cols, erp_weight_tiles):
+        """Compute the normal matrix A^T A of the weighted gradient-fidelity system.
+
+        As the faces share the same finite differences matrices, A^T A is computed from the sum of the squared
+        weights, instead of stacking the per-face weighted blocks of A.
+
+        :param rows: The ERP image height.
+        :type rows: int
+        :param cols: The ERP image width.
+        :type cols: int
+        :param erp_weight_tiles: The per-face blend weight tiles.
+        :type erp_weight_tiles: list
+        """
+        if self.blending_method != "poisson" and self.blending_method != "all":
+            return
 
-    def compute_linear_system_matrices(self, rows, cols, equirect_weights):
+        weights_sq_sum = np.zeros((rows, cols), np.float64)
+        for tile, weights in zip(self.face_tiles[:self.n_subimages], erp_weight_tiles):
+            weights = weights.astype(np.float64, copy=False)
+            tile.add_to(weights_sq_sum, weights * weights)
 
-        if self.blending_method != "poisson" and self.blending_method != "all":
+        if self.poisson_solver == "cg" and self.poisson_band_tolerance is None:
+            # the conjugate gradient only applies the normal operator, the matrix is not assembled
+            self.set_linear_system(GradientFidelityOperator(weights_sq_sum, self.fidelity_weight), rows, cols)
             return
+
         # Horizontal forward finite differences
         x_grad_mat = scipy.sparse.coo_matrix((cols, cols))
         x_grad_mat.setdiag(-1)
@@ -469,20 +1075,227 @@ class BlendIt:
         y_grad_mat.setdiag(1, cols)
         y_grad_mat = y_grad_mat.tocsr()
 
-        # Mat A. [x_ffd_1, y_ffd_1, x_ffd_2, y_ffd_2, ... , x_ffd_n, y_ffd_n, fidelity]
-        blocks = []
-        for i in range(0, self.n_subimages):
-            weights = equirect_weights[..., i]
+        weights_sq_sum = scipy.sparse.diags(weights_sq_sum.ravel())
+
+        mat_AtA = x_grad_mat.transpose().dot(weights_sq_sum).dot(x_grad_mat) + \
+            y_grad_mat.transpose().dot(weights_sq_sum).dot(y_grad_mat) + \
+            self.fidelity_weight * self.fidelity_weight * scipy.sparse.eye(rows * cols)
+        self.set_linear_system(mat_AtA.tocsr(), rows, cols)
 
-            #   Weight the [x_grad, y_grad] blocks of the A matrix
-            blocks.append(x_grad_mat.multiply(weights.ravel()[:, None]))
-            blocks.append(y_grad_mat.multiply(weights.ravel()[:, None]))
+    def set_linear_system(self, AtA, rows, cols):
+        """Set the normal matrix and prepare the Poisson blending solver, the Eigen factorization or the multigrid
+        levels.
 
-        blocks.append(self.fidelity_weight * scipy.sparse.eye(blocks[0].shape[1]))
-        mat_A = self.concatenate_csr_matrices_by_row(blocks)
-        self.A = mat_A
+        :param AtA: The normal matrix, [rows * cols, rows * cols], or the matrix-free operator of the "cg" solver.
+        :type AtA: scipy.sparse.csr_matrix
+        """
+        t0 = time.time()
+        self.AtA = AtA
+        self.band_mask = None
+        self.band_AtA = None
+        self.band_coupling = None
+        if self.poisson_band_tolerance is not None and scipy.sparse.issparse(self.AtA) and \
+                self.poisson_solver != "multigrid":
+            margin = self.poisson_band_margin()
+            band_mask = self.poisson_band_mask(rows, cols, margin).ravel()
+            if band_mask.all():
+                # the band can not be smaller than the image within the tolerance, fall back to the full system
+                log.info("The Poisson band of {} pixels margin covers all pixels, solve the full system.".format(
+                    margin))
+            else:
+                band_rows = self.AtA[band_mask]
+                self.band_mask = band_mask
+                self.band_AtA = band_rows[:, band_mask].tocsr()
+                self.band_coupling = band_rows[:, ~band_mask].tocsr()
+                log.debug("The Poisson band of {} pixels margin has {} of {} pixels.".format(
+                    margin, np.count_nonzero(band_mask), rows * cols))
         if self.eigen_solver is not None:
-            self.eigen_solver.A = self.A.transpose().dot(self.A)
-        # self.x_grad_mat = x_grad_mat
-        # self.y_grad_mat = y_grad_mat
+            self.set_eigen_matrix(self.AtA if self.band_mask is None else self.band_AtA)
+        if self.poisson_solver == "multigrid" and self.AtA is not None:
+            self.multigrid_solver = MultigridSolver(self.AtA, (rows, cols))
+        # the setup time out of the Eigen factorization, which is in the Eigen solver's stats
+        self.setup_time = time.time() - t0
+        if self.eigen_solver is not None:
+            self.setup_time -= self.eigen_solver.stats["setup_time"]
+
+    def set_eigen_matrix(self, matrix):
+        """Hand the symmetric normal matrix to the Eigen solver.
+
+        The CSR buffers of the symmetric matrix are its CSC buffers, so the solver views them without copying
+        when the indices are int32. The matrix must not be changed while the solver uses it.
+
+        :param matrix: The symmetric matrix, [n, n].
+        :type matrix: scipy.sparse.csr_matrix
+        """
+        matrix = matrix.tocsr()
+        # Eigen needs the sorted indices without duplicates, canonicalize a copy to keep the caller's matrix
+        if not matrix.has_canonical_format:
+            matrix = matrix.copy()
+            matrix.sum_duplicates()
+        if matrix.indptr.dtype == np.int32 and matrix.indices.dtype == np.int32 and matrix.data.dtype == np.float64:
+            self.eigen_solver.set_csc_buffers(matrix.indptr, matrix.indices, matrix.data,
+                                              matrix.shape[0], matrix.shape[1])
+        else:
+            self.eigen_solver.A = matrix
 
+    def poisson_band_margin(self):
+        """The band margin in pixels which keeps the band restricted solve within poisson_band_tolerance of the full
+        solve, relative to the result's range.
+
+        The normal equations are the screened Poisson equation of the squared gradient weights w^2 and the squared
+        fidelity weight f^2, whose solution's change decays as exp(-distance * f / w) away from the overlaps and
+        seams. The margin is ln(1 / tolerance) decay lengths of the largest gradient weight, the largest squared
+        weight is the largest off-diagonal magnitude of the normal matrix.
+
+        :return: The margin in pixels.
+        :rtype: int
+        """
+        gradient_weight = np.sqrt(max(-self.AtA.min(), 0.0))
+        decay_length = gradient_weight / self.fidelity_weight
+        return int(np.ceil(decay_length * np.log(1.0 / self.poisson_band_tolerance)))
+
+    def poisson_band_mask(self, rows, cols, margin):
+        """The unknown pixels of the band restricted Poisson blending.
+
+        The pixels covered by exactly one face's square and one face's triangle are the nn blended pixels of that
+        face, where its gradient and fidelity terms are both satisfied. The Poisson blending only changes them
+        near the overlaps and the seams between two faces, the change decays with the distance, so the band is the
+        overlaps and seams dilated by the margin, with the longitude wrap around.
+
+        :param rows: The ERP image height.
+        :type rows: int
+        :param cols: The ERP image width.
+        :type cols: int
+        :param margin: The band margin in pixels, see poisson_band_margin.
+        :type margin: int
+        :return: The band pixels, [rows, cols].
+        :rtype: numpy
+        """
+        square_count = np.zeros((rows, cols), np.int32)
+        triangle_count = np.zeros((rows, cols), np.int32)
+        face_index = np.zeros((rows, cols), np.int32)  # the sum of the covering faces' indices
+        for index in range(self.n_subimages):
+            tile = self.face_tiles[index]
+            tile_yv, tile_xv = self.squared_coordinates_tile[index]
+            covered = tile.new(0, np.int32)
+            covered[tile_yv, tile_xv] = 1
+            tile.add_to(square_count, covered)
+            tile.add_to(face_index, covered * index)
+
+            erp_tri_xv, erp_tri_yv = self.triangle_coordinates_erp[index]
+            covered = np.zeros((rows, cols), np.bool_)
+            covered[erp_tri_yv.astype(int), erp_tri_xv.astype(int)] = True
+            triangle_count += covered
+
+        single_face = (square_count == 1) & (triangle_count == 1)
+        face_index[~single_face] = -1
+        # the seams between the faces without overlap, the forward differences cross two faces
+        seam = face_index != np.roll(face_index, -1, axis=1)
+        seam[:-1] |= face_index[:-1] != face_index[1:]
+        return ndimage.maximum_filter(~single_face | seam, size=2 * margin + 1, mode=("nearest", "wrap"))
+
+    def cache_key(self, erp_image_height, tangent_img_size, tangent_cam_params):
+        """The parameters the precomputed blending data depend on, the cache entry is used only if all of them match.
+
+        :param erp_image_height: The ERP image height.
+        :type erp_image_height: int
+        :param tangent_img_size: The tangent image size, [height, width].
+        :type tangent_img_size: tuple
+        :param tangent_cam_params: The subimages' camera parameters.
+        :type tangent_cam_params: list
+        :return: The cache key.
+        :rtype: dict
+        """
+        return {"version": BLEND_CACHE_VERSION,
+                "erp_image_height": int(erp_image_height),
+                "tangent_img_size": [int(size) for size in tangent_img_size],
+                "padding": float(self.padding),
+                "n_subimages": int(self.n_subimages),
+                "projection": self.projection_name,
+                "blending_method": self.blending_method,
+                "dtype": np.dtype(self.dtype).name,
+                "fidelity_weight": float(self.fidelity_weight),
+                "inflection_point": float(self.inflection_point),
+                "diagonal_percentage": float(self.diagonal_percentage),
+                "intrinsics": np.asarray(tangent_cam_params[0]["intrinsics"]["matrix"], np.float64).tolist()}
+
+    def cache_filepath(self, cache_dir, key):
+        key_sha256 = serialization.get_sha256(json.dumps(key, sort_keys=True))
+        return os.path.join(cache_dir, "blendit_{}.npz".format(key_sha256[:16]))
+
+    def save_cache(self, cache_dir, erp_image_height, tangent_img_size, tangent_cam_params):
+        """Save the faces' coordinates, the blend weights and the linear system matrix to the cache directory.
+
+        The Eigen solver's factorization is computed from the cached matrix when it is loaded.
+
+        :param cache_dir: The cache directory.
+        :type cache_dir: str
+        """
+        key = self.cache_key(erp_image_height, tangent_img_size, tangent_cam_params)
+        data = {"key": np.array(json.dumps(key, sort_keys=True)),
+                "face_tiles": np.array([[tile.row_start, tile.col_start, tile.height, tile.width]
+                                        for tile in self.face_tiles], np.int64)}
+        for name in ["triangle_coordinates_erp", "triangle_coordinates_tangent", "squared_coordinates_erp",
+                     "squared_coordinates_tangent", "squared_coordinates_tile"]:
+            for index, coordinates in enumerate(getattr(self, name)):
+                data["{}_{}".format(name, index)] = np.stack(coordinates)
+        for name in ["radial_blendweights", "frustum_blendweights"]:
+            for index, weights in enumerate(getattr(self, name)):
+                data["{}_{}".format(name, index)] = weights
+        if scipy.sparse.issparse(self.AtA):
+            data["AtA_data"] = self.AtA.data
+            data["AtA_indices"] = self.AtA.indices
+            data["AtA_indptr"] = self.AtA.indptr
+            data["AtA_shape"] = np.array(self.AtA.shape)
+
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_filepath = self.cache_filepath(cache_dir, key)
+        # write to a temporary file first, so the other processes never read a partial cache file
+        temp_filepath = "{}.{}.tmp".format(cache_filepath, os.getpid())
+        with open(temp_filepath, "wb") as cache_file:
+            np.savez(cache_file, **data)
+        os.replace(temp_filepath, cache_filepath)
+        log.info("Save the blending data to cache {}".format(cache_filepath))
+
+    def load_cache(self, cache_dir, erp_image_height, tangent_img_size, tangent_cam_params):
+        """Load the precomputed blending data from the cache directory.
+
+        :param cache_dir: The cache directory.
+        :type cache_dir: str
+        :return: True if the cache entry matches all parameters and is loaded, otherwise False.
+        :rtype: bool
+        """
+        key = self.cache_key(erp_image_height, tangent_img_size, tangent_cam_params)
+        cache_filepath = self.cache_filepath(cache_dir, key)
+        if not os.path.isfile(cache_filepath):
+            return False
+
+        try:
+            with np.load(cache_filepath, allow_pickle=False) as data:
+                if str(data["key"]) != json.dumps(key, sort_keys=True):
+                    log.warn("The blending cache {} is stale, recompute it.".format(cache_filepath))
+                    return False
+
+                erp_size = (erp_image_height, erp_image_height * 2)
+                self.face_tiles = [FaceTile(*[int(value) for value in tile], erp_size) for tile in data["face_tiles"]]
+                for name in ["triangle_coordinates_erp", "triangle_coordinates_tangent", "squared_coordinates_erp",
+                             "squared_coordinates_tangent", "squared_coordinates_tile"]:
+                    setattr(self, name, [list(data["{}_{}".format(name, index)]) for index in range(self.face_number)])
+                for name in ["radial_blendweights", "frustum_blendweights"]:
+                    setattr(self, name, [data["{}_{}".format(name, index)] for index in range(self.face_number)])
+                self.normalized_weights = {}
+                self.AtA = None
+                if "AtA_data" in data:
+                    self.AtA = scipy.sparse.csr_matrix((data["AtA_data"], data["AtA_indices"], data["AtA_indptr"]),
+                                                       shape=tuple(data["AtA_shape"]))
+        except (OSError, ValueError, KeyError) as error:
+            log.warn("Can not load the blending cache {}: {}".format(cache_filepath, error))
+            return False
+
+        if self.AtA is None or (self.poisson_solver == "cg" and self.poisson_band_tolerance is None):
+            # the matrix-free operator is computed from the cached weights without assembly
+            self.compute_linear_system_matrices(erp_image_height, erp_image_height * 2, self.frustum_blendweights)
+        else:
+            self.set_linear_system(self.AtA, erp_image_height, erp_image_height * 2)
+        log.info("Load the blending data from cache {}".format(cache_filepath))
+        return True
@@ -0,0 +1,385 @@
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+import model_registry
+from logger import Logger
+
+log = Logger(__name__)
+log.logger.propagate = False
+
+"""
+The batched BoostingMonocularDepth estimation of the tangent images.
+
+BoostingMonocularDepth estimates the whole depth map of an image with the double estimation, MiDaS at two resolutions
+merged by the pix2pix network, then estimates the local patches in the same way, merges each of them with the base
+estimate by the pix2pix network and blends them into the whole estimate. The patches' estimations and merges only
+depend on the image and the base estimate, so here each network runs on the batches of all images' inputs:
+1) the double estimations of the whole images;
+2) the double estimations of all images' patches;
+3) the merges of all images' patches;
+then the merged patches are blended into each image's estimate in order. The double estimations and the merges are
+cached by the content hash of their inputs, so the repeated faces and patches, e.g. of the video frames and the grid
+search, are not estimated again.
+"""
+
+# Settings from the official repo
+R_THRESHOLD = 0.2  # value x of R_x defined in the section 5 of the main paper
+SCALE_THRESHOLD = 3  # allows up-scaling with a scale up to 3
+WHOLE_SIZE_THRESHOLD = 3000  # R_max from the paper
+NET_RECEPTIVE_FIELD_SIZE = 384  # MiDaS, depthNet 0
+PATCH_NET_SIZE = 2 * NET_RECEPTIVE_FIELD_SIZE
+PIX2PIX_SIZE = 1024
+MAX_RES = 2000
+
+# The MiDaS input normalization of BoostingMonocularDepth
+MIDAS_MEAN = np.array([0.485, 0.456, 0.406], np.float32)
+MIDAS_STD = np.array([0.229, 0.224, 0.225], np.float32)
+
+# The networks' batch size when it is not set
+BATCH_SIZE = 4
+
+
+class PatchCache:
+    """The least recently used cache of the estimations, by the content hash of their inputs."""
+
+    def __init__(self, max_bytes=1024 * 1024 * 1024):
+        """
+        :param max_bytes: The largest total size of the cached estimations, the least recently used ones are evicted.
+        :type max_bytes: int
+        """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+
+    @staticmethod
+    def key(*items):
+        """The content hash of the arrays and the parameters."""
+        key_hash = hashlib.sha1()
+        for item in items:
+            if isinstance(item, np.ndarray):
+                item = np.ascontiguousarray(item)
+                key_hash.update("{}{}".format(item.shape, item.dtype).encode())
+                key_hash.update(item.data)
+            else:
+                key_hash.update(repr(item).encode())
+        return key_hash.hexdigest()
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        if key in self.entries:
+            return
+        self.entries[key] = value
+        self.total_bytes += value.nbytes
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.total_bytes -= evicted.nbytes
+
+    def clear(self):
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+
+
+# The estimations of the process
+patch_cache = PatchCache()
+
+
+def run_network(network, inputs, batch_size):
+    """Run the network on the stacked inputs in batches.
+
+    :param network: The network on the registry's device.
+    :type network: torch.nn.Module
+    :param inputs: The inputs, (number, channel, height, width).
+    :type inputs: numpy.ndarray
+    :return: The outputs.
+    :rtype: numpy.ndarray
+    """
+    device = model_registry.registry.device
+    outputs = []
+    with torch.no_grad():
+        for start in range(0, inputs.shape[0], batch_size):
+            input_batch = torch.from_numpy(inputs[start:start + batch_size]).to(device)
+            outputs.append(network(input_batch).cpu().numpy())
+    return np.concatenate(outputs)
+
+
+def normalize(data):
+    """Scale the data to [0, 1], the constant data is 0."""
+    data_min = data.min()
+    data_max = data.max()
+    if data_max - data_min > np.finfo("float").eps:
+        return (data - data_min) / (data_max - data_min)
+    return np.zeros_like(data)
+
+
+def midas_input_size(size, max_size):
+    """The multiple of 32 nearest to the size, or below it when the nearest is larger than max_size, as the
+    constrain_to_multiple_of of the MiDaS Resize."""
+    multiple = int(np.round(size / 32) * 32)
+    if multiple > max_size:
+        multiple = int(np.floor(size / 32) * 32)
+    return max(multiple, 32)
+
+
+def midas_input_shape(image_shape, msize):
+    """The MiDaS input height and width of an image, as the Resize of BoostingMonocularDepth's estimatemidas.
+
+    The image is scaled to fit in the msize square with its aspect ratio kept, and each side is rounded to a multiple
+    of 32 not larger than msize, see midas_input_size.
+
+    :param image_shape: The image's height and width.
+    :type image_shape: tuple
+    :param msize: The MiDaS input resolution.
+    :type msize: int
+    :return: The input height and width.
+    :rtype: tuple
+    """
+    height, width = image_shape[:2]
+    scale = min(msize / height, msize / width)
+    return midas_input_size(scale * height, msize), midas_input_size(scale * width, msize)
+
+
+def estimate_midas(boost_run, images, msize, batch_size):
+    """The MiDaS estimations of the images at the resolution, in [0, 1] and in the images' size.
+
+    Each image keeps its aspect ratio in the MiDaS input, see midas_input_shape, the images of the same input shape
+    are estimated in batches.
+
+    :param boost_run: The BoostingMonocularDepth run module of the registry.
+    :param images: The rgb images.
+    :type images: list
+    :param msize: The MiDaS input resolution.
+    :type msize: int
+    :return: The estimations.
+    :rtype: list
+    """
+    import cv2
+    shape_groups = {}
+    for index, image in enumerate(images):
+        shape_groups.setdefault(midas_input_shape(image.shape, msize), []).append(index)
+
+    estimations = [None] * len(images)
+    for (input_height, input_width), indices in shape_groups.items():
+        inputs = np.stack([((cv2.resize(images[index], (input_width, input_height), interpolation=cv2.INTER_CUBIC)
+                             - MIDAS_MEAN) / MIDAS_STD).transpose(2, 0, 1) for index in indices]).astype(np.float32)
+        predictions = run_network(boost_run.midasmodel, inputs, batch_size)
+        for index, prediction in zip(indices, predictions):
+            image = images[index]
+            estimations[index] = normalize(cv2.resize(prediction, (image.shape[1], image.shape[0]),
+                                                      interpolation=cv2.INTER_CUBIC))
+    return estimations
+
+
+def merge(boost_run, outer_estimations, inner_estimations, batch_size):
+    """The pix2pix merges of the estimations' pairs, in [0, 1].
+
+    :param outer_estimations: The estimations of the low frequency structure, PIX2PIX_SIZE square.
+    :type outer_estimations: list
+    :param inner_estimations: The estimations of the high frequency details, PIX2PIX_SIZE square.
+    :type inner_estimations: list
+    :return: The merged estimations, (number, PIX2PIX_SIZE, PIX2PIX_SIZE).
+    :rtype: numpy.ndarray
+    """
+    inputs = np.stack([np.stack([normalize(outer) * 2 - 1, normalize(inner) * 2 - 1])
+                       for outer, inner in zip(outer_estimations, inner_estimations)]).astype(np.float32)
+    merged = run_network(boost_run.pix2pixmodel.netG, inputs, batch_size)
+    return (merged[:, 0] + 1) / 2
+
+
+def double_estimate(boost_run, images, size1, size2, batch_size, cache):
+    """The double estimations of the images, the low and high resolution MiDaS estimations merged by pix2pix.
+
+    :param images: The rgb images.
+    :type images: list
+    :param size1: The low resolution.
+    :type size1: int
+    :param size2: The high resolution.
+    :type size2: int
+    :param cache: The cache of the estimations.
+    :type cache: PatchCache
+    :return: The estimations in [0, 1], PIX2PIX_SIZE square.
+    :rtype: list
+    """
+    import cv2
+    keys = [cache.key(image, "double", size1, size2) for image in images]
+    estimations = [cache.get(key) for key in keys]
+    missing = [index for index, estimation in enumerate(estimations) if estimation is None]
+    if not missing:
+        return estimations
+
+    missing_images = [images[index] for index in missing]
+    if max(size1, size2) > getattr(boost_run, "GPU_threshold", 1600 - 32):
+        # the large resolution is estimated by BoostingMonocularDepth's grid of patches
+        missing_estimations = [boost_run.doubleestimate(image, size1, size2, PIX2PIX_SIZE, 0)
+                               for image in missing_images]
+    else:
+        low_estimations = [cv2.resize(estimation, (PIX2PIX_SIZE, PIX2PIX_SIZE), interpolation=cv2.INTER_CUBIC)
+                           for estimation in estimate_midas(boost_run, missing_images, size1, batch_size)]
+        high_estimations = [cv2.resize(estimation, (PIX2PIX_SIZE, PIX2PIX_SIZE), interpolation=cv2.INTER_CUBIC)
+                            for estimation in estimate_midas(boost_run, missing_images, size2, batch_size)]
+        missing_estimations = [normalize(merged) for merged in
+                               merge(boost_run, low_estimations, high_estimations, batch_size)]
+
+    for index, estimation in zip(missing, missing_estimations):
+        estimations[index] = estimation
+        cache.put(keys[index], estimation)
+    return estimations
+
+
+def merge_patches(boost_run, patches, patch_estimations, batch_size, cache):
+    """Merge the patches' estimations with their base estimate by pix2pix.
+
+    :param patches: The ImageandPatchs patches.
+    :type patches: list
+    :param patch_estimations: The patches' double estimations.
+    :type patch_estimations: list
+    :return: The merged estimations, PIX2PIX_SIZE square.
+    :rtype: list
+    """
+    import cv2
+    keys = [cache.key(patch["patch_rgb"], patch["patch_whole_estimate_base"], "merge")
+            for patch in patches]
+    merged_estimations = [cache.get(key) for key in keys]
+    missing = [index for index, merged in enumerate(merged_estimations) if merged is None]
+    if not missing:
+        return merged_estimations
+
+    bases = [cv2.resize(patches[index]["patch_whole_estimate_base"], (PIX2PIX_SIZE, PIX2PIX_SIZE),
+                        interpolation=cv2.INTER_CUBIC) for index in missing]
+    merged = merge(boost_run, bases, [patch_estimations[index] for index in missing], batch_size)
+    for position, index in enumerate(missing):
+        # the merged estimation matches the values of the base estimate with a linear fit
+        mapped = merged[position].astype(np.float64)
+        base = bases[position].astype(np.float64)
+        mapped_mean = mapped.mean()
+        base_mean = base.mean()
+        mapped_var = np.mean((mapped - mapped_mean) ** 2)
+        slope = np.mean((mapped - mapped_mean) * (base - base_mean)) / mapped_var if mapped_var > 0 else 0.0
+        merged_estimations[index] = (slope * (mapped - mapped_mean) + base_mean).astype(np.float32)
+        cache.put(keys[index], merged_estimations[index])
+    return merged_estimations
+
+
+def boosting_monodepth(rgb_image_data_list, batch_size=None, cache=None):
+    """Estimate the images' depth maps with BoostingMonocularDepth, the networks run on the batches of all images.
+
+    :param rgb_image_data_list: The rgb images.
+    :type rgb_image_data_list: list
+    :param batch_size: The networks' batch size, defaults to BATCH_SIZE.
+    :type batch_size: int, optional
+    :param cache: The cache of the estimations, defaults to the process's patch_cache.
+    :type cache: PatchCache, optional
+    :return: The disparity maps in the images' size.
+    :rtype: list
+    """
+    import cv2
+    batch_size = BATCH_SIZE if batch_size is None else batch_size
+    cache = patch_cache if cache is None else cache
+    # the merge network and the MiDaS network are resident in the registry
+    boost_run = model_registry.registry.boost()
+    from BoostingMonocularDepth.utils import ImageandPatchs, generatemask, calculateprocessingres
+
+    images = [np.asarray(image) for image in rgb_image_data_list]
+
+    # 1) the whole images' double estimations, the images of the same optimal resolution in one batch
+    whole_sizes = []
+    patch_scales = []
+    for image in images:
+        # the resolution search described in section 5-double estimation of the main paper
+        whole_size, patch_scale = calculateprocessingres(image, NET_RECEPTIVE_FIELD_SIZE, R_THRESHOLD,
+                                                         SCALE_THRESHOLD, WHOLE_SIZE_THRESHOLD)
+        whole_sizes.append(whole_size)
+        patch_scales.append(patch_scale)
+    whole_estimates = [None] * len(images)
+    for whole_size in set(whole_sizes):
+        indices = [index for index, size in enumerate(whole_sizes) if size == whole_size]
+        estimations = double_estimate(boost_run, [images[index] for index in indices], NET_RECEPTIVE_FIELD_SIZE,
+                                      whole_size, batch_size, cache)
+        for index, estimation in zip(indices, estimations):
+            whole_estimates[index] = estimation
+
+    # 2) the patches of each image
+    depthmaps = [None] * len(images)
+    image_patches = {}
+    for index, image in enumerate(images):
+        input_resolution = image.shape
+        whole_size = whole_sizes[index]
+        if MAX_RES < whole_size:
+            log.debug("No local boosting of image {}, the max resolution is smaller than R20.".format(index))
+            depthmaps[index] = cv2.resize(whole_estimates[index], (input_resolution[1], input_resolution[0]),
+                                          interpolation=cv2.INTER_CUBIC)
+            continue
+
+        # the multiplier of section 6 of the main paper to select small high-density regions
+        boost_run.factor = max(min(1, 4 * patch_scales[index] * whole_size / WHOLE_SIZE_THRESHOLD), 0.2)
+        factor = boost_run.factor
+
+        # the default target resolution, saturated to the max resolution
+        if image.shape[0] > image.shape[1]:
+            a = 2 * whole_size
+            b = round(2 * whole_size * image.shape[1] / image.shape[0])
+        else:
+            a = round(2 * whole_size * image.shape[0] / image.shape[1])
+            b = 2 * whole_size
+        b = int(round(b / factor))
+        a = int(round(a / factor))
+        if max(a, b) > MAX_RES:
+            if image.shape[0] > image.shape[1]:
+                a = MAX_RES
+                b = round(MAX_RES * image.shape[1] / image.shape[0])
+            else:
+                a = round(MAX_RES * image.shape[0] / image.shape[1])
+                b = MAX_RES
+            b = int(b)
+            a = int(a)
+        image_resized = cv2.resize(image, (b, a), interpolation=cv2.INTER_CUBIC)
+
+        patchset = boost_run.generatepatchs(image_resized, NET_RECEPTIVE_FIELD_SIZE * 2)
+        # the patches are merged in the input resolution
+        mergein_scale = input_resolution[0] / image_resized.shape[0]
+        imageandpatchs = ImageandPatchs(None, None, patchset, image_resized, mergein_scale)
+        whole_estimate_resized = cv2.resize(whole_estimates[index],
+                                            (round(image_resized.shape[1] * mergein_scale),
+                                             round(image_resized.shape[0] * mergein_scale)),
+                                            interpolation=cv2.INTER_CUBIC)
+        imageandpatchs.set_base_estimate(whole_estimate_resized.copy())
+        imageandpatchs.set_updated_estimate(whole_estimate_resized.copy())
+        image_patches[index] = (imageandpatchs, [imageandpatchs[patch_index]
+                                                 for patch_index in range(len(imageandpatchs))])
+
+    # 3) all patches' double estimations and merges, they only depend on the image and the base estimate
+    all_patches = [patch for _, patches in image_patches.values() for patch in patches]
+    log.debug("Estimate {} patches of {} images.".format(len(all_patches), len(images)))
+    if all_patches:
+        patch_estimations = double_estimate(boost_run, [patch["patch_rgb"] for patch in all_patches],
+                                            NET_RECEPTIVE_FIELD_SIZE, PATCH_NET_SIZE, batch_size, cache)
+        merged_estimations = merge_patches(boost_run, all_patches, patch_estimations, batch_size, cache)
+
+    # 4) blend the merged patches into each image's estimate in order, with the Gaussian mask at the boundaries
+    mask_org = generatemask((3000, 3000))
+    masks = {}
+    patch_position = 0
+    for index, (imageandpatchs, patches) in image_patches.items():
+        estimate = imageandpatchs.estimation_updated_image
+        for patch in patches:
+            merged = merged_estimations[patch_position]
+            patch_position += 1
+            org_size = patch["patch_whole_estimate_base"].shape
+            merged = cv2.resize(merged, (org_size[1], org_size[0]), interpolation=cv2.INTER_CUBIC)
+            if org_size not in masks:
+                masks[org_size] = cv2.resize(mask_org, (org_size[1], org_size[0]), interpolation=cv2.INTER_LINEAR)
+            w1, h1, w2, h2 = patch["rect"][0], patch["rect"][1], patch["rect"][0] + patch["rect"][2], \
+                patch["rect"][1] + patch["rect"][3]
+            region = estimate[h1:h2, w1:w2]
+            region += masks[org_size] * (merged - region)
+        depthmaps[index] = cv2.resize(estimate, (images[index].shape[1], images[index].shape[0]),
+                                      interpolation=cv2.INTER_CUBIC)
+
+    return depthmaps
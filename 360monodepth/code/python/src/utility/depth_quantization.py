@@ -0,0 +1,133 @@
+import copy
+
+import torch
+
+from logger import Logger
+
+log = Logger(__name__)
+log.logger.propagate = False
+
+"""
+The int8 quantization of the perspective depth networks for the CPU inference:
+- "dynamic": the weights of the linear layers are int8 and their activations are quantized on the fly, it suits the
+  transformer models, e.g. DPT;
+- "static": the weights and activations of the convolution and linear layers are int8, the activation ranges are
+  calibrated on the sample faces. The first and last layers are kept in float, and more of them when the quantized
+  output is not accurate enough. The networks that can not be traced by torch.fx fall back to "dynamic", so do all
+  networks before PyTorch 1.13 without the QConfigMapping API.
+"""
+
+# The supported quantization methods, "none" runs the float model
+QUANTIZATIONS = ["none", "dynamic", "static"]
+
+# The static quantization keeps these numbers of the first and last layers in float, until the error is acceptable,
+# then quantizes only the layers without the functional operations
+STATIC_FLOAT_LAYERS = [1, 2, 4]
+
+# The layers quantized by the static quantization of the layers only
+STATIC_LAYER_TYPES = [torch.nn.Conv2d, torch.nn.Linear, torch.nn.ReLU, torch.nn.BatchNorm2d]
+
+if hasattr(torch, "ao"):
+    from torch.ao import quantization as torch_quantization
+    from torch.ao.quantization import quantize_fx
+else:
+    # PyTorch before 1.10
+    from torch import quantization as torch_quantization
+    from torch.quantization import quantize_fx
+
+
+def check_quantization(quantization):
+    if quantization not in QUANTIZATIONS:
+        log.error("The quantization {} is not supported.".format(quantization))
+
+
+def relative_error(output, reference):
+    """The mean absolute error of the output relative to the mean absolute reference."""
+    return float(torch.mean(torch.abs(output - reference)) / torch.clamp(torch.mean(torch.abs(reference)), min=1e-7))
+
+
+def quantized_layer_number(model):
+    """The number of the int8 modules of the network, 0 when the quantization leaves it in float."""
+    return sum(1 for module in model.modules() if ".quantized" in type(module).__module__)
+
+
+def quantize_dynamic(model):
+    """Quantize the linear layers' weights to int8, the activations are quantized dynamically."""
+    return torch_quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def quantize_static(model, calibration_batch, float_layers=1, layers_only=False):
+    """Quantize the weights and activations to int8 with torch.fx, calibrated on the calibration inputs.
+
+    :param model: The float network in evaluation mode on CPU.
+    :type model: torch.nn.Module
+    :param calibration_batch: The calibration inputs, (number, channel, height, width).
+    :type calibration_batch: torch.Tensor
+    :param float_layers: The number of the first and the last convolution and linear layers kept in float.
+    :type float_layers: int
+    :param layers_only: Quantize only the STATIC_LAYER_TYPES layers, the functional operations, e.g. the arithmetic
+        of the output head, are kept in float.
+    :type layers_only: bool
+    :return: The quantized network.
+    :rtype: torch.fx.GraphModule
+    """
+    qconfig_mapping = torch_quantization.get_default_qconfig_mapping(torch.backends.quantized.engine)
+    if layers_only:
+        qconfig = qconfig_mapping.global_qconfig
+        qconfig_mapping = torch_quantization.QConfigMapping()
+        for layer_type in STATIC_LAYER_TYPES:
+            qconfig_mapping.set_object_type(layer_type, qconfig)
+    layer_names = [name for name, module in model.named_modules()
+                   if isinstance(module, (torch.nn.Conv2d, torch.nn.Linear))]
+    for name in layer_names[:float_layers] + layer_names[-float_layers:]:
+        qconfig_mapping.set_module_name(name, None)
+
+    prepared_model = quantize_fx.prepare_fx(model, qconfig_mapping, example_inputs=(calibration_batch[:1],))
+    with torch.no_grad():
+        for index in range(calibration_batch.shape[0]):
+            prepared_model(calibration_batch[index:index + 1])
+    return quantize_fx.convert_fx(prepared_model)
+
+
+def quantize_model(model, calibration_batch, quantization="static", max_error=0.05):
+    """The int8 quantized copy of the depth network.
+
+    :param model: The float network in evaluation mode.
+    :type model: torch.nn.Module
+    :param calibration_batch: The sample faces' inputs of the calibration and the error check.
+    :type calibration_batch: torch.Tensor
+    :param quantization: The quantization method, see QUANTIZATIONS.
+    :type quantization: str
+    :param max_error: The largest acceptable relative error of the static quantized output on the calibration
+        inputs, see relative_error.
+    :type max_error: float
+    :return: The quantized network on CPU.
+    :rtype: torch.nn.Module
+    """
+    check_quantization(quantization)
+    float_model = copy.deepcopy(model).cpu().eval()
+    calibration_batch = calibration_batch.cpu()
+    if quantization == "none":
+        return float_model
+    if quantization == "dynamic":
+        return quantize_dynamic(float_model)
+
+    with torch.no_grad():
+        reference = float_model(calibration_batch)
+    for layers_only in [False, True]:
+        for float_layers in STATIC_FLOAT_LAYERS:
+            try:
+                quantized_model = quantize_static(copy.deepcopy(float_model), calibration_batch, float_layers,
+                                                  layers_only)
+            except Exception as error:
+                log.warn("The static quantization fails, use the dynamic quantization: {}".format(error))
+                return quantize_dynamic(float_model)
+            with torch.no_grad():
+                output_error = relative_error(quantized_model(calibration_batch), reference)
+            log.info("The static quantization {}with {} float layers at each end has relative error {:.4f}.".format(
+                "of the layers only " if layers_only else "", float_layers, output_error))
+            if output_error <= max_error:
+                return quantized_model
+
+    log.warn("The static quantization error is larger than {}, use the dynamic quantization.".format(max_error))
+    return quantize_dynamic(float_model)
@@ -3,6 +3,8 @@ from utility import subimage
 from utility import depthmap_utils
 from utility import serialization
 from utility import image_io
+from utility import projection
+from utility import depthmap_align_direct
 
 from skimage.transform import pyramid_gaussian
 import numpy as np
@@ -61,9 +63,16 @@ class DepthmapAlign:
         self.align_coeff_grid_height = 8          # the height of the initial grid
         self.align_coeff_grid_width_finest = 10   # the grid width of the finest grid
         self.align_coeff_grid_height_finest = 16  # the grid height of the finest grid.
+        # the initial coefficients, the ones set before align_multi_res, e.g. the previous frame's, are resized to
+        # the initial grid, empty to start from the identity
         self.align_coeff_initial_scale_list = []
         self.align_coeff_initial_offset_list = []
         self.depthmap_original_ico_index = []      # the subimage's depth map ico face index
+        self.projection = "icosahedron"            # the tangent faces projection, "icosahedron" or "cubemap"
+
+        # the alignment solver, "ceres" or "direct" which starts ceres from the direct solver's coefficients, see
+        # depthmap_align_direct
+        self.align_solver = "ceres"
 
         # ceres options
         self.ceres_thread_number = 12
@@ -86,6 +95,11 @@ class DepthmapAlign:
 
         # pixel correpsonding down-sample parameter
         self.downsample_pixelcorr_ratio = 0.4
+        # the pixels corresponding cache folder, None to cache them in memory only
+        self.pixelcorr_cache_dir = None
+
+        # the data type of depth maps and pixel corresponding, upcast to float64 when calling the cpp module
+        self.dtype = np.float64
 
         # initial the align process (depthmapAlign) run time
         depthmapAlign.init(self.align_method)
@@ -99,7 +113,21 @@ class DepthmapAlign:
     def align_coeff_init(self):
         """
         Create & initial subimages alignment coefficient.
+        The coefficients already set for all depth maps are resized to the grid, otherwise they are the identity.
         """
+        grid_size = (self.align_coeff_grid_width, self.align_coeff_grid_height)
+        if len(self.align_coeff_initial_scale_list) == len(self.depthmap_original_ico_index) and \
+                len(self.align_coeff_initial_offset_list) == len(self.depthmap_original_ico_index):
+            self.align_coeff_initial_scale_list = [
+                cv2.resize(np.asarray(scale, np.float64), dsize=grid_size, interpolation=cv2.INTER_LINEAR)
+                for scale in self.align_coeff_initial_scale_list]
+            self.align_coeff_initial_offset_list = [
+                cv2.resize(np.asarray(offset, np.float64), dsize=grid_size, interpolation=cv2.INTER_LINEAR)
+                for offset in self.align_coeff_initial_offset_list]
+            return
+
+        self.align_coeff_initial_scale_list = []
+        self.align_coeff_initial_offset_list = []
         for ico_face_index in self.depthmap_original_ico_index:
             align_coeff_initial_scale = np.full((self.align_coeff_grid_height, self.align_coeff_grid_width), 1.0, np.float64)
             align_coeff_initial_offset = np.full((self.align_coeff_grid_height, self.align_coeff_grid_width), 0.0, np.float64)
@@ -117,8 +145,8 @@ class DepthmapAlign:
         diff_sum = 0
         pixel_numb = 0
         # the cost of projection term
-        for src_idx in range(0,20):
-            for tar_idx in range(0,20):
+        for src_idx in range(0, len(depthmap_list)):
+            for tar_idx in range(0, len(depthmap_list)):
                 if src_idx == tar_idx:
                     continue
 
@@ -147,7 +175,7 @@ class DepthmapAlign:
         # the cost of smooth term
         # the cost of scale term
 
-    def align_single_res(self, depthmap_original_list, pixels_corresponding_list):
+    def align_single_res(self, depthmap_original_list, pixels_corresponding_list, solver=None):
         """
         Align the sub-images depth map in single layer.
 
@@ -155,9 +183,15 @@ class DepthmapAlign:
         :type depthmap_original_list: list
         :param pixels_corresponding_list: the pixels corresponding relationship.
         :type pixels_corresponding_list: 
+        :param solver: the alignment solver, "ceres" or "direct" to start ceres from the coefficients of
+            depthmap_align_direct, None to use self.align_solver.
+        :type solver: str, optional
         """
         if self.align_method not in ["group", "enum"]:
             log.error("The depth map alignment method {} specify error! ".format(self.align_method))
+        if solver is None:
+            solver = self.align_solver
+        depthmap_align_direct.check_solver(solver)
 
         # report the alignment information:
         if False:
@@ -177,6 +211,32 @@ class DepthmapAlign:
             # 1) get the cost
             self.report_cost(depthmap_original_list, pixels_corresponding_list)
 
+        # both solvers align the float64 depth maps
+        if self.dtype != np.float64:
+            depthmap_original_list = [depthmap.astype(np.float64) for depthmap in depthmap_original_list]
+
+        if solver == "direct":
+            # the linear least-squares counterpart of the group energy is solved in one sparse factorization, its
+            # coefficients in the gauge of the ceres scale term are the initial coefficients of ceres
+            if self.align_method != "group":
+                log.error("The direct solver only supports the group alignment method.")
+            _, align_coeff = depthmap_align_direct.align_direct(
+                depthmap_original_list,
+                pixels_corresponding_list,
+                self.depthmap_original_ico_index,
+                self.align_coeff_grid_width,
+                self.align_coeff_grid_height,
+                self.weight_project,
+                self.weight_smooth,
+                self.weight_scale,
+                self.coeff_fixed_face_index,
+                ceres_gauge=True)
+            self.align_coeff_initial_scale_list = align_coeff[0::2]
+            self.align_coeff_initial_offset_list = align_coeff[1::2]
+
+        # the cpp module views the packed float64 pixels corresponding without copy
+        pixels_corresponding_packed = subimage.pack_pixels_corr(pixels_corresponding_list)
+
         try:
             # set Ceres solver options
             ceres_setting_result = depthmapAlign.ceres_solver_option(self.ceres_thread_number,  self.ceres_max_num_iterations,
@@ -195,7 +255,7 @@ class DepthmapAlign:
                 depthmap_original_list,
                 self.depthmap_original_ico_index,
                 self.coeff_fixed_face_index,
-                pixels_corresponding_list,
+                pixels_corresponding_packed,
                 self.align_coeff_grid_height,
                 self.align_coeff_grid_width,
                 True,
@@ -210,6 +270,9 @@ class DepthmapAlign:
         except RuntimeError as error:
             log.error('Error: ' + repr(error))
 
+        if self.dtype != np.float64:
+            self.depthmap_aligned = [depthmap.astype(self.dtype) for depthmap in self.depthmap_aligned]
+
         # update the coeff
         for index in range(0, self.depthmap_number):
             assert self.align_coeff_initial_scale_list[index].shape == align_coeff[index * 2].shape
@@ -236,8 +299,9 @@ class DepthmapAlign:
         """
         self.depthmap_number = len(subimage_depthmap)
 
-        if depthmap_original_ico_index is None and len(subimage_depthmap) == 20:
-            self.depthmap_original_ico_index = list(range(0, 20))
+        face_number = projection.face_number(self.projection)
+        if depthmap_original_ico_index is None and len(subimage_depthmap) == face_number:
+            self.depthmap_original_ico_index = list(range(0, face_number))
         elif depthmap_original_ico_index is not None and len(depthmap_original_ico_index) == len(subimage_depthmap):
             self.depthmap_original_ico_index = depthmap_original_ico_index
         else:
@@ -247,7 +311,7 @@ class DepthmapAlign:
         log.debug("Normalization the depth map with {} norm method".format(self.depthmap_norm_mothod))
         subimage_depthmap_norm_list = []
         for depthmap in subimage_depthmap:
-            subimage_depthmap_norm = depthmap_utils.dispmap_normalize(depthmap, self.depthmap_norm_mothod)
+            subimage_depthmap_norm = depthmap_utils.dispmap_normalize(depthmap, self.depthmap_norm_mothod, dtype=self.dtype)
             subimage_depthmap_norm_list.append(subimage_depthmap_norm)
 
         # 0) generate the gaussion pyramid of each sub-image depth map
@@ -259,7 +323,8 @@ class DepthmapAlign:
                              self.align_coeff_grid_height*(2**level)] for
                             level in range(0, self.pyramid_layer_number)]
         else:
-            depthmap_pryamid = depthmap_utils.depthmap_pyramid(subimage_depthmap_norm_list, self.pyramid_layer_number, self.pyramid_downscale)
+            depthmap_pryamid = depthmap_utils.depthmap_pyramid(subimage_depthmap_norm_list, self.pyramid_layer_number,
+                                                               self.pyramid_downscale, self.dtype)
 
         # 1) multi-resolution to compute the alignment coefficient
         subimage_cam_param_list = None
@@ -297,7 +362,8 @@ class DepthmapAlign:
             # 1-0) get subimage the pixel corresponding relationship
             if pixel_corr_list is None or subimage_cam_param_list is None:
                 _, subimage_cam_param_list, pixel_corr_list = \
-                    subimage.erp_ico_proj(erp_rgb_image_data, padding_size, tangent_image_width, self.downsample_pixelcorr_ratio, self.opt)
+                    subimage.erp_ico_proj(erp_rgb_image_data, padding_size, tangent_image_width, self.downsample_pixelcorr_ratio,
+                                          self.opt, self.dtype, self.projection, self.pixelcorr_cache_dir)
 
             # save intermedia data for debug output pixel corresponding relationship and warped source image
             if self.debug:
@@ -317,8 +383,8 @@ class DepthmapAlign:
                 # output the all subimages depth map corresponding relationship to json
                 if self.subimage_pixelcorr_filepath_expression is not None:
                     log.debug("output the all subimages corresponding relationship to {}".format(self.subimage_pixelcorr_filepath_expression))
-                    for subimage_index_src in range(0, 20):
-                        for subimage_index_tar in range(0, 20):
+                    for subimage_index_src in range(0, face_number):
+                        for subimage_index_tar in range(0, face_number):
                             if subimage_index_src == subimage_index_tar:
                                 continue
 
@@ -0,0 +1,296 @@
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+
+from logger import Logger
+
+log = Logger(__name__)
+log.logger.propagate = False
+
+"""
+The direct sparse linear least-squares solver of the depth maps alignment.
+
+The unknowns are the scale and offset grids of all depth maps, [s_0, o_0, s_1, o_1, ...], each grid in row-major
+order. The terms have the bilinear weights, smoothness edges and term weights of the cpp group stitcher, but the
+energy is its linear least-squares counterpart, not the same objective:
+- re-projection term, weight_project / pixels corresponding number
+  * sum((d_tar * S_tar + O_tar) - (d_src * S_src + O_src))^2,
+  the cpp stitcher squares each difference again, its term is the 4th power of the differences;
+- smooth term, weight_smooth / (depth maps number * grid size) * sum over the grid edges (ds^2 + do^2),
+  the cpp stitcher squares the sum over the grid edges of each depth map;
+- scale term, weight_scale / (depth maps number * grid size) * sum((s - 1)^2 + o^2),
+  the cpp stitcher's term is weight_scale * (sum(1 / s))^2 of each depth map, a barrier which pushes the scales up.
+With the fixed reference depth map both solvers fix its scale to 1 and offset to 0. Without it the mean scale is
+constrained to 1 and the mean offset to 0 here, while the cpp stitcher's scales grow with the barrier, so the two
+solvers' coefficients differ by more than a common scale and offset, and so do the aligned depth maps. So the
+direct solution, scaled to the gauge of the cpp scale term, is the initial coefficients of the cpp stitcher, which
+converges to its own solution from there.
+The normal equations are assembled once and solved by one sparse factorization.
+"""
+
+# The supported depth maps alignment solvers
+ALIGN_SOLVERS = ["ceres", "direct"]
+
+
+def check_solver(solver):
+    if solver not in ALIGN_SOLVERS:
+        log.error("The depth map alignment solver {} is not supported.".format(solver))
+
+
+def grid_weights(coordinates, image_size, grid_size):
+    """The 1D bilinear weights of the pixels' coordinates on the coefficient grid, as DepthmapUtil::bilinear_weight.
+
+    :param coordinates: The pixels' coordinates along the axis.
+    :type coordinates: numpy
+    :param image_size: The image size along the axis.
+    :type image_size: int
+    :param grid_size: The grid size along the axis.
+    :type grid_size: int
+    :return: The lower and upper grid index, and their weights. The upper weight is 0 on the grid points.
+    :rtype: tuple
+    """
+    grid_interval = (image_size - 1.0) / (grid_size - 1.0)
+    grid_low = (coordinates / grid_interval).astype(np.int64)
+    grid_low_pixel = grid_low * grid_interval
+    # the pixels on the last grid point may be a rounding error away from it
+    on_grid = (grid_low_pixel == coordinates) | (grid_low >= grid_size - 1)
+    grid_low = np.minimum(grid_low, grid_size - 1)
+    grid_up = np.where(on_grid, grid_low, grid_low + 1)
+    grid_up_pixel = grid_up * grid_interval
+    with np.errstate(divide="ignore", invalid="ignore"):
+        weight_low = np.where(on_grid, 1.0, (grid_up_pixel - coordinates) / (grid_up_pixel - grid_low_pixel))
+        weight_up = np.where(on_grid, 0.0, (coordinates - grid_low_pixel) / (grid_up_pixel - grid_low_pixel))
+    return grid_low, grid_up, weight_low, weight_up
+
+
+def interpolation_matrix(image_size, grid_size):
+    """The dense linear interpolation of the grid to the pixels along one axis, [image_size, grid_size]."""
+    grid_low, grid_up, weight_low, weight_up = grid_weights(np.arange(image_size, dtype=np.float64),
+                                                            image_size, grid_size)
+    matrix = np.zeros((image_size, grid_size), np.float64)
+    pixel_index = np.arange(image_size)
+    np.add.at(matrix, (pixel_index, grid_low), weight_low)
+    np.add.at(matrix, (pixel_index, grid_up), weight_up)
+    return matrix
+
+
+def sample_depth(depthmap, y, x):
+    """Sample the depth map at the sub-pixel locations, as DepthmapStitcher::getColorSubpix.
+
+    The locations are single precision, the border is reflected and the bilinear value is rounded, so both solvers
+    fit the same observations.
+    """
+    height, width = depthmap.shape
+    x = x.astype(np.float32)
+    y = y.astype(np.float32)
+    x0 = x.astype(np.int64)
+    y0 = y.astype(np.int64)
+    a = x - x0.astype(np.float32)
+    c = y - y0.astype(np.float32)
+    # the BORDER_REFLECT_101 of the next pixel, the pixel itself is inside the image
+    x1 = np.where(x0 + 1 < width, x0 + 1, width - 2)
+    y1 = np.where(y0 + 1 < height, y0 + 1, height - 2)
+    a_inv = (1 - a).astype(np.float64)
+    c_inv = (1 - c).astype(np.float64)
+    a = a.astype(np.float64)
+    c = c.astype(np.float64)
+    return np.rint((depthmap[y0, x0] * a_inv + depthmap[y0, x1] * a) * c_inv +
+                   (depthmap[y1, x0] * a_inv + depthmap[y1, x1] * a) * c)
+
+
+def smooth_edges(grid_width, grid_height):
+    """The grid edges of the smooth term, the right, down and two diagonal neighbours of each grid point.
+
+    :return: The edges' current and neighbour grid index.
+    :rtype: tuple
+    """
+    index = np.arange(grid_width * grid_height).reshape(grid_height, grid_width)
+    inner = index[:-1, :-1].ravel()
+    current = [inner, inner, inner, inner + 1, index[:-1, -1], index[-1, :-1]]
+    neighbour = [inner + 1, inner + grid_width, inner + grid_width + 1, inner + grid_width,
+                 index[:-1, -1] + grid_width, index[-1, :-1] + 1]
+    return np.concatenate(current), np.concatenate(neighbour)
+
+
+def pair_jacobian(depthmap_src, depthmap_tar, pixels_corresponding, grid_width, grid_height):
+    """The re-projection residuals' linear coefficients of one depth map pair.
+
+    :return: The rows, the columns in [s_src, o_src, s_tar, o_tar] and the values of the non-zero coefficients.
+    :rtype: tuple
+    """
+    image_height, image_width = depthmap_src.shape
+    grid_size = grid_width * grid_height
+    corr_number = pixels_corresponding.shape[0]
+    rows = np.repeat(np.arange(corr_number), 4)
+    rows_list, cols_list, values_list = [], [], []
+    # the source coefficients are subtracted, the target coefficients are added
+    pixels_src = (depthmap_src, pixels_corresponding[:, 0], pixels_corresponding[:, 1], -1.0, 0)
+    pixels_tar = (depthmap_tar, pixels_corresponding[:, 2], pixels_corresponding[:, 3], 1.0, 2 * grid_size)
+    for depthmap, y, x, sign, col_start in [pixels_src, pixels_tar]:
+        depth_value = np.repeat(sample_depth(depthmap, y, x), 4)
+        col_low, col_up, col_weight_low, col_weight_up = grid_weights(x.astype(np.float64), image_width, grid_width)
+        row_low, row_up, row_weight_low, row_weight_up = grid_weights(y.astype(np.float64), image_height, grid_height)
+        # the 4 bilinear weights of each pixel, the zero weights of the pixels on the grid lines are dropped
+        grid_index = np.stack((row_low * grid_width + col_low, row_low * grid_width + col_up,
+                               row_up * grid_width + col_low, row_up * grid_width + col_up), axis=1).ravel()
+        weight = np.stack((row_weight_low * col_weight_low, row_weight_low * col_weight_up,
+                           row_weight_up * col_weight_low, row_weight_up * col_weight_up), axis=1).ravel()
+        valid = weight != 0
+        # the scale and the offset coefficients
+        rows_list += [rows[valid], rows[valid]]
+        cols_list += [col_start + grid_index[valid], col_start + grid_size + grid_index[valid]]
+        values_list += [sign * weight[valid] * depth_value[valid], sign * weight[valid]]
+    return np.concatenate(rows_list), np.concatenate(cols_list), np.concatenate(values_list)
+
+
+def ceres_scale_gauge(coeff, jacobian_project, edge_difference, depthmap_number, weight_project, weight_smooth,
+                      weight_scale):
+    """The common factor of all coefficients which minimizes the cpp group stitcher's energy along them.
+
+    The cpp re-projection and smooth terms are the 4th powers of the coefficients and its scale term is their -2nd
+    power, so along the common factor l the energy is a * l^4 + b * l^-2, minimized at l = (b / (2 * a))^(1/6).
+
+    :param coeff: The coefficients [s_0, o_0, s_1, o_1, ...].
+    :type coeff: numpy
+    :param jacobian_project: The re-projection residuals' linear coefficients, [corr_number, unknown_number].
+    :type jacobian_project: scipy.sparse.csr_matrix
+    :param edge_difference: The grid edges' difference, [edge_number, grid_size].
+    :type edge_difference: scipy.sparse.csr_matrix
+    :return: The common factor, 1 when the scales are not positive or the scale term is not used.
+    :rtype: float
+    """
+    grid_size = edge_difference.shape[1]
+    grids = coeff.reshape(2 * depthmap_number, grid_size)
+    scales = grids[0::2]
+    if weight_scale <= 0 or np.any(scales <= 0):
+        return 1.0
+    difference = np.asarray(edge_difference @ grids.T)
+    edge_energy = np.sum(difference * difference, axis=0)
+    energy_smooth = weight_smooth / (depthmap_number * grid_size) * np.sum((edge_energy[0::2] + edge_energy[1::2]) ** 2)
+    residual = jacobian_project @ coeff
+    energy_project = weight_project / residual.size * np.sum(residual ** 4)
+    energy_scale = weight_scale * np.sum(np.sum(1.0 / scales, axis=1) ** 2)
+    if energy_project + energy_smooth <= 0:
+        return 1.0
+    return float((energy_scale / (2 * (energy_project + energy_smooth))) ** (1.0 / 6.0))
+
+
+def align_direct(depthmap_list, pixels_corresponding_list, depthmap_index_list, grid_width, grid_height,
+                 weight_project, weight_smooth, weight_scale, fixed_depthmap_index=-1, ceres_gauge=False):
+    """Align the depth maps with the direct sparse linear least-squares solver.
+
+    It minimizes the linear least-squares counterpart of the cpp group stitcher's energy, without its 1 / s scale
+    barrier and with the single squared residuals, see the module description. The result is not the Ceres solution,
+    it is the initial coefficients of the Ceres refinement.
+
+    :param depthmap_list: The depth maps, each [height, width].
+    :type depthmap_list: list
+    :param pixels_corresponding_list: The pixels corresponding, [src][tar] is [corr_number, 4], the columns are
+        y_src, x_src, y_tar and x_tar.
+    :type pixels_corresponding_list: dict
+    :param depthmap_index_list: The depth maps' face index, the keys of the pixels corresponding.
+    :type depthmap_index_list: list
+    :param grid_width: The coefficient grid width.
+    :type grid_width: int
+    :param grid_height: The coefficient grid height.
+    :type grid_height: int
+    :param weight_project: The re-projection term weight.
+    :type weight_project: float
+    :param weight_smooth: The smooth term weight.
+    :type weight_smooth: float
+    :param weight_scale: The scale term weight.
+    :type weight_scale: float
+    :param fixed_depthmap_index: The face index of the reference depth map, its scale is 1 and offset is 0.
+        As the cpp stitcher, the reference is fixed when the index is larger than 0.
+    :type fixed_depthmap_index: int
+    :param ceres_gauge: Without the fixed reference, scale the coefficients by the common factor of the cpp
+        stitcher's scale barrier instead of the mean scale 1, see ceres_scale_gauge.
+    :type ceres_gauge: bool
+    :return: The aligned depth maps, and the scale and offset grids [scale_0, offset_0, scale_1, ...].
+    :rtype: tuple
+    """
+    depthmap_number = len(depthmap_list)
+    grid_size = grid_width * grid_height
+    unknown_number = 2 * grid_size * depthmap_number
+    index_map = {face_index: index for index, face_index in enumerate(depthmap_index_list)}
+    fix_reference = fixed_depthmap_index > 0 and fixed_depthmap_index in index_map
+
+    # 1) the re-projection term
+    rows_list, cols_list, values_list = [], [], []
+    row_number = 0
+    for src_key, pixels_corresponding_src in pixels_corresponding_list.items():
+        for tar_key, pixels_corresponding in pixels_corresponding_src.items():
+            if src_key == tar_key or pixels_corresponding.size == 0:
+                continue
+            src_index = index_map[src_key]
+            tar_index = index_map[tar_key]
+            rows, cols, values = pair_jacobian(depthmap_list[src_index], depthmap_list[tar_index],
+                                               pixels_corresponding, grid_width, grid_height)
+            # the pair's [s_src, o_src, s_tar, o_tar] columns in the unknowns
+            cols = np.where(cols < 2 * grid_size, cols + 2 * grid_size * src_index,
+                            cols - 2 * grid_size + 2 * grid_size * tar_index)
+            rows_list.append(rows + row_number)
+            cols_list.append(cols)
+            values_list.append(values)
+            row_number += pixels_corresponding.shape[0]
+    if row_number == 0:
+        log.error("There is not pixels corresponding between the depth maps.")
+    jacobian_project = scipy.sparse.csr_matrix(
+        (np.concatenate(values_list), (np.concatenate(rows_list), np.concatenate(cols_list))),
+        shape=(row_number, unknown_number))
+
+    # 2) the smooth term, the same edges of the scale and offset grids of each depth map
+    edge_current, edge_neighbour = smooth_edges(grid_width, grid_height)
+    edge_number = edge_current.size
+    difference = scipy.sparse.csr_matrix(
+        (np.concatenate((np.ones(edge_number), -np.ones(edge_number))),
+         (np.tile(np.arange(edge_number), 2), np.concatenate((edge_current, edge_neighbour)))),
+        shape=(edge_number, grid_size))
+    jacobian_smooth = scipy.sparse.block_diag([difference] * (2 * depthmap_number), format="csr")
+
+    # 3) the normal equations, the term weights are normalized by the pixels corresponding and grid numbers
+    grid_weight_smooth = weight_smooth / (depthmap_number * grid_size)
+    grid_weight_scale = weight_scale / (depthmap_number * grid_size)
+    normal_matrix = weight_project / row_number * (jacobian_project.T @ jacobian_project) + \
+        grid_weight_smooth * (jacobian_smooth.T @ jacobian_smooth) + \
+        grid_weight_scale * scipy.sparse.identity(unknown_number, format="csr")
+    normal_rhs = np.zeros(unknown_number, np.float64)
+    scale_mask = (np.arange(unknown_number) // grid_size) % 2 == 0
+    normal_rhs[scale_mask] = grid_weight_scale
+
+    normal_matrix = normal_matrix.tocsc()
+    if fix_reference:
+        # eliminate the reference depth map's coefficients
+        coeff = np.zeros(unknown_number, np.float64)
+        coeff[scale_mask] = 1.0
+        free_mask = np.ones(unknown_number, bool)
+        reference_index = index_map[fixed_depthmap_index]
+        free_mask[2 * grid_size * reference_index: 2 * grid_size * (reference_index + 1)] = False
+        normal_rhs = normal_rhs[free_mask] - normal_matrix[free_mask][:, ~free_mask] @ coeff[~free_mask]
+        coeff[free_mask] = scipy.sparse.linalg.spsolve(normal_matrix[free_mask][:, free_mask], normal_rhs)
+    else:
+        # the re-projection and smooth terms are invariant to a common scale and offset, constrain the mean scale to 1 and mean offset to 0
+        constraint = scipy.sparse.csr_matrix(np.stack((scale_mask, ~scale_mask)) / (depthmap_number * grid_size))
+        kkt_matrix = scipy.sparse.bmat([[normal_matrix, constraint.T], [constraint, None]], format="csc")
+        kkt_rhs = np.concatenate((normal_rhs, [1.0, 0.0]))
+        coeff = scipy.sparse.linalg.spsolve(kkt_matrix, kkt_rhs)[:unknown_number]
+    if not np.all(np.isfinite(coeff)):
+        log.error("The direct alignment solver normal equations are singular.")
+    if ceres_gauge and not fix_reference:
+        coeff *= ceres_scale_gauge(coeff, jacobian_project, difference, depthmap_number, weight_project,
+                                   weight_smooth, weight_scale)
+
+    # 4) deform the depth maps with the bilinear interpolated coefficients
+    image_height, image_width = depthmap_list[0].shape
+    interpolation_rows = interpolation_matrix(image_height, grid_height)
+    interpolation_cols = interpolation_matrix(image_width, grid_width)
+    depthmap_aligned_list = []
+    align_coeff_list = []
+    for index in range(depthmap_number):
+        scale = coeff[2 * grid_size * index: 2 * grid_size * index + grid_size].reshape(grid_height, grid_width)
+        offset = coeff[2 * grid_size * index + grid_size: 2 * grid_size * (index + 1)].reshape(grid_height, grid_width)
+        scale_pixels = interpolation_rows @ scale @ interpolation_cols.T
+        offset_pixels = interpolation_rows @ offset @ interpolation_cols.T
+        depthmap_aligned_list.append(scale_pixels * depthmap_list[index] + offset_pixels)
+        align_coeff_list += [scale, offset]
+    return depthmap_aligned_list, align_coeff_list
@@ -10,29 +10,45 @@ from torchvision import transforms
 from torchvision.utils import make_grid
 
 from struct import unpack
+import copy
 import os
 import sys
+import time
 import re
-import gc
+import threading
 
 import fs_utility
+import boosting
+import model_registry
+import depth_quantization
+from face_tensor import FaceTensor
 from logger import Logger
 
 log = Logger(__name__)
 log.logger.propagate = False
 
+# the progressive preview and the background refinement share the depth networks and the device, run one at a time
+persp_monodepth_lock = threading.Lock()
 
-def fill_ico_subimage(depth_data_list_, subimage_idx_list):
+# the forward pass memory estimate of the exported graphs in bytes per input element, the modules' outputs of the
+# ResNeXt-101 encoder of MiDaS v2.1 are 2.4 KB per input element, with a margin for the decoder
+FORWARD_MEMORY_PER_INPUT_ELEMENT = 4096
+
+
+def fill_ico_subimage(depth_data_list_, subimage_idx_list, face_number=20):
     """ replace missed subimage with zero matrix.
+
+    :param face_number: the faces number of the projection, 20 of the icosahedron or 6 of the cubemap.
+    :type face_number: int
     """
-    depth_data_list = [np.zeros_like(depth_data_list_[0])] * 20
+    depth_data_list = [np.zeros_like(depth_data_list_[0])] * face_number
     for subimage_index in range(len(subimage_idx_list)):
         subimage_face_idx = subimage_idx_list[subimage_index]
         depth_data_list[subimage_face_idx] = depth_data_list_[subimage_index]
     return depth_data_list
 
 
-def depth_ico_visual_save(depth_data_list_, output_path, subimage_idx_list=None):
+def depth_ico_visual_save(depth_data_list_, output_path, subimage_idx_list=None, face_number=20):
     """save the visualized depth map array to image file with value-bar.
 
     :param dapthe_data: The depth data.
@@ -41,6 +57,8 @@ def depth_ico_visual_save(depth_data_list_, output_path, subimage_idx_list=None)
     :type output_path: str
     :param subimage_idx_list: available subimages index list.
     :type subimage_idx_list: list
+    :param face_number: the faces number of the projection, 20 of the icosahedron in 4x5 or 6 of the cubemap in 2x3.
+    :type face_number: int
     """
     # get vmin and vmax
     # for dispmap in depth_data_list:
@@ -58,7 +76,7 @@ def depth_ico_visual_save(depth_data_list_, output_path, subimage_idx_list=None)
 
     # add blank image to miss subimage to fill the sub-image array
     depth_data_list = None
-    if len(depth_data_list_) != 20 \
+    if len(depth_data_list_) != face_number \
             and subimage_idx_list is not None \
             and len(depth_data_list_) == len(subimage_idx_list):
         log.debug("The ico's sub-image size is {}, fill blank sub-images.".format(len(depth_data_list_)))
@@ -66,24 +84,25 @@ def depth_ico_visual_save(depth_data_list_, output_path, subimage_idx_list=None)
         # for subimage_index in range(len(subimage_idx_list)):
         #     subimage_face_idx = subimage_idx_list[subimage_index]
         #     depth_data_list[subimage_face_idx] = depth_data_list_[subimage_index]
-        depth_data_list = fill_ico_subimage(depth_data_list_, subimage_idx_list)
-    elif len(depth_data_list_) == 20:
+        depth_data_list = fill_ico_subimage(depth_data_list_, subimage_idx_list, face_number)
+    elif len(depth_data_list_) == face_number:
         depth_data_list = depth_data_list_
     else:
         raise log.error("The sub-image is not completed.")
 
     # draw image
-    figure, axes = plt.subplots(4, 5)
+    row_number, col_number = (4, 5) if face_number == 20 else (2, (face_number + 1) // 2)
+    figure, axes = plt.subplots(row_number, col_number)
     counter = 0
-    for row_index in range(0, 4):
-        for col_index in range(0, 5):
+    for row_index in range(0, row_number):
+        for col_index in range(0, col_number):
             axes[row_index, col_index].get_xaxis().set_visible(False)
             axes[row_index, col_index].get_yaxis().set_visible(False)
             # add sub caption
             axes[row_index, col_index].set_title(str(counter))
             counter = counter + 1
             #
-            dispmap_index = row_index * 5 + col_index
+            dispmap_index = row_index * col_number + col_index
             im = axes[row_index, col_index].imshow(depth_data_list[dispmap_index],
                                                    cmap=cm.jet, vmin=vmin_, vmax=vmax_)
 
@@ -169,81 +188,282 @@ def rgb2dispmap(image_filepath, pytorch_hub=True):
     return depthmap_data
 
 
-def run_persp_monodepth(rgb_image_data_list, persp_monodepth, use_large_model=True):
-    if (persp_monodepth == "midas2") or (persp_monodepth == "midas3"):
-        return MiDaS_torch_hub_data(rgb_image_data_list, persp_monodepth, use_large_model=use_large_model)
-    if persp_monodepth == "boost":
-        return boosting_monodepth(rgb_image_data_list)
-    if persp_monodepth == "zoedepth":
-        return zoedepth_monodepth(rgb_image_data_list)
+def run_persp_monodepth(rgb_image_data_list, persp_monodepth, use_large_model=True, batch_size=None,
+                        memory_limit=None):
+    """Estimate the disparity maps of the tangent images.
+
+    :param rgb_image_data_list: The tangent rgb images, a list or FaceTensor.
+    :type rgb_image_data_list: FaceTensor
+    :param batch_size: The MiDaS faces number of each forward pass, None runs all faces together, and the boost
+        networks' batch size of the patches, None for boosting.BATCH_SIZE.
+    :type batch_size: int, optional
+    :param memory_limit: The MiDaS peak memory limit of each forward pass in MB, reduces the batch size.
+    :type memory_limit: float, optional
+    :return: The disparity maps, with the same faces' index and metadata as the rgb images.
+    :rtype: FaceTensor
+    """
+    disparity_map_list = None
+    with persp_monodepth_lock:
+        if (persp_monodepth == "midas2") or (persp_monodepth == "midas3"):
+            disparity_map_list = MiDaS_torch_hub_data(rgb_image_data_list, persp_monodepth,
+                                                      use_large_model=use_large_model, batch_size=batch_size,
+                                                      memory_limit=memory_limit)
+        elif persp_monodepth == "boost":
+            disparity_map_list = boosting_monodepth(rgb_image_data_list, batch_size=batch_size)
+        elif persp_monodepth == "zoedepth":
+            disparity_map_list = zoedepth_monodepth(rgb_image_data_list)
+        elif persp_monodepth == "stub":
+            disparity_map_list = stub_monodepth(rgb_image_data_list, batch_size=batch_size, memory_limit=memory_limit)
+        else:
+            log.error("The perspective monodepth method {} do not support.".format(persp_monodepth))
+
+    if isinstance(rgb_image_data_list, FaceTensor):
+        return rgb_image_data_list.like(np.stack(disparity_map_list))
+    return FaceTensor.from_list(disparity_map_list)
+
+
+def forward_memory(model, inputs, device):
+    """Run the model and measure the memory of the forward pass.
 
+    The memory is the peak allocated memory of the Torch models on CUDA. On CPU it is the total size of the modules'
+    outputs, an upper bound of the activations alive together. The other exported graphs can not be measured, their
+    memory is the conservative estimate of FORWARD_MEMORY_PER_INPUT_ELEMENT.
+
+    :return: The model's output and the memory in bytes.
+    :rtype: tuple
+    """
+    if device.type == "cuda" and isinstance(model, torch.nn.Module):
+        torch.cuda.reset_peak_memory_stats(device)
+        memory_start = torch.cuda.memory_allocated(device)
+        output = model(inputs)
+        return output, torch.cuda.max_memory_allocated(device) - memory_start
+    if not isinstance(model, torch.nn.Module) or isinstance(model, torch.jit.ScriptModule):
+        memory = inputs.numel() * FORWARD_MEMORY_PER_INPUT_ELEMENT
+        log.warn("The forward pass memory of the exported graph can not be measured, estimate {:.1f} MB.".format(
+            memory / 1024 / 1024))
+        return model(inputs), memory
+
+    output_bytes = [0]
+
+    def output_hook(module, module_input, module_output):
+        if isinstance(module_output, torch.Tensor):
+            output_bytes[0] += module_output.numel() * module_output.element_size()
+
+    hooks = [module.register_forward_hook(output_hook) for module in model.modules()
+             if len(list(module.children())) == 0]
+    try:
+        output = model(inputs)
+    finally:
+        for hook in hooks:
+            hook.remove()
+    return output, output_bytes[0] + inputs.numel() * inputs.element_size()
+
+
+def run_model_batches(model, input_batch, output_size, device, batch_size=None, memory_limit=None):
+    """Run the model on the stacked inputs in batches and resize the predictions in bulk.
+
+    With the memory limit the first input runs alone to measure the memory of one input, and the following batches
+    are cut to fit the limit, see forward_memory. A batch running out of CUDA memory is retried with the half size.
+
+    :param model: The network, output the (batch, height, width) predictions.
+    :type model: torch.nn.Module
+    :param input_batch: The preprocessed inputs, (number, channel, height, width).
+    :type input_batch: torch.Tensor
+    :param output_size: The predictions are resized to (height, width).
+    :type output_size: tuple
+    :param batch_size: The inputs number of each forward pass, None runs all inputs together.
+    :type batch_size: int, optional
+    :param memory_limit: The memory limit of each forward pass in MB.
+    :type memory_limit: float, optional
+    :return: The resized predictions, (number, height, width).
+    :rtype: numpy.ndarray
+    """
+    input_number = input_batch.shape[0]
+    batch_size = input_number if batch_size is None else max(1, min(batch_size, input_number))
+    current_batch_size = 1 if memory_limit is not None else batch_size
+    outputs = np.empty((input_number,) + tuple(output_size), np.float32)
 
-def MiDaS_torch_hub_data(rgb_image_data_list, persp_monodepth, use_large_model=True):
-    """Estimation the single RGB image's depth with MiDaS downloading from Torch Hub.
+    start = 0
+    with torch.no_grad():
+        while start < input_number:
+            stop = min(start + current_batch_size, input_number)
+            try:
+                if memory_limit is not None and start == 0:
+                    prediction, input_memory = forward_memory(model, input_batch[start:stop].to(device), device)
+                else:
+                    prediction = model(input_batch[start:stop].to(device))
+                prediction = torch.nn.functional.interpolate(
+                    prediction.unsqueeze(1),
+                    size=output_size,
+                    mode="bicubic",
+                    align_corners=False,
+                )
+            except RuntimeError as error:
+                # torch.cuda.OutOfMemoryError is a RuntimeError, and it is not available before PyTorch 1.13
+                if "out of memory" not in str(error) or stop - start == 1:
+                    raise
+                prediction = None
+                torch.cuda.empty_cache()
+                current_batch_size = batch_size = (stop - start) // 2
+                log.warn("Out of CUDA memory, reduce the batch size to {}.".format(batch_size))
+                continue
+            outputs[start:stop] = prediction[:, 0].cpu().numpy()
+            del prediction
+
+            if memory_limit is not None and start == 0:
+                current_batch_size = batch_size
+                if input_memory > 0:
+                    current_batch_size = int(min(batch_size, max(1, memory_limit * 1024 * 1024 // input_memory)))
+                log.debug("The forward pass of one input uses {:.1f} MB memory, the batch size is {}.".format(
+                    input_memory / 1024 / 1024, current_batch_size))
+            start = stop
+            log.debug("Estimate {} of {} inputs.".format(stop, input_number))
+    return outputs
+
+
+def MiDaS_torch_hub_data(rgb_image_data_list, persp_monodepth, use_large_model=True, batch_size=None,
+                         memory_limit=None):
+    """Estimation the RGB images' depth with MiDaS loaded from the local Torch Hub weights directory.
     reference: https://pytorch.org/hub/intelisl_midas_v2/
 
-    :param rgb_image_path: the RGB image file path.
-    :type rgb_image_path: str
+    The images are preprocessed and stacked together, and the network runs on them in batches, see
+    run_depth_network.
+
+    :param rgb_image_data_list: the RGB images.
+    :type rgb_image_data_list: list
     :param use_large_model: the MiDaS model type.
     :type use_large_model: bool, optional
+    :param batch_size: the images number of each forward pass, None runs all images together.
+    :type batch_size: int, optional
+    :param memory_limit: the peak memory limit of each forward pass in MB.
+    :type memory_limit: float, optional
     """
 
-    # 1)initial PyTorch run-time environment
-    if use_large_model:
-        if persp_monodepth == "midas2":
-            midas = torch.hub.load("intel-isl/MiDaS", "MiDaS")
-        if persp_monodepth == "midas3":
-            midas = torch.hub.load("intel-isl/MiDaS", "DPT_Large")
-    else:
-        if persp_monodepth == "midas2":
-            midas = torch.hub.load("intel-isl/MiDaS", "MiDaS_small")
-        if persp_monodepth == "midas3":
-            midas = torch.hub.load("intel-isl/MiDaS", "DPT_Hybrid")
-
-    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
-    midas.to(device)
-    midas.eval()
-
-    midas_transforms = torch.hub.load("intel-isl/MiDaS", "transforms")
-    if use_large_model:
-        transform = midas_transforms.default_transform
-    else:
-        transform = midas_transforms.small_transform
+    midas, transform = model_registry.registry.midas(persp_monodepth, use_large_model)
+    model_name = model_registry.MIDAS_MODELS[(persp_monodepth, use_large_model)]
+    return run_depth_network(rgb_image_data_list, model_name, midas, transform, batch_size, memory_limit)
+
+
+def stub_monodepth(rgb_image_data_list, batch_size=None, memory_limit=None):
+    """Estimation the RGB images' depth with the stub network, see model_registry.StubDepthNet."""
+    stub, transform = model_registry.registry.stub()
+    return run_depth_network(rgb_image_data_list, "stub", stub, transform, batch_size, memory_limit)
 
-    disparity_map_list = []
 
+def run_depth_network(rgb_image_data_list, model_name, model, transform, batch_size=None, memory_limit=None):
+    """Estimate the disparity maps of the RGB images with the network of the registry's inference backend.
+
+    The images of the same size are preprocessed to the same input size, stacked together and estimated in batches,
+    see run_model_batches.
+
+    :param rgb_image_data_list: the RGB images.
+    :type rgb_image_data_list: list
+    :param model_name: the model name of the exported graph.
+    :type model_name: str
+    :param model: the network, output the (batch, height, width) disparity maps.
+    :type model: torch.nn.Module
+    :param transform: the preprocessing of a RGB image to the (1, channel, height, width) input.
+    :type transform: function
+    :return: the disparity maps.
+    :rtype: list
+    """
+    device = model_registry.registry.device
+    disparity_map_list = [None] * len(rgb_image_data_list)
+    image_groups = {}
     for index in range(0, len(rgb_image_data_list)):
-        img = rgb_image_data_list[index]
-        input_batch = transform(img).to(device)
-        with torch.no_grad():
-            prediction = midas(input_batch)
-
-            prediction = torch.nn.functional.interpolate(
-                prediction.unsqueeze(1),
-                size=img.shape[:2],
-                mode="bicubic",
-                align_corners=False,
-            ).squeeze()
-
-        output = prediction.cpu().numpy()
-        disparity_map_list.append(output)
-        del output
+        image_groups.setdefault(rgb_image_data_list[index].shape[:2], []).append(index)
+    for image_size, image_indices in image_groups.items():
+        input_batch = torch.cat([transform(rgb_image_data_list[index]) for index in image_indices])
+        inference_model = model_registry.registry.inference_model(model_name, model, input_batch)
+        disparity_maps = run_model_batches(inference_model, input_batch, image_size, device, batch_size,
+                                           memory_limit)
+        for index, disparity_map in zip(image_indices, disparity_maps):
+            disparity_map_list[index] = disparity_map
         del input_batch
-        del prediction
-        torch.cuda.empty_cache()
-
-        if index % 10 ==0:
-            log.debug("MiDaS estimate {} rgb image's disparity map.".format(index))
+        log.debug("{} estimate {} rgb images' disparity maps.".format(model_name, len(image_indices)))
 
-    del midas
-    gc.collect()
     torch.cuda.empty_cache()
     return disparity_map_list
 
 
+def quantization_report(rgb_image_data_list, persp_monodepth, use_large_model=True, quantizations=None,
+                        batch_size=None, memory_limit=None):
+    """Compare the speed and the disparity maps of the int8 quantized inference with the float inference.
+
+    The float and quantized models run on CPU through the registry's inference backend, each is made and warmed up
+    before the timing. The disparity maps of each quantization are compared with the float model's by
+    metrics.report_precision_error, the reported metrics are the mean of the faces. The quantizations without int8
+    layers, e.g. the dynamic quantization of the convolution networks, are skipped. The registry's quantization is
+    restored at the end.
+
+    :param rgb_image_data_list: the tangent RGB images of the same size.
+    :type rgb_image_data_list: list
+    :param persp_monodepth: the MiDaS or stub model.
+    :type persp_monodepth: str
+    :param quantizations: the compared quantization methods, defaults to all methods.
+    :type quantizations: list, optional
+    :return: each inference's time in seconds, the quantizations' int8 layers number, speedup and error metrics.
+    :rtype: dict
+    """
+    import metrics
+    registry = model_registry.registry
+    if quantizations is None:
+        quantizations = [method for method in depth_quantization.QUANTIZATIONS if method != "none"]
+    quantization, calibration_number = registry.quantization, registry.calibration_number
+    # the quantized models run on CPU, and so does the float model of the comparison
+    registry.set_quantization(quantizations[0], calibration_number)
+    device = torch.device("cpu")
+
+    if persp_monodepth in ["midas2", "midas3"]:
+        model, transform = registry.midas(persp_monodepth, use_large_model)
+        model_name = model_registry.MIDAS_MODELS[(persp_monodepth, use_large_model)]
+    elif persp_monodepth == "stub":
+        model, transform = registry.stub()
+        model_name = "stub"
+    else:
+        log.error("The quantization of the perspective monodepth method {} is not supported.".format(persp_monodepth))
+
+    # the resident model may be on CUDA
+    if next(model.parameters()).device != device:
+        model = copy.deepcopy(model).to(device)
+    input_batch = torch.cat([transform(rgb_image_data) for rgb_image_data in rgb_image_data_list])
+    output_size = rgb_image_data_list[0].shape[:2]
+
+    def timed_inference(method):
+        registry.set_quantization(method, calibration_number)
+        # quantize, export and warm up before the timing
+        inference_model = registry.inference_model(model_name, model, input_batch)
+        run_model_batches(inference_model, input_batch[:1], output_size, device)
+        tic = time.perf_counter()
+        disparity_maps = run_model_batches(inference_model, input_batch, output_size, device, batch_size,
+                                           memory_limit)
+        return disparity_maps, time.perf_counter() - tic
+
+    float_dispmaps, float_time = timed_inference("none")
+    report = {"float": {"Time": float_time}}
+
+    for method in quantizations:
+        registry.set_quantization(method, calibration_number)
+        layer_number = depth_quantization.quantized_layer_number(
+            registry.quantized_model(model_name, model, input_batch))
+        if layer_number == 0:
+            log.warn("The {} quantization of {} has no int8 layers, skip it.".format(method, model_name))
+            report[method] = {"QuantizedLayers": 0}
+            continue
+        dispmaps, method_time = timed_inference(method)
+        face_metrics = [metrics.report_precision_error(float_dispmap, dispmap)
+                        for float_dispmap, dispmap in zip(float_dispmaps, dispmaps)]
+        report[method] = {"QuantizedLayers": layer_number, "Time": method_time, "Speedup": float_time / method_time}
+        for key in face_metrics[0].keys():
+            report[method][key] = float(np.mean([face_metric[key] for face_metric in face_metrics]))
+        log.info("{} quantization of {}: {}".format(method, model_name, report[method]))
+
+    registry.set_quantization(quantization, calibration_number)
+    return report
+
 
 def MiDaS_torch_hub_file(rgb_image_path, use_large_model=True):
-    """Estimation the single RGB image's depth with MiDaS downloading from Torch Hub.
+    """Estimation the single RGB image's depth with MiDaS loaded from the local Torch Hub weights directory.
     reference: https://pytorch.org/hub/intelisl_midas_v2/
 
     :param rgb_image_path: the RGB image file path.
@@ -260,21 +480,8 @@ def MiDaS_torch_hub_file(rgb_image_path, use_large_model=True):
     # urllib.request.urlretrieve(url, filename)
     # use_large_model = True
 
-    if use_large_model:
-        midas = torch.hub.load("intel-isl/MiDaS", "MiDaS")
-    else:
-        midas = torch.hub.load("intel-isl/MiDaS", "MiDaS_small")
-
-    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
-    midas.to(device)
-    midas.eval()
-
-    midas_transforms = torch.hub.load("intel-isl/MiDaS", "transforms")
-
-    if use_large_model:
-        transform = midas_transforms.default_transform
-    else:
-        transform = midas_transforms.small_transform
+    midas, transform = model_registry.registry.midas("midas2", use_large_model)
+    device = model_registry.registry.device
 
     img = cv2.imread(rgb_image_path)
     img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
@@ -297,265 +504,19 @@ def MiDaS_torch_hub_file(rgb_image_path, use_large_model=True):
     return output
 
 
-def boosting_monodepth(rgb_image_data_list):
-    # Load merge network
-    import cv2
-    import argparse
-    import warnings
-    warnings.simplefilter('ignore', np.RankWarning)
-
-    class Object(object):
-        pass
-
-    # Settings from the official repo
-    option = Object()
-    option.R0 = False
-    option.R20 = False
-    option.Final = True
-    option.output_resolution = 1
-    option.pix2pixsize = 1024
-    option.depthNet = 0
-    option.max_res = 2000
-
-    currfile_dir = os.path.dirname(__file__)
-    boost_path = f"{os.path.join(currfile_dir, os.pardir, os.pardir, os.pardir, os.pardir, 'BoostingMonocularDepth')}"
-    sys.path.append(os.path.abspath(boost_path))
-    sys.path.append(os.path.abspath(os.path.dirname(boost_path)))
-
-    # This import fixes relative imports in subfiles within BoostingMonocularDepth project
-    sys.path.append(os.path.abspath(os.path.join(boost_path, "structuredrl", "models", "syncbn")))
-
-    import BoostingMonocularDepth.run
-
-    # OUR
-    from BoostingMonocularDepth.utils import ImageandPatchs, generatemask, calculateprocessingres
-
-    # MIDAS
-    import BoostingMonocularDepth.midas.utils
-    from BoostingMonocularDepth.midas.models.midas_net import MidasNet
-
-    # PIX2PIX : MERGE NET
-    from BoostingMonocularDepth.pix2pix.options.test_options import TestOptions
-    from BoostingMonocularDepth.pix2pix.models.pix2pix4depth_model import Pix2Pix4DepthModel
-
-    # select device
-    device = torch.device("cuda")
-    print("device: %s" % device)
-
-    whole_size_threshold = 3000  # R_max from the paper
-    GPU_threshold = 1600 - 32  # Limit for the GPU (NVIDIA RTX 2080), can be adjusted
-
-    # Handle pix2pix parser
-    opt = TestOptions()
-    parser_pix2pix = argparse.ArgumentParser()
-    parser_pix2pix = opt.initialize(parser_pix2pix)
-    # Remove arguments causing conflict with main arguments
-    parser_pix2pix.__dict__['_option_string_actions'].pop('--dataroot')
-    parser_pix2pix.__dict__['_option_string_actions'].pop('--dataset_mode')
-    parser_pix2pix.__dict__['_option_string_actions'].pop('--data_dir')
-    opt = parser_pix2pix.parse_known_args()[0]
-    opt.isTrain = False
-    opt.gpu_ids = [0]
-
-    BoostingMonocularDepth.run.pix2pixmodel = Pix2Pix4DepthModel(opt)
-    BoostingMonocularDepth.run.pix2pixmodel.save_dir = os.path.join(boost_path, "pix2pix", "checkpoints", "mergemodel")
-    BoostingMonocularDepth.run.pix2pixmodel.load_networks('latest')
-    BoostingMonocularDepth.run.pix2pixmodel.eval()
-
-    # Decide which depth estimation network to load
-    if option.depthNet == 0:
-        option.net_receptive_field_size = 384
-        option.patch_netsize = 2 * option.net_receptive_field_size
-        midas_model_path = os.path.join(boost_path, "midas", "model.pt")
-        BoostingMonocularDepth.run.midasmodel = MidasNet(midas_model_path, non_negative=True)
-        BoostingMonocularDepth.run.midasmodel.to(device)
-        BoostingMonocularDepth.run.midasmodel.eval()
-
-    # Generate mask used to smoothly blend the local pathc estimations to the base estimate.
-    # It is arbitrarily large to avoid artifacts during rescaling for each crop.
-    mask_org = generatemask((3000, 3000))
-    mask = mask_org.copy()
-
-    # Value x of R_x defined in the section 5 of the main paper.
-    r_threshold_value = 0.2
-    if option.R0:
-        r_threshold_value = 0
-    elif option.R20:
-        r_threshold_value = 0.2
-
-    # Go through all images
-    depthmaps = []
-    print("start processing")
-    for image_ind, image in enumerate(rgb_image_data_list):
-        print('processing image', image_ind)
-
-        # Load image from dataset
-        img = image
-        input_resolution = img.shape
-
-        scale_threshold = 3  # Allows up-scaling with a scale up to 3
-
-        # Find the best input resolution R-x. The resolution search described in section 5-double estimation of the main paper and section B of the
-        # supplementary material.
-        whole_image_optimal_size, patch_scale = calculateprocessingres(img, option.net_receptive_field_size,
-                                                                       r_threshold_value, scale_threshold,
-                                                                       whole_size_threshold)
-
-        print('\t wholeImage being processed in :', whole_image_optimal_size)
-
-        # Generate the base estimate using the double estimation.
-        whole_estimate = BoostingMonocularDepth.run.doubleestimate(img, option.net_receptive_field_size,
-                                                                   whole_image_optimal_size, option.pix2pixsize,
-                                                                   option.depthNet)
-
-        # Compute the multiplier described in section 6 of the main paper to make sure our initial patch can select
-        # small high-density regions of the image.
-        BoostingMonocularDepth.run.factor = max(min(1, 4 * patch_scale * whole_image_optimal_size / whole_size_threshold), 0.2)
-        factor = BoostingMonocularDepth.run.factor
-        print('Adjust factor is:', 1 / factor)
-
-        # Check if Local boosting is beneficial.
-        if option.max_res < whole_image_optimal_size:
-            print("No Local boosting. Specified Max Res is smaller than R20")
-            continue
+def boosting_monodepth(rgb_image_data_list, batch_size=None):
+    """Estimation the RGB images' depth with BoostingMonocularDepth, the patches of all images are estimated in
+    batches and cached, see boosting.boosting_monodepth."""
+    return boosting.boosting_monodepth(rgb_image_data_list, batch_size=batch_size)
 
-        # Compute the default target resolution.
-        if img.shape[0] > img.shape[1]:
-            a = 2 * whole_image_optimal_size
-            b = round(2 * whole_image_optimal_size * img.shape[1] / img.shape[0])
-        else:
-            a = round(2 * whole_image_optimal_size * img.shape[0] / img.shape[1])
-            b = 2 * whole_image_optimal_size
-        b = int(round(b / factor))
-        a = int(round(a / factor))
-
-        # recompute a, b and saturate to max res.
-        if max(a, b) > option.max_res:
-            print('Default Res is higher than max-res: Reducing final resolution')
-            if img.shape[0] > img.shape[1]:
-                a = option.max_res
-                b = round(option.max_res * img.shape[1] / img.shape[0])
-            else:
-                a = round(option.max_res * img.shape[0] / img.shape[1])
-                b = option.max_res
-            b = int(b)
-            a = int(a)
-
-        img = cv2.resize(img, (b, a), interpolation=cv2.INTER_CUBIC)
-
-        # Extract selected patches for local refinement
-        base_size = option.net_receptive_field_size * 2
-        patchset = BoostingMonocularDepth.run.generatepatchs(img, base_size)
-
-        print('Target resolution: ', img.shape)
-
-        # Computing a scale in case user prompted to generate the results as the same resolution of the input.
-        # Notice that our method output resolution is independent of the input resolution and this parameter will only
-        # enable a scaling operation during the local patch merge implementation to generate results with the same resolution
-        # as the input.
-        if option.output_resolution == 1:
-            mergein_scale = input_resolution[0] / img.shape[0]
-            print('Dynamicly change merged-in resolution; scale:', mergein_scale)
-        else:
-            mergein_scale = 1
-
-        imageandpatchs = ImageandPatchs(None, None, patchset, img, mergein_scale)
-        whole_estimate_resized = cv2.resize(whole_estimate, (round(img.shape[1] * mergein_scale),
-                                                             round(img.shape[0] * mergein_scale)),
-                                            interpolation=cv2.INTER_CUBIC)
-        imageandpatchs.set_base_estimate(whole_estimate_resized.copy())
-        imageandpatchs.set_updated_estimate(whole_estimate_resized.copy())
-
-        print('\t Resulted depthmap res will be :', whole_estimate_resized.shape[:2])
-        print('patchs to process: ' + str(len(imageandpatchs)))
-
-        # Enumerate through all patches, generate their estimations and refining the base estimate.
-        for patch_ind in range(len(imageandpatchs)):
-
-            # Get patch information
-            patch = imageandpatchs[patch_ind]  # patch object
-            patch_rgb = patch['patch_rgb']  # rgb patch
-            patch_whole_estimate_base = patch['patch_whole_estimate_base']  # corresponding patch from base
-            rect = patch['rect']  # patch size and location
-            patch_id = patch['id']  # patch ID
-            org_size = patch_whole_estimate_base.shape  # the original size from the unscaled input
-            print('\t processing patch', patch_ind, '|', rect)
-
-            # We apply double estimation for patches. The high resolution value is fixed to twice the receptive
-            # field size of the network for patches to accelerate the process.
-            patch_estimation = BoostingMonocularDepth.run.doubleestimate(patch_rgb, option.net_receptive_field_size,
-                                                                         option.patch_netsize, option.pix2pixsize,
-                                                                         option.depthNet)
-
-            # Output patch estimation if required
-            patch_estimation = cv2.resize(patch_estimation, (option.pix2pixsize, option.pix2pixsize),
-                                          interpolation=cv2.INTER_CUBIC)
-
-            patch_whole_estimate_base = cv2.resize(patch_whole_estimate_base, (option.pix2pixsize, option.pix2pixsize),
-                                                   interpolation=cv2.INTER_CUBIC)
-
-            # Merging the patch estimation into the base estimate using our merge network:
-            # We feed the patch estimation and the same region from the updated base estimate to the merge network
-            # to generate the target estimate for the corresponding region.
-            BoostingMonocularDepth.run.pix2pixmodel.set_input(patch_whole_estimate_base, patch_estimation)
-
-            # Run merging network
-            BoostingMonocularDepth.run.pix2pixmodel.test()
-            visuals = BoostingMonocularDepth.run.pix2pixmodel.get_current_visuals()
-
-            prediction_mapped = visuals['fake_B']
-            prediction_mapped = (prediction_mapped + 1) / 2
-            prediction_mapped = prediction_mapped.squeeze().cpu().numpy()
-
-            mapped = prediction_mapped
-
-            # We use a simple linear polynomial to make sure the result of the merge network would match the values of
-            # base estimate
-            p_coef = np.polyfit(mapped.reshape(-1), patch_whole_estimate_base.reshape(-1), deg=1)
-            merged = np.polyval(p_coef, mapped.reshape(-1)).reshape(mapped.shape)
-
-            merged = cv2.resize(merged, (org_size[1], org_size[0]), interpolation=cv2.INTER_CUBIC)
-
-            # Get patch size and location
-            w1 = rect[0]
-            h1 = rect[1]
-            w2 = w1 + rect[2]
-            h2 = h1 + rect[3]
-
-            # To speed up the implementation, we only generate the Gaussian mask once with a sufficiently large size
-            # and resize it to our needed size while merging the patches.
-            if mask.shape != org_size:
-                mask = cv2.resize(mask_org, (org_size[1], org_size[0]), interpolation=cv2.INTER_LINEAR)
-
-            tobemergedto = imageandpatchs.estimation_updated_image
-
-            # Update the whole estimation:
-            # We use a simple Gaussian mask to blend the merged patch region with the base estimate to ensure seamless
-            # blending at the boundaries of the patch region.
-            tobemergedto[h1:h2, w1:w2] = np.multiply(tobemergedto[h1:h2, w1:w2], 1 - mask) + np.multiply(merged, mask)
-            imageandpatchs.set_updated_estimate(tobemergedto)
-
-        # Output the result
-        output = cv2.resize(imageandpatchs.estimation_updated_image,
-                            (input_resolution[1], input_resolution[0]),
-                            interpolation=cv2.INTER_CUBIC)
-        depthmaps.append(output)
-
-    return depthmaps
 
 @torch.no_grad()
 def zoedepth_monodepth(rgb_image_data_list):
-    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
-    torch.hub._validate_not_a_forked_repo=lambda a,b,c: True
-    torch.hub.help("intel-isl/MiDaS", "DPT_BEiT_L_384", force_reload=True)
+    model_zoe = model_registry.registry.zoedepth()
+    device = model_registry.registry.device
 
     tfoms = transforms.Compose([transforms.ToTensor()])
 
-    repo = "isl-org/ZoeDepth"
-    model_zoe = torch.hub.load(repo, "ZoeD_NK", pretrained=True)
-    model_zoe = model_zoe.to(device)
-    model_zoe.eval()
-
     depthmaps = []
     for img in rgb_image_data_list:
         img_t = tfoms(img / 255.).unsqueeze(0).type(torch.float32).to(device)
@@ -572,7 +533,6 @@ def zoedepth_monodepth(rgb_image_data_list):
             out = torch.clamp(out, min=1e-6)
         depthmaps.append(out)
 
-    del model_zoe
     # grid = make_grid(depthmaps, nrow=5)[0]
     return [depth2disparity(d.squeeze().cpu().numpy()) for d in depthmaps]
 
@@ -749,7 +709,7 @@ def depthmap_histogram(data):
     plt.show()
 
 
-def depth2disparity(depth_map, baseline=1.0, focal=1.0):
+def depth2disparity(depth_map, baseline=1.0, focal=1.0, dtype=np.float64):
     """
     Convert the depth map to disparity map.
 
@@ -759,25 +719,33 @@ def depth2disparity(depth_map, baseline=1.0, focal=1.0):
     :type baseline: float, optional
     :param focal: [description], defaults to 1
     :type focal: float, optional
+    :param dtype: the disparity map data type, defaults to float64
+    :type dtype: numpy.dtype, optional
     :return: disparity map data, 
     :rtype: numpy
     """
+    if isinstance(depth_map, FaceTensor):
+        return depth_map.like(depth2disparity(depth_map.data, baseline, focal, dtype))
+
     no_zeros_index = np.where(depth_map != 0)
-    disparity_map = np.full(depth_map.shape, np.Inf, np.float64)
+    disparity_map = np.full(depth_map.shape, np.inf, dtype)
     disparity_map[no_zeros_index] = (baseline * focal) / depth_map[no_zeros_index]
     return disparity_map
 
 
-def disparity2depth(disparity_map,  baseline=1.0, focal=1.0):
+def disparity2depth(disparity_map,  baseline=1.0, focal=1.0, dtype=np.float64):
     """Convert disparity value to depth value.
     """
+    if isinstance(disparity_map, FaceTensor):
+        return disparity_map.like(disparity2depth(disparity_map.data, baseline, focal, dtype))
+
     no_zeros_index = np.where(disparity_map != 0)
-    depth_map = np.full(disparity_map.shape, np.Inf, np.float64)
+    depth_map = np.full(disparity_map.shape, np.inf, dtype)
     depth_map[no_zeros_index] = (baseline * focal) / disparity_map[no_zeros_index]
     return depth_map
 
 
-def dispmap_normalize(dispmap, method = "", mask = None):
+def dispmap_normalize(dispmap, method = "", mask = None, dtype=np.float64):
     """Normalize a disparity map.
 
     TODO support mask
@@ -788,6 +756,8 @@ def dispmap_normalize(dispmap, method = "", mask = None):
     :type method: str
     :param mask: The mask map, available pixel is 1, invalid is 0.
     :type mask: numpy
+    :param dtype: the normalized disparity map data type of "midas" method.
+    :type dtype: numpy.dtype
     :return: normalized disparity map.
     :rtype: numpy
     """
@@ -801,7 +771,7 @@ def dispmap_normalize(dispmap, method = "", mask = None):
     elif method == "midas":
         median_dispmap = np.median(dispmap[mask])
         dev_dispmap = np.sum(np.abs(dispmap[mask] - median_dispmap)) / np.sum(mask)
-        dispmap_norm = np.full(dispmap.shape, np.nan, dtype= np.float64)
+        dispmap_norm = np.full(dispmap.shape, np.nan, dtype=dtype)
         dispmap_norm[mask] = (dispmap[mask] - median_dispmap) / dev_dispmap
     elif method == "range01":
         max_index = np.argsort(dispmap, axis=None)[int(dispmap.size * 0.96)]
@@ -820,6 +790,9 @@ def subdepthmap_erp2tang(subimage_depthmap_erp, gnomonic_coord_xy):
     :param subimage_depthmap: the subimage's depth map in perspective projection, [height, width].
     :param gnomonic_coord: The tangent image each pixels location in gnomonic space, [height, width] * 2.
     """
+    if isinstance(subimage_depthmap_erp, FaceTensor):
+        return subimage_depthmap_erp.like(subdepthmap_erp2tang(subimage_depthmap_erp.data, gnomonic_coord_xy))
+
     gnomonic_coord_x = gnomonic_coord_xy[0]
     gnomonic_coord_y = gnomonic_coord_xy[1]
 
@@ -832,11 +805,14 @@ def subdepthmap_erp2tang(subimage_depthmap_erp, gnomonic_coord_xy):
 def subdepthmap_tang2erp(subimage_depthmap_persp, gnomonic_coord_xy):
     """ Convert the depth map from perspective to ERP space.
 
-    :param subimage_erp_depthmap: subimage's depth map of ERP space.
+    :param subimage_erp_depthmap: subimage's depth map of ERP space, a depth map or FaceTensor of all faces.
     :type subimage_erp_depthmap: numpy 
     :param gnomonic_coord_xy: The tangent image's pixels gnomonic coordinate, x and y.
     :type gnomonic_coord_xy: list
     """
+    if isinstance(subimage_depthmap_persp, FaceTensor):
+        return subimage_depthmap_persp.like(subdepthmap_tang2erp(subimage_depthmap_persp.data, gnomonic_coord_xy))
+
     gnomonic_coord_x = gnomonic_coord_xy[0]
     gnomonic_coord_y = gnomonic_coord_xy[1]
     center2pixel_length = np.sqrt(np.square(gnomonic_coord_x) + np.square(gnomonic_coord_y) + np.ones_like(gnomonic_coord_y))
@@ -844,7 +820,7 @@ def subdepthmap_tang2erp(subimage_depthmap_persp, gnomonic_coord_xy):
     return subimage_depthmap_erp
 
 
-def depthmap_pyramid(depthmap_list, pyramid_layer_number, pyramid_downscale):
+def depthmap_pyramid(depthmap_list, pyramid_layer_number, pyramid_downscale, dtype=np.float64):
     """ Create the all depth maps pyramid.
 
     :param depthmap_list: The list of depth map
@@ -853,18 +829,27 @@ def depthmap_pyramid(depthmap_list, pyramid_layer_number, pyramid_downscale):
     :type pyramid_layer_number: int
     :param pyramid_downscale: pyramid downsample ration, coarse_level_size = fine_level_size * pyramid_downscale
     :type pyramid_downscale: float
+    :param dtype: the pyramid depth maps data type.
+    :type dtype: numpy.dtype
     :return: the pyramid for each depth map. the 1st index is pyramid level, 2nd is image index, [pyramid_idx][image_idx], 1st (index 0) level is coarsest image.
+        If the depth maps are FaceTensor, each level is a FaceTensor.
     :rtype: list
     """    
+    if isinstance(depthmap_list, FaceTensor):
+        if pyramid_layer_number == 1:
+            return [depthmap_list.astype(dtype)]
+        depthmap_pryamid = depthmap_pyramid(depthmap_list.tolist(), pyramid_layer_number, pyramid_downscale, dtype)
+        return [depthmap_list.like(np.stack(layer)) for layer in depthmap_pryamid]
+
     depthmap_number = len(depthmap_list)
     depthmap_pryamid = [[0] * depthmap_number for i in range(pyramid_layer_number)]
     for index in range(0, depthmap_number):
         if pyramid_layer_number == 1:
-            depthmap_pryamid[0][index] = depthmap_list[index].astype(np.float64)
+            depthmap_pryamid[0][index] = depthmap_list[index].astype(dtype)
         else:
             depthmap = depthmap_list[index]
             pyramid = tuple(pyramid_gaussian(depthmap, max_layer=pyramid_layer_number - 1, downscale=pyramid_downscale, multichannel=False))
             for layer_index in range(0, pyramid_layer_number):
-                depthmap_pryamid[pyramid_layer_number - layer_index - 1][index] = pyramid[layer_index].astype(np.float64)
+                depthmap_pryamid[pyramid_layer_number - layer_index - 1][index] = pyramid[layer_index].astype(dtype)
 
     return depthmap_pryamid
\ No newline at end of file
@@ -0,0 +1,177 @@
+import numpy as np
+from skimage.transform import resize
+
+import depthmap_utils
+from face_tensor import FaceTensor
+
+from logger import Logger
+
+log = Logger(__name__)
+log.logger.propagate = False
+
+
+class FaceSequenceCache:
+    """The previous frames' results of the 360 video sequence, reused for the tangent faces without change.
+
+    Each frame's tangent faces are compared with the frame whose results are cached for the face, by the mean
+    absolute pixel difference or the difference hash. The unchanged faces reuse the cached monocular disparity maps.
+    When no face changes, the alignment and the blended disparity map of the previous frame are reused. Otherwise
+    the alignment starts from the previous frame's coefficients, the faces whose aligned disparity maps did not change
+    reuse their blending tiles and contributions, and the previous blended disparity map is the initial guess of the
+    multigrid Poisson solver.
+    """
+
+    def __init__(self, method="pixel", threshold=None, downsample=4, hash_size=8, aligned_tolerance=1e-3):
+        """
+        :param method: The face change detection, "pixel" the mean absolute difference of the downsampled gray
+            images, or "hash" the Hamming distance of the difference hashes.
+        :type method: str
+        :param threshold: The face is changed when the difference is larger than it, defaults to 2.0 gray levels of
+            "pixel" and 4 bits of "hash".
+        :type threshold: float, optional
+        :param downsample: The downsample ratio of the gray images of "pixel", reduces the noise and the cost.
+        :type downsample: int
+        :param hash_size: The difference hash size of "hash", the hash has hash_size * hash_size bits.
+        :type hash_size: int
+        :param aligned_tolerance: The aligned disparity map is unchanged when its largest difference to the cached
+            one is below this fraction of its range.
+        :type aligned_tolerance: float
+        """
+        if method not in ["pixel", "hash"]:
+            log.error("The face change detection method {} is not supported.".format(method))
+        self.method = method
+        self.threshold = threshold
+        if self.threshold is None:
+            self.threshold = 2.0 if method == "pixel" else 4
+        self.downsample = downsample
+        self.hash_size = hash_size
+        self.aligned_tolerance = aligned_tolerance
+
+        self.face_signatures = None  # the signature of each face's cached frame
+        self.dispmap_persp = None  # the FaceTensor of the cached monocular disparity maps
+        self.changed_faces = None  # the changed faces of the current frame
+        self.alignment = None  # the cached alignment results
+        self.blended = None  # the cached blended ERP disparity maps
+        self.blend_state = None  # the cached per-face blending tiles and contributions, see BlendIt.blend_faces
+        self.blend_changed_faces = None  # the faces whose aligned disparity maps changed in the current frame
+
+    def face_signature(self, face_rgb):
+        """The gray image or the difference hash of the tangent face."""
+        face_gray = np.asarray(face_rgb, np.float32)
+        if face_gray.ndim == 3:
+            face_gray = face_gray[..., :3].mean(axis=2)
+        if self.method == "pixel":
+            height = face_gray.shape[0] // self.downsample * self.downsample
+            width = face_gray.shape[1] // self.downsample * self.downsample
+            return face_gray[:height, :width].reshape(height // self.downsample, self.downsample,
+                                                      width // self.downsample, self.downsample).mean(axis=(1, 3))
+        face_small = resize(face_gray, (self.hash_size, self.hash_size + 1), anti_aliasing=True)
+        return face_small[:, 1:] > face_small[:, :-1]
+
+    def signature_difference(self, signature, reference):
+        if self.method == "pixel":
+            return float(np.mean(np.abs(signature - reference)))
+        return int(np.count_nonzero(signature != reference))
+
+    def detect_changes(self, subimage_rgb_list):
+        """Find the faces changed since their cached frame, the changed faces' signatures are updated.
+
+        The unchanged faces keep the signature of the cached frame, so the slow changes over many frames are
+        detected when they add up.
+
+        :param subimage_rgb_list: The current frame's tangent rgb images.
+        :type subimage_rgb_list: FaceTensor
+        :return: The changed faces' position in the list.
+        :rtype: list
+        """
+        signatures = [self.face_signature(face_rgb) for face_rgb in subimage_rgb_list]
+        if self.face_signatures is None or len(self.face_signatures) != len(signatures):
+            self.changed_faces = list(range(len(signatures)))
+            self.face_signatures = signatures
+        else:
+            self.changed_faces = [index for index, (signature, reference) in
+                                  enumerate(zip(signatures, self.face_signatures))
+                                  if self.signature_difference(signature, reference) > self.threshold]
+            for index in self.changed_faces:
+                self.face_signatures[index] = signatures[index]
+        log.info("{} of {} faces changed.".format(len(self.changed_faces), len(signatures)))
+        return self.changed_faces
+
+    def unchanged(self):
+        """Whether all faces of the current frame are unchanged."""
+        return self.changed_faces is not None and len(self.changed_faces) == 0
+
+    def align_coeff_initial(self):
+        """The previous frame's alignment coefficients, the initial coefficients of the current frame's alignment.
+
+        The unchanged faces keep their coefficients. The changed faces' normalized disparity maps are close to their
+        previous ones, so their previous coefficients are a closer start than the identity, and the gauge of the
+        fixed reference face is kept.
+
+        :return: The copies of the scale and offset coefficients lists, empty lists without cached alignment.
+        :rtype: tuple
+        """
+        if self.alignment is None:
+            return [], []
+        _, coeffs_scale, coeffs_offset, _ = self.alignment
+        return [scale.copy() for scale in coeffs_scale], [offset.copy() for offset in coeffs_offset]
+
+    def detect_aligned_changes(self, dispmap_aligned_list):
+        """Find the faces whose aligned disparity maps changed since the cached alignment.
+
+        The unchanged faces' aligned disparity maps are replaced by the cached ones, so the blending tiles reused for
+        them match the returned list.
+
+        :param dispmap_aligned_list: The current frame's aligned disparity maps.
+        :type dispmap_aligned_list: list
+        :return: The aligned disparity maps, and the changed faces' position in the list.
+        :rtype: tuple
+        """
+        dispmap_aligned_list = list(dispmap_aligned_list)
+        if self.alignment is None or len(self.alignment[0]) != len(dispmap_aligned_list):
+            self.blend_changed_faces = list(range(len(dispmap_aligned_list)))
+            return dispmap_aligned_list, self.blend_changed_faces
+
+        self.blend_changed_faces = []
+        for index, (dispmap, reference) in enumerate(zip(dispmap_aligned_list, self.alignment[0])):
+            if dispmap.shape != reference.shape:
+                self.blend_changed_faces.append(index)
+                continue
+            dispmap_range = max(float(np.max(reference) - np.min(reference)), np.finfo(np.float64).tiny)
+            if np.max(np.abs(dispmap - reference)) > self.aligned_tolerance * dispmap_range:
+                self.blend_changed_faces.append(index)
+            else:
+                dispmap_aligned_list[index] = reference
+        log.info("{} of {} aligned disparity maps changed.".format(len(self.blend_changed_faces),
+                                                                    len(dispmap_aligned_list)))
+        return dispmap_aligned_list, self.blend_changed_faces
+
+    def run_persp_monodepth(self, subimage_rgb_list, persp_monodepth, batch_size=None, memory_limit=None):
+        """Estimate the disparity maps of the changed faces and reuse the cached ones of the others.
+
+        :param subimage_rgb_list: The current frame's tangent rgb images.
+        :type subimage_rgb_list: FaceTensor
+        :param persp_monodepth: The perspective monodepth method.
+        :type persp_monodepth: str
+        :param batch_size: The MiDaS batch size, see depthmap_utils.run_persp_monodepth.
+        :type batch_size: int, optional
+        :param memory_limit: The MiDaS memory limit in MB, see depthmap_utils.run_persp_monodepth.
+        :type memory_limit: float, optional
+        :return: The disparity maps of all faces.
+        :rtype: FaceTensor
+        """
+        subimage_rgb_list = FaceTensor.from_list(subimage_rgb_list)
+        changed_faces = self.detect_changes(subimage_rgb_list)
+        if self.dispmap_persp is None or len(self.dispmap_persp) != len(subimage_rgb_list):
+            self.dispmap_persp = depthmap_utils.run_persp_monodepth(subimage_rgb_list, persp_monodepth,
+                                                                    batch_size=batch_size, memory_limit=memory_limit)
+        elif changed_faces:
+            changed_rgb = FaceTensor(subimage_rgb_list.data[changed_faces],
+                                     [subimage_rgb_list.face_index[index] for index in changed_faces],
+                                     [subimage_rgb_list.metadata[index] for index in changed_faces])
+            changed_dispmap = depthmap_utils.run_persp_monodepth(changed_rgb, persp_monodepth, batch_size=batch_size,
+                                                                 memory_limit=memory_limit)
+            dispmap_data = self.dispmap_persp.data.copy()
+            dispmap_data[changed_faces] = changed_dispmap.data
+            self.dispmap_persp = subimage_rgb_list.like(dispmap_data)
+        return self.dispmap_persp
@@ -0,0 +1,87 @@
+import numpy as np
+
+from logger import Logger
+
+log = Logger(__name__)
+log.logger.propagate = False
+
+
+class FaceTensor:
+    """The stacked tangent images of the ERP image projection.
+
+    The face images are stored in one contiguous array, [face_number, height, width] or
+    [face_number, height, width, channel], so the per-pixel operations run on all faces at once.
+    Indexing and iterating return the per-face image views, so it can be used where a list of face images is expected.
+    """
+
+    def __init__(self, data, face_index=None, metadata=None):
+        """
+        :param data: The stacked face images, the 1st axis is the face.
+        :type data: numpy
+        :param face_index: The face index of each image in the projection, defaults to [0, face_number).
+        :type face_index: list, optional
+        :param metadata: Each face's information, e.g. the tangent point, defaults to empty dict.
+        :type metadata: list, optional
+        """
+        self.data = np.ascontiguousarray(data)
+        face_number = self.data.shape[0]
+        self.face_index = list(range(face_number)) if face_index is None else list(face_index)
+        self.metadata = [{} for _ in range(face_number)] if metadata is None else list(metadata)
+        if len(self.face_index) != face_number or len(self.metadata) != face_number:
+            log.error("The face index and metadata size do not match the {} faces.".format(face_number))
+
+    @classmethod
+    def from_list(cls, image_list, face_index=None, metadata=None, dtype=None):
+        """Stack the list of same size face images.
+
+        :param image_list: The face images.
+        :type image_list: list
+        :param dtype: The data type of the stacked images, defaults to the images' type.
+        :type dtype: numpy.dtype, optional
+        """
+        if isinstance(image_list, FaceTensor):
+            data = image_list.data if dtype is None else image_list.data.astype(dtype, copy=False)
+            face_index = image_list.face_index if face_index is None else face_index
+            metadata = image_list.metadata if metadata is None else metadata
+            return cls(data, face_index, metadata)
+        data = np.stack(image_list)
+        if dtype is not None:
+            data = data.astype(dtype, copy=False)
+        return cls(data, face_index, metadata)
+
+    def like(self, data):
+        """Create the face tensor with the new data and the same faces' index and metadata."""
+        if data.shape[0] != len(self.face_index):
+            log.error("The data has {} faces, expect {}.".format(data.shape[0], len(self.face_index)))
+        return FaceTensor(data, self.face_index, self.metadata)
+
+    def tolist(self):
+        return [self.data[index] for index in range(self.data.shape[0])]
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    def astype(self, dtype, copy=True):
+        return self.like(self.data.astype(dtype, copy=copy))
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def __getitem__(self, index):
+        return self.data[index]
+
+    def __setitem__(self, index, value):
+        self.data[index] = value
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __array__(self, dtype=None, copy=None):
+        if dtype is None:
+            return self.data
+        return self.data.astype(dtype, copy=False)
@@ -2,6 +2,7 @@
 import numpy as np
 
 from logger import Logger
+from spherical_coordinates import output_buffers, scalar_output, check_out_overlap
 
 log = Logger(__name__)
 log.logger.propagate = False
@@ -75,7 +76,7 @@ def inside_polygon_2d(points_list, polygon_points, on_line=False, eps=1e-4):
         return np.logical_and(point_inside, np.logical_not(online_index)).reshape(np.shape(points_list[:, 0]))
 
 
-def gnomonic_projection(theta, phi, theta_0, phi_0):
+def gnomonic_projection(theta, phi, theta_0, phi_0, out=None):
     """ Gnomonic projection.
     Convet point form the spherical coordinate to tangent image's coordinate.
         https://mathworld.wolfram.com/GnomonicProjection.html
@@ -88,27 +89,53 @@ def gnomonic_projection(theta, phi, theta_0, phi_0):
     :type theta_0: float
     :param phi_0: the tangent point's latitude of gnomonic projection.
     :type phi_0: float
+    :param out: the output (x, y) buffers, can be the theta and phi arrays in either order.
+    :type out: tuple, optional
     :return: The gnomonic coordinate normalized coordinate.
     :rtype: numpy
     """
-    cos_c = np.sin(phi_0) * np.sin(phi) + np.cos(phi_0) * np.cos(phi) * np.cos(theta - theta_0)
+    x, y = output_buffers(out, 2, np.broadcast_shapes(np.shape(theta), np.shape(phi)), theta, phi)
+    # each trigonometric function of the points is evaluated once
+    sin_phi_0 = np.sin(phi_0)
+    cos_phi_0 = np.cos(phi_0)
+    sin_delta_theta, cos_delta_theta, sin_phi = output_buffers(None, 3, x.shape, x)
+
+    # theta and phi are read before the first write to the out buffers, so they can be the out buffers
+    np.subtract(theta, theta_0, out=sin_delta_theta)
+    np.cos(sin_delta_theta, out=cos_delta_theta)
+    np.sin(sin_delta_theta, out=sin_delta_theta)
+    np.sin(phi, out=sin_phi)
+    np.cos(phi, out=x)
+    np.multiply(x, sin_phi_0, out=y)
+    np.multiply(y, cos_delta_theta, out=y)  # sin(phi_0) * cos(phi) * cos(theta - theta_0)
+    np.multiply(x, sin_delta_theta, out=sin_delta_theta)  # cos(phi) * sin(theta - theta_0)
+    np.multiply(x, cos_phi_0, out=x)
+    np.multiply(x, cos_delta_theta, out=x)  # cos(phi_0) * cos(phi) * cos(theta - theta_0)
+
+    cos_c = cos_delta_theta
+    np.multiply(sin_phi, sin_phi_0, out=cos_c)
+    np.add(cos_c, x, out=cos_c)
+    np.multiply(sin_phi, cos_phi_0, out=sin_phi)
+    np.subtract(sin_phi, y, out=y)
 
     # get cos_c's zero element index
     zeros_index = cos_c == 0
     if np.any(zeros_index):
         cos_c[zeros_index] = np.finfo(float).eps
 
-    x = np.cos(phi) * np.sin(theta - theta_0) / cos_c
-    y = (np.cos(phi_0) * np.sin(phi) - np.sin(phi_0) * np.cos(phi) * np.cos(theta - theta_0)) / cos_c
+    np.divide(sin_delta_theta, cos_c, out=x)
+    np.divide(y, cos_c, out=y)
 
     if np.any(zeros_index):
         x[zeros_index] = 0
         y[zeros_index] = 0
 
+    if out is None:
+        return scalar_output(x), scalar_output(y)
     return x, y
 
 
-def reverse_gnomonic_projection(x, y, lambda_0, phi_1):
+def reverse_gnomonic_projection(x, y, lambda_0, phi_1, out=None):
     """ Reverse gnomonic projection.
     Convert the gnomonic nomalized coordinate to spherical coordinate.
 
@@ -120,31 +147,64 @@ def reverse_gnomonic_projection(x, y, lambda_0, phi_1):
     :type theta_0: float
     :param phi_0: the gnomonic projection tangent point's latitude f .
     :type phi_0: float
+    :param out: the output (theta, phi) buffers, can be the x and y arrays in either order.
+    :type out: tuple, optional
     :return: the point array's spherical coordinate location. the longitude range is continuous and exceed the range [-pi, +pi]
     :rtype: numpy
     """
-    rho = np.sqrt(x**2 + y**2)
+    lambda_, phi_ = output_buffers(out, 2, np.broadcast_shapes(np.shape(x), np.shape(y)), x, y)
+    # each trigonometric function of the points is evaluated once
+    sin_phi_1 = np.sin(phi_1)
+    cos_phi_1 = np.cos(phi_1)
+    rho, cos_c, sin_c, y_sin_c, y_sin_phi_1_sin_c = output_buffers(None, 5, lambda_.shape, lambda_)
+
+    # x and y are read before the first write to the out buffers, so they can be the out buffers
+    np.square(x, out=rho)
+    np.square(y, out=cos_c)
+    np.add(rho, cos_c, out=rho)
+    np.sqrt(rho, out=rho)
 
     # get rho's zero element index
     zeros_index = rho == 0
     if np.any(zeros_index):
         rho[zeros_index] = np.finfo(float).eps
 
-    c = np.arctan2(rho, 1)
-    phi_ = np.arcsin(np.cos(c) * np.sin(phi_1) + (y * np.sin(c) * np.cos(phi_1)) / rho)
-    lambda_ = lambda_0 + np.arctan2(x * np.sin(c), rho * np.cos(phi_1) * np.cos(c) - y * np.sin(phi_1) * np.sin(c))
+    np.arctan2(rho, 1, out=cos_c)
+    np.sin(cos_c, out=sin_c)
+    np.cos(cos_c, out=cos_c)
+    np.multiply(y, sin_c, out=y_sin_c)
+    np.multiply(y, sin_phi_1, out=y_sin_phi_1_sin_c)
+    np.multiply(y_sin_phi_1_sin_c, sin_c, out=y_sin_phi_1_sin_c)
+    x_sin_c = sin_c
+    np.multiply(x, sin_c, out=x_sin_c)
+
+    # phi_ = arcsin(cos(c) * sin(phi_1) + (y * sin(c) * cos(phi_1)) / rho)
+    np.multiply(y_sin_c, cos_phi_1, out=phi_)
+    np.divide(phi_, rho, out=phi_)
+    np.multiply(cos_c, sin_phi_1, out=lambda_)
+    np.add(lambda_, phi_, out=phi_)
+    np.arcsin(phi_, out=phi_)
+
+    # lambda_ = lambda_0 + arctan2(x * sin(c), rho * cos(phi_1) * cos(c) - y * sin(phi_1) * sin(c))
+    np.multiply(rho, cos_phi_1, out=rho)
+    np.multiply(rho, cos_c, out=rho)
+    np.subtract(rho, y_sin_phi_1_sin_c, out=rho)
+    np.arctan2(x_sin_c, rho, out=lambda_)
+    np.add(lambda_, lambda_0, out=lambda_)
 
     if np.any(zeros_index):
         phi_[zeros_index] = phi_1
         lambda_[zeros_index] = lambda_0
 
+    if out is None:
+        return scalar_output(lambda_), scalar_output(phi_)
     return lambda_, phi_
 
 
 def gnomonic2pixel(coord_gnom_x, coord_gnom_y,
                    padding_size,
                    tangent_image_width, tangent_image_height=None,
-                   coord_gnom_xy_range=None):
+                   coord_gnom_xy_range=None, out=None):
     """Transform the tangent image's gnomonic coordinate to tangent image pixel coordinate.
 
     The tangent image gnomonic x is right, y is up.
@@ -162,6 +222,8 @@ def gnomonic2pixel(coord_gnom_x, coord_gnom_y,
     :type tangent_image_height: float
     :param coord_gnom_xy_range: the range of gnomonic coordinate, [x_min, x_max, y_min, y_max]. It's often [-1.0 - padding_size, +1.0 + padding_size, ]
     :type coord_gnom_xy_range: list
+    :param out: the output (x, y) int buffers.
+    :type out: tuple, optional
     :retrun: the pixel's location
     :rtype: numpy (int)
     """
@@ -185,20 +247,33 @@ def gnomonic2pixel(coord_gnom_x, coord_gnom_y,
 
     # normailzed tangent image space --> tangent image space
     # TODO check add the padding whether necessary
+    if out is None:
+        coord_pixel_x, coord_pixel_y = np.empty((2,) + np.shape(coord_gnom_x), int)
+    else:
+        coord_pixel_x, coord_pixel_y = out
+    coord_pixel = output_buffers(None, 1, np.shape(coord_gnom_x), coord_gnom_x, coord_gnom_y)[0]
+
     gnomonic2image_width_ratio = (tangent_image_width - 1.0) / (x_max - x_min + padding_size * 2.0)
-    coord_pixel_x = (coord_gnom_x - x_min + padding_size) * gnomonic2image_width_ratio
-    coord_pixel_x = (coord_pixel_x + 0.5).astype(int)
+    np.subtract(coord_gnom_x, x_min, out=coord_pixel)
+    np.add(coord_pixel, padding_size, out=coord_pixel)
+    np.multiply(coord_pixel, gnomonic2image_width_ratio, out=coord_pixel)
+    np.add(coord_pixel, 0.5, out=coord_pixel)
+    np.copyto(coord_pixel_x, coord_pixel, casting="unsafe")
 
     gnomonic2image_height_ratio = (tangent_image_height - 1.0) / (y_max - y_min + padding_size * 2.0)
-    coord_pixel_y = -(coord_gnom_y - y_max - padding_size) * gnomonic2image_height_ratio
-    coord_pixel_y = (coord_pixel_y + 0.5).astype(int)
+    np.subtract(coord_gnom_y, y_max, out=coord_pixel)
+    np.subtract(coord_pixel, padding_size, out=coord_pixel)
+    np.negative(coord_pixel, out=coord_pixel)
+    np.multiply(coord_pixel, gnomonic2image_height_ratio, out=coord_pixel)
+    np.add(coord_pixel, 0.5, out=coord_pixel)
+    np.copyto(coord_pixel_y, coord_pixel, casting="unsafe")
 
     return coord_pixel_x, coord_pixel_y
 
 
 def pixel2gnomonic(coord_pixel_x, coord_pixel_y,  padding_size,
                    tangent_image_width, tangent_image_height=None,
-                   coord_gnom_xy_range=None):
+                   coord_gnom_xy_range=None, out=None):
     """Transform the tangent image's from tangent image pixel coordinate to gnomonic coordinate.
 
     :param coord_pixel_x: tangent image's pixels x coordinate
@@ -213,6 +288,8 @@ def pixel2gnomonic(coord_pixel_x, coord_pixel_y,  padding_size,
     :type tangent_image_height: numpy
     :param coord_gnom_xy_range: the range of gnomonic coordinate, [x_min, x_max, y_min, y_max]. It desn't includes padding outside to boundary.
     :type coord_gnom_xy_range: list
+    :param out: the output (x, y) buffers, can be the input arrays to convert in place.
+    :type out: tuple, optional
     :retrun: the pixel's location 
     :rtype:
     """
@@ -231,13 +308,24 @@ def pixel2gnomonic(coord_pixel_x, coord_pixel_y,  padding_size,
         y_min = coord_gnom_xy_range[2]
         y_max = coord_gnom_xy_range[3]
 
+    if out is not None:
+        check_out_overlap(out, (coord_pixel_x, coord_pixel_y))
+    coord_gnom_x, coord_gnom_y = output_buffers(out, 2, np.shape(coord_pixel_x), coord_pixel_x, coord_pixel_y)
+
     # tangent image space --> tangent normalized space
     gnomonic_size_x = abs(x_max - x_min)
     gnomonic2image_ratio_width = (tangent_image_width - 1.0) / (gnomonic_size_x + padding_size * 2.0)
-    coord_gnom_x = coord_pixel_x / gnomonic2image_ratio_width + x_min - padding_size
+    np.divide(coord_pixel_x, gnomonic2image_ratio_width, out=coord_gnom_x)
+    np.add(coord_gnom_x, x_min, out=coord_gnom_x)
+    np.subtract(coord_gnom_x, padding_size, out=coord_gnom_x)
 
     gnomonic_size_y = abs(y_max - y_min)
     gnomonic2image_ratio_height = (tangent_image_height - 1.0) / (gnomonic_size_y + padding_size * 2.0)
-    coord_gnom_y = - coord_pixel_y / gnomonic2image_ratio_height + y_max + padding_size
+    np.negative(coord_pixel_y, out=coord_gnom_y)
+    np.divide(coord_gnom_y, gnomonic2image_ratio_height, out=coord_gnom_y)
+    np.add(coord_gnom_y, y_max, out=coord_gnom_y)
+    np.add(coord_gnom_y, padding_size, out=coord_gnom_y)
 
+    if out is None:
+        return scalar_output(coord_gnom_x), scalar_output(coord_gnom_y)
     return coord_gnom_x, coord_gnom_y
@@ -0,0 +1,136 @@
+import os
+import inspect
+
+import numpy as np
+import torch
+
+from logger import Logger
+
+log = Logger(__name__)
+log.logger.propagate = False
+
+"""
+Run the perspective depth networks as exported graphs on the optimized CPU runtimes:
+- "eager": the PyTorch module as it is;
+- "torchscript": the module traced and frozen to TorchScript, optimized for inference;
+- "onnx": the module exported to ONNX and run by ONNX Runtime, needs the onnx and onnxruntime packages.
+The exported graph is saved once for each model and input size, later runs load it without the model's code.
+"""
+
+# The supported inference backends
+BACKENDS = ["eager", "torchscript", "onnx"]
+
+
+def check_backend(backend):
+    if backend not in BACKENDS:
+        log.error("The inference backend {} is not supported.".format(backend))
+
+
+def export_filepath(export_dir, model_name, example_input, backend):
+    """The exported graph file of the model and input size, e.g. <export_dir>/MiDaS_3x384x384.pt."""
+    input_size = "x".join(str(size) for size in example_input.shape[1:])
+    extension = ".pt" if backend == "torchscript" else ".onnx"
+    return os.path.join(export_dir, "{}_{}{}".format(model_name, input_size, extension))
+
+
+def export_torchscript(model, example_input, filepath):
+    """Trace the model with the example input, freeze it and save the TorchScript file.
+
+    :param model: The network in evaluation mode.
+    :type model: torch.nn.Module
+    :param example_input: An input batch of the network's input size.
+    :type example_input: torch.Tensor
+    :param filepath: The TorchScript file path.
+    :type filepath: str
+    """
+    with torch.no_grad():
+        traced_model = torch.jit.trace(model, example_input, check_trace=False)
+        traced_model = torch.jit.freeze(traced_model.eval())
+    torch.jit.save(traced_model, filepath)
+
+
+def export_onnx(model, example_input, filepath):
+    """Export the model to the ONNX file, with the dynamic batch size.
+
+    :param model: The network in evaluation mode.
+    :type model: torch.nn.Module
+    :param example_input: An input batch of the network's input size.
+    :type example_input: torch.Tensor
+    :param filepath: The ONNX file path.
+    :type filepath: str
+    """
+    export_options = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        # the TorchScript based exporter, the default of the earlier PyTorch versions
+        export_options["dynamo"] = False
+    with torch.no_grad():
+        torch.onnx.export(model, example_input, filepath, input_names=["input"], output_names=["output"],
+                          dynamic_axes={"input": {0: "batch"}, "output": {0: "batch"}}, opset_version=13,
+                          **export_options)
+
+
+class OnnxModel:
+    """The ONNX Runtime session of the exported network, called like the PyTorch module."""
+
+    def __init__(self, filepath, threads=None):
+        """
+        :param filepath: The ONNX file path.
+        :type filepath: str
+        :param threads: The intra-op threads number, None for the runtime's default.
+        :type threads: int, optional
+        """
+        import onnxruntime
+        session_options = onnxruntime.SessionOptions()
+        session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads is not None:
+            session_options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(filepath, session_options, providers=["CPUExecutionProvider"])
+
+    def __call__(self, input_batch):
+        input_data = np.ascontiguousarray(input_batch.detach().cpu().numpy(), dtype=np.float32)
+        output = self.session.run(None, {"input": input_data})[0]
+        return torch.from_numpy(output)
+
+
+def load_exported(model, model_name, example_input, backend, export_dir, threads=None):
+    """The model as the backend's exported graph, exported on the first use of the model and input size.
+
+    :param model: The network in evaluation mode on CPU.
+    :type model: torch.nn.Module
+    :param model_name: The model name of the exported file.
+    :type model_name: str
+    :param example_input: An input batch of the network's input size.
+    :type example_input: torch.Tensor
+    :param backend: The inference backend, see BACKENDS.
+    :type backend: str
+    :param export_dir: The folder of the exported files.
+    :type export_dir: str
+    :param threads: The intra-op threads number of the runtime, None for the default.
+    :type threads: int, optional
+    :return: The callable model, output the same predictions as the network.
+    """
+    check_backend(backend)
+    if backend == "eager":
+        return model
+    if backend == "onnx":
+        try:
+            import onnx
+            import onnxruntime
+        except ImportError:
+            log.error("The onnx inference backend needs the onnx and onnxruntime packages.")
+
+    filepath = export_filepath(export_dir, model_name, example_input, backend)
+    if not os.path.exists(filepath):
+        log.info("Export the model {} to {}.".format(model_name, filepath))
+        os.makedirs(export_dir, exist_ok=True)
+        example_input = example_input.cpu()
+        if backend == "torchscript":
+            export_torchscript(model, example_input, filepath)
+        else:
+            export_onnx(model, example_input, filepath)
+
+    if backend == "torchscript":
+        if threads is not None:
+            torch.set_num_threads(threads)
+        return torch.jit.optimize_for_inference(torch.jit.load(filepath, map_location="cpu"))
+    return OnnxModel(filepath, threads)
@@ -208,6 +208,21 @@ def report_error(gt, pred, max_depth=10.0):
     return metrics_res
 
 
+def report_precision_error(reference, pred):
+    """Compare the prediction with the reference, e.g. float32 pipeline result with the float64 one."""
+    mask = np.isfinite(reference) & np.isfinite(pred)
+    reference = reference[mask].astype(np.float64)
+    diff = np.abs(pred[mask].astype(np.float64) - reference)
+    rel_diff = diff / np.maximum(np.abs(reference), eps)
+
+    metrics_res = {"MaxAbsDiff": np.max(diff),
+                   "MeanAbsDiff": np.mean(diff),
+                   "MaxRelDiff": np.max(rel_diff),
+                   "MeanRelDiff": np.mean(rel_diff)}
+
+    return metrics_res
+
+
 def normalize_depth_maps2(pred, gt, mask):
     median_gt = np.median(gt[mask])
     median_pred = np.median(pred[mask])
@@ -0,0 +1,305 @@
+import os
+import sys
+import argparse
+import gc
+
+import numpy as np
+import torch
+
+import inference_backend
+import depth_quantization
+from logger import Logger
+
+log = Logger(__name__)
+log.logger.propagate = False
+
+"""
+The perspective depth models, loaded once per process from the local weights directory and kept resident, so the
+panoramas and the grid search iterations reuse them.
+
+The weights directory is a Torch Hub directory prepared in advance, e.g. by running the models once with network
+access, it defaults to torch.hub.get_dir(), which is data/models/hub/ with the TORCH_HOME of the utility package.
+The models are loaded without network access:
+- <weights_dir>/intel-isl_MiDaS_master/: the MiDaS repository, the hub code of midas2, midas3 and zoedepth;
+- <weights_dir>/isl-org_ZoeDepth_main/: the ZoeDepth repository;
+- <weights_dir>/checkpoints/: the downloaded MiDaS and ZoeDepth weights.
+The boost models are loaded from the BoostingMonocularDepth folder next to the 360monodepth folder, and the stub
+model needs no weights.
+
+With the torchscript or onnx inference backend the models run on CPU as the exported graphs, which are saved to
+<weights_dir>/exported/, see inference_backend. With the quantization the models run on CPU as the int8 models,
+which are calibrated on the first image's faces, see depth_quantization.
+"""
+
+# The MiDaS hub entry of each (persp_monodepth, use_large_model)
+MIDAS_MODELS = {("midas2", True): "MiDaS", ("midas2", False): "MiDaS_small",
+                ("midas3", True): "DPT_Large", ("midas3", False): "DPT_Hybrid"}
+
+MIDAS_REPO = "intel-isl_MiDaS_master"
+ZOEDEPTH_REPO = "isl-org_ZoeDepth_main"
+
+# The input size of the stub model
+STUB_INPUT_SIZE = 64
+
+
+class StubDepthNet(torch.nn.Module):
+    """A tiny fixed weights depth network to test the pipeline offline, the disparity is larger on the bright and the
+    lower pixels of the smoothed image. Its output is in the MiDaS layout, (batch, height, width)."""
+
+    def __init__(self):
+        super().__init__()
+        self.smooth = torch.nn.Conv2d(3, 1, 5, padding=2, bias=True)
+        with torch.no_grad():
+            self.smooth.weight.fill_(1.0 / (3 * 5 * 5))
+            self.smooth.bias.fill_(1.0)
+        self.row_weight = torch.nn.Parameter(torch.linspace(0.0, 1.0, STUB_INPUT_SIZE)[:, None],
+                                             requires_grad=False)
+
+    def forward(self, input_batch):
+        return torch.relu(self.smooth(input_batch))[:, 0] + self.row_weight
+
+
+def stub_transform(image):
+    """The stub model input of the rgb image in [0, 255], (1, 3, STUB_INPUT_SIZE, STUB_INPUT_SIZE)."""
+    image_data = torch.from_numpy(np.ascontiguousarray(image[..., :3], dtype=np.float32) / 255.0)
+    return torch.nn.functional.interpolate(image_data.permute(2, 0, 1)[None], size=(STUB_INPUT_SIZE, STUB_INPUT_SIZE),
+                                           mode="bilinear", align_corners=False)
+
+
+class ModelRegistry:
+    """The resident depth models of the process, each model is loaded on its first use."""
+
+    def __init__(self, weights_dir=None, backend="eager", threads=None, quantization="none", calibration_number=8):
+        """
+        :param weights_dir: The local Torch Hub directory of the models, defaults to torch.hub.get_dir().
+        :type weights_dir: str, optional
+        :param backend: The inference backend of the MiDaS and stub models, see inference_backend.BACKENDS.
+        :type backend: str
+        :param threads: The CPU threads number of the inference, None for the default.
+        :type threads: int, optional
+        :param quantization: The int8 quantization of the MiDaS and stub models, see depth_quantization.QUANTIZATIONS.
+        :type quantization: str
+        :param calibration_number: The faces number of the quantization calibration.
+        :type calibration_number: int
+        """
+        self.weights_dir = weights_dir
+        self.backend = "eager"
+        self.threads = None
+        self.quantization = "none"
+        self.calibration_number = calibration_number
+        self.device = None
+        self.models = {}
+        self.set_backend(backend, threads)
+        self.set_quantization(quantization, calibration_number)
+
+    def set_weights_dir(self, weights_dir):
+        """Use the other weights directory, the loaded models are released when it changes."""
+        if weights_dir != self.weights_dir:
+            self.clear()
+            self.weights_dir = weights_dir
+
+    def set_backend(self, backend, threads=None):
+        """Use the other inference backend, the exported graphs run on CPU and the models are loaded on CPU for them.
+
+        :param backend: The inference backend, see inference_backend.BACKENDS.
+        :type backend: str
+        :param threads: The CPU threads number of the inference, None for the default.
+        :type threads: int, optional
+        """
+        inference_backend.check_backend(backend)
+        if backend == "onnx" and self.quantization != "none":
+            log.error("The quantized models can not run with the onnx inference backend.")
+        if backend != self.backend:
+            self.clear()
+            self.backend = backend
+        self.threads = threads
+        if threads is not None:
+            torch.set_num_threads(threads)
+        self.select_device()
+
+    def set_quantization(self, quantization, calibration_number=8):
+        """Use the other int8 quantization, the quantized models run on CPU.
+
+        :param quantization: The quantization method, see depth_quantization.QUANTIZATIONS.
+        :type quantization: str
+        :param calibration_number: The faces number of the calibration.
+        :type calibration_number: int
+        """
+        depth_quantization.check_quantization(quantization)
+        if quantization != "none" and self.backend == "onnx":
+            log.error("The quantized models can not run with the onnx inference backend.")
+        self.quantization = quantization
+        self.calibration_number = calibration_number
+        self.select_device()
+
+    def select_device(self):
+        """The models run on CUDA when it is available, except the exported and quantized models on CPU."""
+        device = torch.device("cpu")
+        if self.backend == "eager" and self.quantization == "none" and torch.cuda.is_available():
+            device = torch.device("cuda")
+        if device != self.device:
+            # the loaded models are on the previous device
+            self.clear()
+            self.device = device
+
+    def hub_dir(self):
+        return self.weights_dir if self.weights_dir is not None else torch.hub.get_dir()
+
+    def hub_load(self, repo, entry, **kwargs):
+        """Load the hub entry from the local repository, the weights are read from the weights directory."""
+        repo_dir = os.path.join(self.hub_dir(), repo)
+        if not os.path.isfile(os.path.join(repo_dir, "hubconf.py")):
+            log.error("The model repository {} does not exist, copy it and its checkpoints to the weights "
+                      "directory {}.".format(repo_dir, self.hub_dir()))
+        # the hub code downloads the weights to <hub dir>/checkpoints, which are found there offline
+        hub_dir = torch.hub.get_dir()
+        torch.hub.set_dir(self.hub_dir())
+        try:
+            return torch.hub.load(repo_dir, entry, source="local", **kwargs)
+        finally:
+            torch.hub.set_dir(hub_dir)
+
+    def get(self, name, loader):
+        """The resident model of the name, loaded by the loader on the first use."""
+        if name not in self.models:
+            log.info("Load the depth model {}.".format(name))
+            self.models[name] = loader()
+        return self.models[name]
+
+    def midas(self, persp_monodepth, use_large_model=True):
+        """The MiDaS model and its input transform.
+
+        :param persp_monodepth: The MiDaS version, "midas2" or "midas3".
+        :type persp_monodepth: str
+        :param use_large_model: Use the large model, otherwise the small and fast one.
+        :type use_large_model: bool
+        :return: The evaluation mode model on the device, and the transform of the rgb image to the input batch.
+        :rtype: tuple
+        """
+        if (persp_monodepth, use_large_model) not in MIDAS_MODELS:
+            log.error("The MiDaS model {} is not supported.".format(persp_monodepth))
+        entry = MIDAS_MODELS[(persp_monodepth, use_large_model)]
+
+        def load_midas():
+            midas = self.hub_load(MIDAS_REPO, entry)
+            midas.to(self.device)
+            midas.eval()
+            return midas
+
+        midas = self.get(entry, load_midas)
+        midas_transforms = self.get("transforms", lambda: self.hub_load(MIDAS_REPO, "transforms"))
+        if use_large_model:
+            return midas, midas_transforms.default_transform
+        return midas, midas_transforms.small_transform
+
+    def stub(self):
+        """The stub model and its input transform, see StubDepthNet."""
+        def load_stub():
+            stub = StubDepthNet()
+            stub.to(self.device)
+            stub.eval()
+            return stub
+
+        return self.get("stub", load_stub), stub_transform
+
+    def inference_model(self, name, model, example_input):
+        """The model run by the inference backend and the quantization, the quantized model and the exported graph are
+        made once for each input size.
+
+        :param name: The model name.
+        :type name: str
+        :param model: The loaded network.
+        :type model: torch.nn.Module
+        :param example_input: The input batch of the network's input size, its first faces are the calibration
+            inputs of the quantization.
+        :type example_input: torch.Tensor
+        :return: The callable model.
+        """
+        if self.quantization != "none":
+            model = self.quantized_model(name, model, example_input)
+            name = "{}_{}".format(name, self.quantization)
+        if self.backend == "eager":
+            return model
+        example_input = example_input[:1]
+        export_dir = os.path.join(self.hub_dir(), "exported")
+        key = (name, self.backend) + tuple(example_input.shape[1:])
+        return self.get(key, lambda: inference_backend.load_exported(model, name, example_input, self.backend,
+                                                                     export_dir, self.threads))
+
+    def quantized_model(self, name, model, example_input):
+        """The int8 model of the quantization, made once for each input size, see inference_model."""
+        key = (name, self.quantization) + tuple(example_input.shape[1:])
+        return self.get(key, lambda: depth_quantization.quantize_model(
+            model, example_input[:self.calibration_number], self.quantization))
+
+    def zoedepth(self):
+        """The ZoeDepth ZoeD_NK model in evaluation mode on the device."""
+        def load_zoedepth():
+            # ZoeDepth loads its MiDaS backbone code from the hub directory, the cached repository is used offline
+            model_zoe = self.hub_load(ZOEDEPTH_REPO, "ZoeD_NK", pretrained=True)
+            model_zoe = model_zoe.to(self.device)
+            model_zoe.eval()
+            return model_zoe
+
+        return self.get("ZoeD_NK", load_zoedepth)
+
+    def boost(self):
+        """The BoostingMonocularDepth run module, with its merge network and MiDaS network loaded on the device."""
+        return self.get("boost", lambda: load_boost(self.device))
+
+    def clear(self):
+        """Release the resident models."""
+        self.models = {}
+        gc.collect()
+        torch.cuda.empty_cache()
+
+
+def load_boost(device):
+    currfile_dir = os.path.dirname(__file__)
+    boost_path = f"{os.path.join(currfile_dir, os.pardir, os.pardir, os.pardir, os.pardir, 'BoostingMonocularDepth')}"
+    sys.path.append(os.path.abspath(boost_path))
+    sys.path.append(os.path.abspath(os.path.dirname(boost_path)))
+
+    # This import fixes relative imports in subfiles within BoostingMonocularDepth project
+    sys.path.append(os.path.abspath(os.path.join(boost_path, "structuredrl", "models", "syncbn")))
+
+    import BoostingMonocularDepth.run
+
+    # MIDAS
+    from BoostingMonocularDepth.midas.models.midas_net import MidasNet
+
+    # PIX2PIX : MERGE NET
+    from BoostingMonocularDepth.pix2pix.options.test_options import TestOptions
+    from BoostingMonocularDepth.pix2pix.models.pix2pix4depth_model import Pix2Pix4DepthModel
+
+    # the run module estimates on its global device
+    BoostingMonocularDepth.run.device = device
+    print("device: %s" % device)
+
+    # Handle pix2pix parser
+    opt = TestOptions()
+    parser_pix2pix = argparse.ArgumentParser()
+    parser_pix2pix = opt.initialize(parser_pix2pix)
+    # Remove arguments causing conflict with main arguments
+    parser_pix2pix.__dict__['_option_string_actions'].pop('--dataroot')
+    parser_pix2pix.__dict__['_option_string_actions'].pop('--dataset_mode')
+    parser_pix2pix.__dict__['_option_string_actions'].pop('--data_dir')
+    opt = parser_pix2pix.parse_known_args()[0]
+    opt.isTrain = False
+    opt.gpu_ids = [0] if device.type == "cuda" else []
+
+    BoostingMonocularDepth.run.pix2pixmodel = Pix2Pix4DepthModel(opt)
+    BoostingMonocularDepth.run.pix2pixmodel.save_dir = os.path.join(boost_path, "pix2pix", "checkpoints", "mergemodel")
+    BoostingMonocularDepth.run.pix2pixmodel.load_networks('latest')
+    BoostingMonocularDepth.run.pix2pixmodel.eval()
+
+    # The depth estimation network, depthNet 0 of the official repo
+    midas_model_path = os.path.join(boost_path, "midas", "model.pt")
+    BoostingMonocularDepth.run.midasmodel = MidasNet(midas_model_path, non_negative=True)
+    BoostingMonocularDepth.run.midasmodel.to(device)
+    BoostingMonocularDepth.run.midasmodel.eval()
+    return BoostingMonocularDepth.run
+
+
+# The models of the process
+registry = ModelRegistry()
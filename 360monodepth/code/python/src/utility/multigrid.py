@@ -0,0 +1,171 @@
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+
+from logger import Logger
+
+log = Logger(__name__)
+log.logger.propagate = False
+
+
+def erp_interpolation_matrix(size, periodic):
+    """The 1D linear interpolation from the coarse grid to the fine grid.
+
+    The even fine points are the coarse points, the odd fine points are the mean of the two neighbour coarse points.
+    The ERP longitude is periodic, the last odd column interpolates with the coarse column 0.
+    The latitude is not, the last odd row next to the pole copies the last coarse row.
+
+    :param size: The fine grid size.
+    :type size: int
+    :param periodic: The grid wraps around.
+    :type periodic: bool
+    :return: The interpolation matrix, [size, coarse size].
+    :rtype: scipy.sparse.csr_matrix
+    """
+    coarse_size = (size + 1) // 2
+    fine_index = np.arange(size)
+    coarse_index = fine_index // 2
+    odd = fine_index % 2 == 1
+    next_index = coarse_index + 1
+    if periodic:
+        next_index = np.remainder(next_index, coarse_size)
+        has_next = odd
+    else:
+        has_next = odd & (next_index < coarse_size)
+
+    rows = np.concatenate((fine_index, fine_index[has_next]))
+    cols = np.concatenate((coarse_index, next_index[has_next]))
+    data = np.concatenate((np.where(has_next, 0.5, 1.0), np.full(np.count_nonzero(has_next), 0.5)))
+    return scipy.sparse.csr_matrix((data, (rows, cols)), shape=(size, coarse_size))
+
+
+class MultigridSolver:
+    """Geometric multigrid solver of the symmetric positive definite systems on the ERP image grid.
+
+    The unknowns are the ERP pixels in row-major order. The grid is coarsened by 2 in both directions with the
+    longitude wrap around and the pole rows kept as boundary, the coarse matrices are the Galerkin products
+    P^T A P, and the coarsest system is factorized.
+    The V-cycles with the damped Jacobi smoother precondition the conjugate gradient, and a warm start initial
+    guess reduces the V-cycles number.
+    """
+
+    def __init__(self, A, erp_size, coarsest_size=16, pre_smooth=2, post_smooth=2, omega=0.8):
+        """
+        :param A: The system matrix, [rows * cols, rows * cols].
+        :type A: scipy.sparse.csr_matrix
+        :param erp_size: The ERP image size, [rows, cols].
+        :type erp_size: tuple
+        :param coarsest_size: Stop coarsening when the grid height is not larger than it.
+        :type coarsest_size: int
+        :param pre_smooth: The smoothing iterations before the coarse grid correction.
+        :type pre_smooth: int
+        :param post_smooth: The smoothing iterations after the coarse grid correction.
+        :type post_smooth: int
+        :param omega: The Jacobi damping factor.
+        :type omega: float
+        """
+        rows, cols = erp_size
+        if A.shape[0] != rows * cols:
+            log.error("The matrix size {} does not match the ERP image size {}.".format(A.shape, erp_size))
+        self.pre_smooth = pre_smooth
+        self.post_smooth = post_smooth
+        self.omega = omega
+        self.cycle_number = 0  # the V-cycles of the last solve
+        self.residual = 0.0  # the relative residual of the last solve
+
+        # the matrix, the damped inverse diagonal and the interpolation to the level of each level
+        self.matrices = [A.tocsr()]
+        self.inv_diagonals = [omega / self.matrices[0].diagonal()]
+        self.interpolations = []
+        while rows > coarsest_size and cols > coarsest_size:
+            interpolation = scipy.sparse.kron(erp_interpolation_matrix(rows, False),
+                                              erp_interpolation_matrix(cols, True)).tocsr()
+            coarse_matrix = (interpolation.T @ self.matrices[-1] @ interpolation).tocsr()
+            self.interpolations.append(interpolation)
+            self.matrices.append(coarse_matrix)
+            self.inv_diagonals.append(omega / coarse_matrix.diagonal())
+            rows, cols = (rows + 1) // 2, (cols + 1) // 2
+        self.coarsest_solver = scipy.sparse.linalg.splu(self.matrices[-1].tocsc())
+        # the nonzeros and the bytes of the level matrices, the interpolations and the coarsest factors
+        self.nnz = sum(matrix.nnz for matrix in self.matrices + self.interpolations) + \
+            self.coarsest_solver.L.nnz + self.coarsest_solver.U.nnz
+        self.memory = sum(matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+                          for matrix in self.matrices + self.interpolations) + \
+            (self.coarsest_solver.L.nnz + self.coarsest_solver.U.nnz) * 12
+        log.debug("Multigrid with {} levels, the coarsest grid is {}x{}.".format(len(self.matrices), rows, cols))
+
+    def smooth(self, level, x, b, iterations):
+        inv_diagonal = self.inv_diagonals[level].reshape((-1,) + (1,) * (x.ndim - 1))
+        for _ in range(iterations):
+            x += inv_diagonal * (b - self.matrices[level] @ x)
+        return x
+
+    def v_cycle(self, level, x, b):
+        """One V-cycle from the level, the x is updated in place."""
+        if level == len(self.matrices) - 1:
+            x[:] = self.coarsest_solver.solve(b)
+            return x
+
+        self.smooth(level, x, b, self.pre_smooth)
+        residual = b - self.matrices[level] @ x
+        interpolation = self.interpolations[level]
+        coarse_correction = self.v_cycle(level + 1, np.zeros((interpolation.shape[1],) + b.shape[1:]),
+                                         interpolation.T @ residual)
+        x += interpolation @ coarse_correction
+        self.smooth(level, x, b, self.post_smooth)
+        return x
+
+    def precondition(self, r):
+        """Apply one V-cycle to the residual from the zero initial guess."""
+        return self.v_cycle(0, np.zeros_like(r), r)
+
+    def solve(self, b, x0=None, tol=1e-05, max_cycles=100):
+        """Solve A x = b with the V-cycle preconditioned conjugate gradient.
+
+        Each iteration applies one V-cycle, it's symmetric as the pre- and post-smoothing are the same Jacobi
+        iterations, and converges in a few iterations from a close initial guess.
+
+        :param b: The right-hand side, [n] or [n, k] for several right-hand sides.
+        :type b: numpy
+        :param x0: The initial guess, e.g. the frustum blended image or the previous frame, defaults to 0.
+        :type x0: numpy, optional
+        :param tol: The relative residual tolerance of each right-hand side.
+        :type tol: float
+        :param max_cycles: The maximum V-cycles number.
+        :type max_cycles: int
+        :return: The solution, the same shape as b.
+        :rtype: numpy
+        """
+        b = np.asarray(b, np.float64)
+        x = np.zeros_like(b) if x0 is None else np.array(x0, np.float64).reshape(b.shape)
+        # the per right-hand side scalars are computed on the columns
+        b_2d = b.reshape(b.shape[0], -1)
+        x_2d = x.reshape(b_2d.shape)
+
+        A = self.matrices[0]
+        r = b_2d - A @ x_2d
+        z = self.precondition(r)
+        p = z.copy()
+        rz = np.einsum("ij,ij->j", r, z)
+        b_norm = np.linalg.norm(b_2d, axis=0)
+        b_norm = np.where(b_norm > 0, b_norm, 1.0)
+        self.cycle_number = 0
+        residual = np.linalg.norm(r, axis=0) / b_norm
+        # the converged right-hand sides, e.g. the zero ones, are not updated anymore
+        active = residual > tol
+        while np.any(active) and self.cycle_number < max_cycles:
+            Ap = A @ p
+            alpha = np.where(active, rz / np.where(active, np.einsum("ij,ij->j", p, Ap), 1.0), 0.0)
+            x_2d += alpha * p
+            r -= alpha * Ap
+            z = self.precondition(r)
+            rz_new = np.einsum("ij,ij->j", r, z)
+            residual = np.linalg.norm(r, axis=0) / b_norm
+            active &= residual > tol
+            beta = np.where(active, rz_new / np.where(active, rz, 1.0), 0.0)
+            p = z + beta * p
+            rz = rz_new
+            self.cycle_number += 1
+        self.residual = np.max(residual)
+        log.debug("Multigrid {} V-cycles, relative residual {:.3e}.".format(self.cycle_number, self.residual))
+        return x
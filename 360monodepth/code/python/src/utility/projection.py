@@ -0,0 +1,61 @@
+import numpy as np
+
+import projection_icosahedron as proj_ico
+import projection_cubemap as proj_cube
+
+from logger import Logger
+
+log = Logger(__name__)
+log.logger.propagate = False
+
+"""
+Select the tangent faces projection of the ERP image by name:
+- "icosahedron": the 20 triangle faces of the icosahedron, the default and best quality;
+- "cubemap": the 6 square faces of the cube, a faster and lower quality pipeline, see projection_cubemap.
+"""
+
+# The supported projections
+PROJECTIONS = ["icosahedron", "cubemap"]
+
+
+def check_projection(projection):
+    if projection not in PROJECTIONS:
+        log.error("The projection {} is not supported.".format(projection))
+
+
+def face_number(projection):
+    """The tangent faces number of the projection."""
+    check_projection(projection)
+    return 20 if projection == "icosahedron" else proj_cube.FACE_NUMBER
+
+
+def reference_face(projection):
+    """The face whose parameters are the intrinsic parameters of all faces, and whose alignment coefficients are fixed
+    when the scale term is not used."""
+    check_projection(projection)
+    return 7 if projection == "icosahedron" else 2
+
+
+def get_face_parameters(projection, face_index, padding_size=0.0):
+    """The tangent face's parameters, see projection_icosahedron.get_icosahedron_parameters."""
+    check_projection(projection)
+    if projection == "icosahedron":
+        return proj_ico.get_icosahedron_parameters(face_index, padding_size)
+    return proj_cube.get_cubemap_parameters(face_index, padding_size)
+
+
+def erp2face_image(projection, erp_image, tangent_image_width, padding_size=0.0, full_face_image=False,
+                   dtype=np.float64):
+    """Project the equirectangular image to the tangent images, see projection_icosahedron.erp2ico_image."""
+    check_projection(projection)
+    if projection == "icosahedron":
+        return proj_ico.erp2ico_image(erp_image, tangent_image_width, padding_size, full_face_image, dtype)
+    return proj_cube.erp2cubemap_image(erp_image, tangent_image_width, padding_size, full_face_image, dtype)
+
+
+def face2erp_image(projection, tangent_images, erp_image_height, padding_size=0.0, blender_method=None):
+    """Stitch the tangent images to ERP image, see projection_icosahedron.ico2erp_image."""
+    check_projection(projection)
+    if projection == "icosahedron":
+        return proj_ico.ico2erp_image(tangent_images, erp_image_height, padding_size, blender_method)
+    return proj_cube.cubemap2erp_image(tangent_images, erp_image_height, padding_size, blender_method)
@@ -0,0 +1,289 @@
+import numpy as np
+from scipy import ndimage
+
+import gnomonic_projection as gp
+import spherical_coordinates as sc
+import polygon
+from face_tensor import FaceTensor
+
+from logger import Logger
+
+log = Logger(__name__)
+log.logger.propagate = False
+
+"""
+Implement cubemap projection and stitch with the Gnomonic projection, the same interfaces as the icosahedron's.
+
+The 6 square faces cost less than a third of the icosahedron's 20 faces in the monocular depth estimation,
+the alignment and the blending. The trade-off is quality:
+- each face covers 90 degrees plus the padding, so the face borders are stretched more by the gnomonic projection,
+  about 2x in length at the unpadded corners, and the monocular depth is less accurate there;
+- the faces overlap in narrow bands along the cube's edges only, with fewer pixel correspondences and
+  alignment constraints between the faces, so the disparity scales are less consistent;
+- each face's alignment coefficient grid covers a larger field of view, so the grid is coarser on the sphere.
+Use it for previews and large batches when the throughput matters more than the seams.
+"""
+
+# the cubemap's face number
+FACE_NUMBER = 6
+
+
+def get_cubemap_parameters(face_index, padding_size=0.0):
+    """
+    Get the cubemap's tangent face's parameters.
+    The faces 0 to 3 are tangent on the equator at longitude -pi, -pi/2, 0 and pi/2, the face 4 is tangent at the
+    north pole and the face 5 at the south pole.
+    The face is the square [-1, 1] x [-1, 1] in the gnomonic coordinate, the padding enlarges it in all directions.
+
+    :return the tangent face's tangent point, 4 vertices's location and bounding box, the same keys as the
+        icosahedron's, the "triangle_points_*" are the square's vertices.
+    """
+    if 0 <= face_index <= 3:
+        theta_0 = -np.pi + face_index * np.pi / 2.0
+        phi_0 = 0.0
+    elif face_index == 4:
+        theta_0 = 0.0
+        phi_0 = np.pi / 2.0
+    elif face_index == 5:
+        theta_0 = 0.0
+        phi_0 = -np.pi / 2.0
+    else:
+        log.error("The cubemap face index {} is out of range.".format(face_index))
+    tangent_point = [theta_0, phi_0]
+
+    # the 4 vertices in tangent image's gnomonic coordinate, clockwise
+    square_points_tangent_no_padding = [[-1.0, -1.0], [-1.0, 1.0], [1.0, 1.0], [1.0, -1.0]]
+    square_points_tangent = polygon.enlarge_polygon(square_points_tangent_no_padding, padding_size)
+
+    # the points in spherical location
+    square_points_sph = []
+    for square_point_x, square_point_y in square_points_tangent:
+        square_point_theta, square_point_phi = gp.reverse_gnomonic_projection(square_point_x, square_point_y,
+                                                                              theta_0, phi_0)
+        square_points_sph.append([square_point_theta, square_point_phi])
+
+    # the side faces' latitude extremes are the edges' middle points, sample the whole boundary of the face
+    half_size = abs(square_points_tangent[0][0])
+    edge = np.linspace(-half_size, half_size, 65)
+    boundary_x = np.concatenate((edge, np.full_like(edge, half_size), edge, np.full_like(edge, -half_size)))
+    boundary_y = np.concatenate((np.full_like(edge, half_size), edge, np.full_like(edge, -half_size), edge))
+    boundary_theta, boundary_phi = gp.reverse_gnomonic_projection(boundary_x, boundary_y, theta_0, phi_0)
+
+    # the bounding box of the face with spherical coordinate, the longitude is continuous around the tangent point
+    # [min_longitude, max_longitude, max_latitude, min_latitude], the ERP Y axis direction as down
+    if face_index == 4:
+        availied_ERP_area_sph = [-np.pi, np.pi, np.pi / 2.0, np.amin(boundary_phi)]
+    elif face_index == 5:
+        availied_ERP_area_sph = [-np.pi, np.pi, np.amax(boundary_phi), -np.pi / 2.0]
+    else:
+        availied_ERP_area_sph = [np.amin(boundary_theta), np.amax(boundary_theta),
+                                 np.amax(boundary_phi), np.amin(boundary_phi)]
+
+    return {"tangent_point": tangent_point, "triangle_points_tangent": square_points_tangent,
+            "triangle_points_sph": square_points_sph,
+            "triangle_points_tangent_nopad": square_points_tangent_no_padding,
+            "availied_ERP_area": availied_ERP_area_sph}
+
+
+def erp2cubemap_image(erp_image, tangent_image_width, padding_size=0.0, full_face_image=False, dtype=np.float64):
+    """Project the equirectangular image to 6 square images.
+
+    The same interface as projection_icosahedron.erp2ico_image. The faces are squares, so all pixels of the face
+    images are in the face whether full_face_image or not.
+
+    :param erp_image: the input equirectangular image, RGB image should be 3 channel [H,W,3], depth map' shape should be [H,W].
+    :type erp_image: numpy array, [height, width, 3]
+    :param tangent_image_width: the output square image size.
+    :type tangent_image_width: int
+    :param padding_size: the output face image' padding size
+    :type padding_size: float
+    :param full_face_image: unused, for the same interface as the icosahedron's.
+    :type full_face_image: bool, optional
+    :param dtype: the tangent images and gnomonic coordinates data type, defaults to float64
+    :type dtype: numpy.dtype, optional
+    :return: 1) a FaceTensor contain 6 square images, or depth maps in tangent coordinate system if erp is depth map;
+             2) each face pixels' spherical coordinate;
+             3) the 3D point cloud of each face in tangent coordinate system if erp is depth map, and the face
+                pixels' gnomonic coordinate.
+    :rtype: tuple
+    """
+    depthmap_enable = False
+    if len(erp_image.shape) == 3:
+        if np.shape(erp_image)[2] == 4:
+            log.info("project ERP image is 4 channels RGB map")
+            erp_image = erp_image[:, :, 0:3]
+        log.info("project ERP image 3 channels RGB map")
+    elif len(erp_image.shape) == 2:
+        log.info("project ERP image is single channel depth map")
+        erp_image = np.expand_dims(erp_image, axis=2)
+        depthmap_enable = True
+
+    erp_image_height, erp_image_width, channel_number = np.shape(erp_image)
+    if erp_image_width != erp_image_height * 2:
+        raise Exception("the ERP image dimession is {}".format(np.shape(erp_image)))
+
+    tangent_3dpoints_list = []
+    tangent_sphcoor_list = []
+    tangent_image_metadata = []
+
+    tangent_image_height = tangent_image_width
+    tangent_images = np.full([FACE_NUMBER, tangent_image_height, tangent_image_width, channel_number],
+                             -1.0 if depthmap_enable else 255.0, dtype)
+
+    # all faces have the same gnomonic coordinate range
+    square_points_tangent = np.array(get_cubemap_parameters(0, padding_size)["triangle_points_tangent"])
+    gnomonic_x_min, gnomonic_y_min = np.amin(square_points_tangent, axis=0)
+    gnomonic_x_max, gnomonic_y_max = np.amax(square_points_tangent, axis=0)
+    tangent_gnomonic_range = [gnomonic_x_min, gnomonic_x_max, gnomonic_y_min, gnomonic_y_max]
+    gnom_range_x = np.linspace(gnomonic_x_min, gnomonic_x_max, num=tangent_image_width, endpoint=True)
+    gnom_range_y = np.linspace(gnomonic_y_max, gnomonic_y_min, num=tangent_image_height, endpoint=True)
+    gnom_range_xv, gnom_range_yv = np.meshgrid(gnom_range_x, gnom_range_y)
+
+    for face_index in range(0, FACE_NUMBER):
+        log.debug("generate the tangent image {}".format(face_index))
+        tangent_point = get_cubemap_parameters(face_index, padding_size)["tangent_point"]
+        tangent_theta, tangent_phi = gp.reverse_gnomonic_projection(gnom_range_xv, gnom_range_yv,
+                                                                    tangent_point[0], tangent_point[1])
+        tangent_sphcoor_list.append(np.stack((tangent_theta, tangent_phi)))
+
+        # get the tangent image pixels value
+        tangent_erp_pixel_x, tangent_erp_pixel_y = sc.sph2erp(tangent_theta, tangent_phi, erp_image_height,
+                                                              sph_modulo=True)
+        # the pole is the center of the faces 4 and 5, the rows out of the ERP image are not wrapped to the other pole
+        np.clip(tangent_erp_pixel_y, 0, erp_image_height - 1, out=tangent_erp_pixel_y)
+        tangent_image = tangent_images[face_index]
+        for channel in range(0, channel_number):
+            tangent_image[:, :, channel] = ndimage.map_coordinates(
+                erp_image[:, :, channel], [tangent_erp_pixel_y, tangent_erp_pixel_x], order=1, mode='wrap', cval=255.0)
+
+        # if the ERP image is depth map, get camera coordinate system 3d points
+        tangent_3dpoints = None
+        if depthmap_enable:
+            # convert the spherical depth map value to tangent image coordinate depth value
+            center2pixel_length = np.sqrt(np.square(gnom_range_xv) + np.square(gnom_range_yv) + 1.0)
+            tangent_image /= center2pixel_length[:, :, None].astype(dtype, copy=False)
+            tangent_3dpoints_x = tangent_image * gnom_range_xv[:, :, None]
+            tangent_3dpoints_y = tangent_image * gnom_range_yv[:, :, None]
+            tangent_3dpoints = np.concatenate([tangent_3dpoints_x, -tangent_3dpoints_y, tangent_image], axis=2)
+
+        tangent_3dpoints_list.append(tangent_3dpoints)
+        tangent_image_metadata.append({"tangent_point": tangent_point, "gnomonic_range": tangent_gnomonic_range})
+
+    tangent_image_gnomonic_xy = [gnom_range_xv.astype(dtype), gnom_range_yv.astype(dtype)]
+    tangent_image_list = FaceTensor(tangent_images, metadata=tangent_image_metadata)
+    return tangent_image_list, tangent_sphcoor_list, [tangent_3dpoints_list, tangent_image_gnomonic_xy]
+
+
+def cubemap2erp_image(tangent_images, erp_image_height, padding_size=0.0, blender_method=None):
+    """Stitch the cubemap's tangent images to ERP image.
+
+    The same interface as projection_icosahedron.ico2erp_image.
+    blender_method:
+        - None: just sample the face area without padding, each ERP pixel from one face;
+        - Mean: the mean value on the overlap area.
+
+    :param tangent_images: 6 tangent images in order.
+    :type tangent_images: a list of numpy
+    :param erp_image_height: the output erp image's height.
+    :type erp_image_height: int
+    :param padding_size: the face image's padding size
+    :type padding_size: float
+    :param blender_method: the method used to blend sub-images.
+    :type blender_method: str
+    :return: the stitched ERP image
+    :type numpy
+    """
+    if len(tangent_images) != FACE_NUMBER:
+        log.error("The tangent's images square number is {}.".format(len(tangent_images)))
+
+    if len(tangent_images[0].shape) == 3:
+        images_channels_number = tangent_images[0].shape[2]
+        if images_channels_number == 4:
+            log.debug("the face image is RGBA image, convert the output to RGB image.")
+            images_channels_number = 3
+    elif len(tangent_images[0].shape) == 2:
+        log.info("project single channel disp or depth map")
+        images_channels_number = 1
+
+    erp_image_width = erp_image_height * 2
+    erp_image = np.full([erp_image_height, erp_image_width, images_channels_number], 0, np.float64)
+    erp_weight_mat = np.zeros((erp_image_height, erp_image_width), dtype=np.float64)
+
+    tangent_image_height = tangent_images[0].shape[0]
+    tangent_image_width = tangent_images[0].shape[1]
+
+    for face_index in range(0, FACE_NUMBER):
+        log.debug("stitch the tangent image {}".format(face_index))
+        face_param = get_cubemap_parameters(face_index, padding_size)
+
+        # 1) get the face's available pixels coordinate
+        availied_ERP_area = face_param["availied_ERP_area"]
+        erp_image_col_start, erp_image_row_start = sc.sph2erp(availied_ERP_area[0], availied_ERP_area[2],
+                                                              erp_image_height, sph_modulo=False)
+        erp_image_col_stop, erp_image_row_stop = sc.sph2erp(availied_ERP_area[1], availied_ERP_area[3],
+                                                            erp_image_height, sph_modulo=False)
+        erp_image_col_start = int(np.floor(erp_image_col_start))
+        erp_image_col_stop = int(np.ceil(erp_image_col_stop))
+        erp_image_row_start = max(int(np.floor(erp_image_row_start)), 0)
+        erp_image_row_stop = min(int(np.ceil(erp_image_row_stop)), erp_image_height - 1)
+
+        # each ERP pixel once, the longitude wraps around and the pole faces cover all columns
+        if erp_image_col_stop - erp_image_col_start + 1 >= erp_image_width:
+            face_x_range = np.arange(0, erp_image_width)
+        else:
+            face_x_range = np.remainder(np.arange(erp_image_col_start, erp_image_col_stop + 1), erp_image_width)
+        face_y_range = np.arange(erp_image_row_start, erp_image_row_stop + 1)
+        face_xv, face_yv = np.meshgrid(face_x_range, face_y_range)
+
+        # 2) project spherical coordinate to tangent plane
+        spherical_uv = sc.erp2sph([face_xv, face_yv], erp_image_height=erp_image_height, sph_modulo=False)
+        theta_0, phi_0 = face_param["tangent_point"]
+        tangent_xv, tangent_yv = gp.gnomonic_projection(spherical_uv[0, :, :], spherical_uv[1, :, :], theta_0, phi_0)
+
+        square_points_tangent = np.array(face_param["triangle_points_tangent"])
+        gnomonic_x_min, gnomonic_y_min = np.amin(square_points_tangent, axis=0)
+        gnomonic_x_max, gnomonic_y_max = np.amax(square_points_tangent, axis=0)
+        tangent_gnomonic_range = [gnomonic_x_min, gnomonic_x_max, gnomonic_y_min, gnomonic_y_max]
+
+        # the squares are axis aligned, the ERP pixels in the face without padding or the padded face
+        if blender_method is None:
+            face_half_size = abs(face_param["triangle_points_tangent_nopad"][0][0])
+        elif blender_method == "mean":
+            face_half_size = abs(square_points_tangent[0][0])
+        else:
+            log.error("The blender method {} is not supported.".format(blender_method))
+        pixel_eps = (gnomonic_x_max - gnomonic_x_min) / (2 * tangent_image_width)
+        available_pixels_list = np.logical_and(np.abs(tangent_xv) <= face_half_size + pixel_eps,
+                                               np.abs(tangent_yv) <= face_half_size + pixel_eps)
+
+        tangent_xv, tangent_yv = gp.gnomonic2pixel(tangent_xv[available_pixels_list], tangent_yv[available_pixels_list],
+                                                   0.0, tangent_image_width, tangent_image_height,
+                                                   tangent_gnomonic_range)
+        erp_yv = face_yv[available_pixels_list]
+        erp_xv = face_xv[available_pixels_list]
+
+        if len(tangent_images[0].shape) == 2:
+            tangent_images_subimage = np.expand_dims(tangent_images[face_index], axis=2)
+        else:
+            tangent_images_subimage = tangent_images[face_index]
+
+        for channel in range(0, images_channels_number):
+            erp_face_image = ndimage.map_coordinates(tangent_images_subimage[:, :, channel], [tangent_yv, tangent_xv],
+                                                     order=1, mode='nearest')
+            if blender_method is None:
+                erp_image[erp_yv, erp_xv, channel] = erp_face_image
+            else:
+                erp_image[erp_yv, erp_xv, channel] += erp_face_image
+        if blender_method == "mean":
+            erp_weight_mat[erp_yv, erp_xv] += 1.0
+
+    # compute the mean of the overlap area base on weight
+    if blender_method == "mean":
+        non_zero_weight_list = erp_weight_mat != 0
+        if not np.all(non_zero_weight_list):
+            log.warn("the weight matrix contain 0.")
+        for channel_index in range(0, images_channels_number):
+            erp_image[:, :, channel_index][non_zero_weight_list] = \
+                erp_image[:, :, channel_index][non_zero_weight_list] / erp_weight_mat[non_zero_weight_list]
+
+    return erp_image
@@ -5,6 +5,7 @@ from scipy import ndimage
 import gnomonic_projection as gp
 import spherical_coordinates as sc
 import polygon
+from face_tensor import FaceTensor
 
 from logger import Logger
 
@@ -207,7 +208,7 @@ def get_icosahedron_parameters(triangle_index, padding_size=0.0):
             "triangle_points_tangent_nopad": triangle_points_tangent_no_pading, "availied_ERP_area": availied_ERP_area_sph}
 
 
-def erp2ico_image(erp_image, tangent_image_width, padding_size=0.0, full_face_image=False):
+def erp2ico_image(erp_image, tangent_image_width, padding_size=0.0, full_face_image=False, dtype=np.float64):
     """Project the equirectangular image to 20 triangle images.
 
     Project the equirectangular image to level-0 icosahedron.
@@ -220,15 +221,17 @@ def erp2ico_image(erp_image, tangent_image_width, padding_size=0.0, full_face_im
     :type padding_size: float
     :param full_face_image: If yes project all pixels in the face image, no just project the pixels in the face triangle, defaults to False
     :type full_face_image: bool, optional
+    :param dtype: the tangent images and gnomonic coordinates data type, defaults to float64
+    :type dtype: numpy.dtype, optional
     :param depthmap_enable: if project depth map, return the each pixel's 3D points location in current camera coordinate system.
     :type depthmap_enable: bool
     :return: If erp is rgb image:
-                1) a list contain 20 triangle images, the image is 4 channels, invalided pixel's alpha is 0, others is 1.
+                1) a FaceTensor contain 20 triangle images, the image is 4 channels, invalided pixel's alpha is 0, others is 1.
                 2)
                 3) None.
     
             If erp is depth map:
-                1) a list contain 20 triangle images depth maps in tangent coordinate system.  The subimage's depth is 3D point could depth value.
+                1) a FaceTensor contain 20 triangle images depth maps in tangent coordinate system.  The subimage's depth is 3D point could depth value.
                 2) 
                 3) 3D point cloud in tangent coordinate system. The pangent point cloud coordinate system is same as the world coordinate system. +y down, +x right and +z forward.
     :rtype: 
@@ -257,12 +260,14 @@ def erp2ico_image(erp_image, tangent_image_width, padding_size=0.0, full_face_im
     if erp_image_width != erp_image_height * 2:
         raise Exception("the ERP image dimession is {}".format(np.shape(erp_image)))
 
-    tangent_image_list = []
     tangent_image_gnomonic_xy = [] # [x[height, width], y[height, width]]
     tangent_3dpoints_list = []
     tangent_sphcoor_list = []
+    tangent_image_metadata = []
 
     tangent_image_height = int((tangent_image_width / 2.0) / np.tan(np.radians(30.0)) + 0.5)
+    tangent_images = np.full([20, tangent_image_height, tangent_image_width, channel_number],
+                             -1.0 if depthmap_enable else 255.0, dtype)
 
     # generate tangent images
     for triangle_index in range(0, 20):
@@ -303,10 +308,7 @@ def erp2ico_image(erp_image, tangent_image_width, padding_size=0.0, full_face_im
         tangent_image_x, tangent_image_y = gp.gnomonic2pixel(gnom_range_xv[inside_list], gnom_range_yv[inside_list],
                                                              0.0, tangent_image_width, tangent_image_height, tangent_gnomonic_range)
 
-        if depthmap_enable:
-            tangent_image = np.full([tangent_image_height, tangent_image_width, channel_number], -1.0)
-        else:
-            tangent_image = np.full([tangent_image_height, tangent_image_width, channel_number], 255.0)
+        tangent_image = tangent_images[triangle_index]
         for channel in range(0, np.shape(erp_image)[2]):
             tangent_image[tangent_image_y, tangent_image_x, channel] = \
                 ndimage.map_coordinates(erp_image[:, :, channel], [tangent_triangle_erp_pixel_y, tangent_triangle_erp_pixel_x], order=1, mode='wrap', cval=255.0)
@@ -316,9 +318,9 @@ def erp2ico_image(erp_image, tangent_image_width, padding_size=0.0, full_face_im
         if depthmap_enable:
             # convert the spherical depth map value to tangent image coordinate depth value  
             center2pixel_length = np.sqrt(np.square(gnom_range_xv[inside_list])  + np.square(gnom_range_yv[inside_list]) + np.ones_like(gnom_range_yv[inside_list]))
-            center2pixel_length = center2pixel_length.reshape((tangent_image_height, tangent_image_width, channel_number))
+            center2pixel_length = center2pixel_length.reshape((tangent_image_height, tangent_image_width, channel_number)).astype(dtype, copy=False)
             tangent_3dpoints_z = np.divide(tangent_image , center2pixel_length)
-            tangent_image = tangent_3dpoints_z
+            tangent_image[:] = tangent_3dpoints_z
 
             # get x and y
             tangent_3dpoints_x = np.multiply(tangent_3dpoints_z , gnom_range_xv[inside_list].reshape((tangent_image_height, tangent_image_width, channel_number)))
@@ -328,15 +330,16 @@ def erp2ico_image(erp_image, tangent_image_width, padding_size=0.0, full_face_im
         # set the pixels outside the boundary to transparent
         # tangent_image[:, :, 3] = 0
         # tangent_image[tangent_image_y, tangent_image_x, 3] = 255
-        tangent_image_list.append(tangent_image)
         tangent_3dpoints_list.append(tangent_3dpoints)
+        tangent_image_metadata.append({"tangent_point": tangent_point, "gnomonic_range": tangent_gnomonic_range})
 
     # get the tangent image's gnomonic coordinate
-    tangent_image_gnomonic_x = gnom_range_xv[inside_list].reshape((tangent_image_height, tangent_image_width))
+    tangent_image_gnomonic_x = gnom_range_xv[inside_list].reshape((tangent_image_height, tangent_image_width)).astype(dtype)
     tangent_image_gnomonic_xy.append(tangent_image_gnomonic_x)
-    tangent_image_gnomonic_y = gnom_range_yv[inside_list].reshape((tangent_image_height, tangent_image_width))
+    tangent_image_gnomonic_y = gnom_range_yv[inside_list].reshape((tangent_image_height, tangent_image_width)).astype(dtype)
     tangent_image_gnomonic_xy.append(tangent_image_gnomonic_y)
 
+    tangent_image_list = FaceTensor(tangent_images, metadata=tangent_image_metadata)
     return tangent_image_list, tangent_sphcoor_list, [tangent_3dpoints_list, tangent_image_gnomonic_xy]
 
 
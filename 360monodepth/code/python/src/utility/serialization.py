@@ -4,6 +4,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 
 import metrics
+import depthmap_utils
 import json
 import os
 import pickle
@@ -337,6 +338,21 @@ def save_metrics(output_file, pred_metrics, times, times_header, idx, blending_m
     f.close()
 
 
+def save_progressive(output_folder, estimated_depthmap, persp_monodepth, idx=0):
+    """Output the progressive preview of the ERP disparity maps, before the full pipeline refines it.
+
+    Each blending method's disparity map is written to a pfm file and the visualized png file.
+
+    :param estimated_depthmap: The disparity maps of each blending method, e.g. {"preview": numpy}.
+    :type estimated_depthmap: dict
+    """
+    for key in estimated_depthmap.keys():
+        filename = os.path.join(output_folder, "{:03}_360monodepth_{}_{}".format(idx, persp_monodepth, key))
+        depthmap_utils.write_pfm(filename + ".pfm", estimated_depthmap[key].astype(np.float32), scale=1)
+        plt.imsave(filename + ".png", estimated_depthmap[key], cmap="turbo")
+        log.info("Output the {} disparity map to {}.pfm".format(key, filename))
+
+
 def save_predictions(output_folder, erp_gt_depthmap, erp_rgb_image_data, estimated_depthmap, persp_monodepth, idx=0):
     # Plot error maps
     vmax = None
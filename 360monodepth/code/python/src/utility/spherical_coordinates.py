@@ -5,6 +5,46 @@ from logger import Logger
 log = Logger(__name__)
 log.logger.propagate = False
 
+
+def float_dtype(*arrays):
+    """The floating result type of the inputs, float32 inputs keep float32."""
+    return np.result_type(*[np.asarray(array) for array in arrays], 1.0)
+
+
+def output_buffers(out, number, shape, *arrays):
+    """Return the `out` buffers, or allocate `number` buffers with the inputs' floating result type.
+
+    The kernels below write the intermediate results into these buffers in place, to avoid the full size temporaries.
+    """
+    if out is not None:
+        return out
+    buffers = np.empty((number,) + tuple(shape), float_dtype(*arrays))
+    return tuple(buffers[index, ...] for index in range(number))
+
+
+def check_out_overlap(out, inputs, in_place=True):
+    """Error when an `out` buffer overlaps an input array that the kernel reads after writing the buffer.
+
+    :param out: the output buffers.
+    :type out: tuple
+    :param inputs: the input arrays, in the order of their output buffers.
+    :type inputs: tuple
+    :param in_place: the i-th output buffer can be the i-th input, the kernel reads it before writing the buffer.
+    :type in_place: bool
+    """
+    for out_index, buffer in enumerate(out):
+        for input_index, array in enumerate(inputs):
+            if in_place and out_index == input_index:
+                continue
+            if isinstance(array, np.ndarray) and np.may_share_memory(buffer, array):
+                log.error("The out buffer {} overlaps the input array {}.".format(out_index, input_index))
+
+
+def scalar_output(array):
+    """Convert the 0-d output of scalar inputs to numpy scalar."""
+    return array[()] if array.ndim == 0 else array
+
+
 def great_circle_distance_uv(points_1_theta, points_1_phi, points_2_theta, points_2_phi, radius=1):
     """
     @see great_circle_distance (haversine distances )
@@ -55,15 +95,30 @@ def erp_pixel_modulo(x_arrray, y_array, image_height):
     return x_arrray_new, y_array_new
 
 
-def erp_sph_modulo(theta, phi):
+def erp_sph_modulo(theta, phi, out=None):
     """Modulo of the spherical coordinate for the erp coordinate.
+
+    :param out: the output (theta, phi) buffers, can be the input arrays to modulo in place.
+    :type out: tuple, optional
     """
-    points_theta = np.remainder(theta + np.pi, 2 * np.pi) - np.pi
-    points_phi = -(np.remainder(-phi + 0.5 * np.pi, np.pi) - 0.5 * np.pi)
+    if out is not None:
+        check_out_overlap(out, (theta, phi))
+    points_theta, points_phi = output_buffers(out, 2, np.broadcast_shapes(np.shape(theta), np.shape(phi)), theta, phi)
+    np.add(theta, np.pi, out=points_theta)
+    np.remainder(points_theta, 2 * np.pi, out=points_theta)
+    np.subtract(points_theta, np.pi, out=points_theta)
+
+    np.negative(phi, out=points_phi)
+    np.add(points_phi, 0.5 * np.pi, out=points_phi)
+    np.remainder(points_phi, np.pi, out=points_phi)
+    np.subtract(points_phi, 0.5 * np.pi, out=points_phi)
+    np.negative(points_phi, out=points_phi)
+    if out is None:
+        return scalar_output(points_theta), scalar_output(points_phi)
     return points_theta, points_phi
 
 
-def erp2sph(erp_points, erp_image_height=None, sph_modulo=False):
+def erp2sph(erp_points, erp_image_height=None, sph_modulo=False, out=None):
     """
     convert the point from erp image pixel location to spherical coordinate.
     The image center is spherical coordinate origin.
@@ -74,6 +129,8 @@ def erp2sph(erp_points, erp_image_height=None, sph_modulo=False):
     :type erp_image_height: int, optional
     :param sph_modulo: if true, process the input points wrap around, .
     :type sph_modulo: bool
+    :param out: the output buffer, size is [2, :], can be the erp_points to convert in place.
+    :type out: numpy, optional
     :return: the spherical coordinate points, theta is in the range [-pi, +pi), and phi is in the range [-pi/2, pi/2)
     :rtype: numpy
     """
@@ -92,16 +149,29 @@ def erp2sph(erp_points, erp_image_height=None, sph_modulo=False):
     erp_points_y = erp_points[1]
 
     # 1) point location to theta and phi
-    points_theta = erp_points_x * (2 * np.pi / width) + np.pi / width - np.pi
-    points_phi = -(erp_points_y * (np.pi / height) + np.pi / height * 0.5) + 0.5 * np.pi
+    if out is None:
+        points_sph = np.empty((2,) + np.shape(erp_points_x), float_dtype(erp_points_x, erp_points_y))
+    else:
+        check_out_overlap((out[0], out[1]), (erp_points_x, erp_points_y))
+        points_sph = out
+    points_theta = points_sph[0, ...]
+    points_phi = points_sph[1, ...]
+    np.multiply(erp_points_x, 2 * np.pi / width, out=points_theta)
+    np.add(points_theta, np.pi / width, out=points_theta)
+    np.subtract(points_theta, np.pi, out=points_theta)
+
+    np.multiply(erp_points_y, np.pi / height, out=points_phi)
+    np.add(points_phi, np.pi / height * 0.5, out=points_phi)
+    np.negative(points_phi, out=points_phi)
+    np.add(points_phi, 0.5 * np.pi, out=points_phi)
 
     if sph_modulo:
-        points_theta, points_phi = erp_sph_modulo(points_theta, points_phi)
+        erp_sph_modulo(points_theta, points_phi, out=(points_theta, points_phi))
 
-    points_theta = np.where(points_theta == np.pi,  -np.pi, points_theta)
-    points_phi = np.where(points_phi == -0.5 * np.pi, 0.5 * np.pi, points_phi)
+    np.copyto(points_theta, -np.pi, where=points_theta == np.pi)
+    np.copyto(points_phi, 0.5 * np.pi, where=points_phi == -0.5 * np.pi)
 
-    return np.stack((points_theta, points_phi))
+    return points_sph
 
 
 def sph2erp_0(sph_points, erp_image_height=None, sph_modulo=False):
@@ -111,7 +181,7 @@ def sph2erp_0(sph_points, erp_image_height=None, sph_modulo=False):
     return np.stack((erp_x, erp_y), axis=0)
 
 
-def sph2erp(theta, phi, erp_image_height, sph_modulo=False):
+def sph2erp(theta, phi, erp_image_height, sph_modulo=False, out=None):
     """ 
     Transform the spherical coordinate location to ERP image pixel location.
 
@@ -123,41 +193,63 @@ def sph2erp(theta, phi, erp_image_height, sph_modulo=False):
     :type image_height: [type]
     :param sph_modulo: if yes process the wrap around case, if no do not.
     :type sph_modulo: bool, optional
+    :param out: the output (erp_x, erp_y) buffers, can be the input arrays to convert in place.
+    :type out: tuple, optional
     :return: the pixel location in the ERP image.
     :rtype: numpy
     """
+    if out is not None:
+        check_out_overlap(out, (theta, phi))
+    erp_x, erp_y = output_buffers(out, 2, np.broadcast_shapes(np.shape(theta), np.shape(phi)), theta, phi)
     if sph_modulo:
-        theta, phi = erp_sph_modulo(theta, phi)
+        theta, phi = erp_sph_modulo(theta, phi, out=(erp_x, erp_y))
 
     erp_image_width = 2 * erp_image_height
-    erp_x = (theta + np.pi) / (2.0 * np.pi / erp_image_width) - 0.5
-    erp_y = (-phi + 0.5 * np.pi) / (np.pi / erp_image_height) - 0.5
+    np.add(theta, np.pi, out=erp_x)
+    np.divide(erp_x, 2.0 * np.pi / erp_image_width, out=erp_x)
+    np.subtract(erp_x, 0.5, out=erp_x)
+
+    np.negative(phi, out=erp_y)
+    np.add(erp_y, 0.5 * np.pi, out=erp_y)
+    np.divide(erp_y, np.pi / erp_image_height, out=erp_y)
+    np.subtract(erp_y, 0.5, out=erp_y)
+    if out is None:
+        return scalar_output(erp_x), scalar_output(erp_y)
     return erp_x, erp_y
 
 
-def car2sph(points_car, min_radius=1e-10):
+def car2sph(points_car, min_radius=1e-10, out=None):
     """
     Transform the 3D point from cartesian to unit spherical coordinate.
 
     :param points_car: The 3D point array, is [point_number, 3], first column is x, second is y, third is z
     :type points_car: numpy
+    :param out: the output buffer, size is [point_number, 2], it does not overlap the points_car.
+    :type out: numpy, optional
     :return: the points spherical coordinate, (theta, phi)
     :rtype: numpy
     """
+    if out is not None:
+        check_out_overlap((out,), (points_car,), in_place=False)
     radius = np.linalg.norm(points_car, axis=1)
 
     valid_list = radius > min_radius  # set the 0 radius to origin.
 
-    theta = np.zeros((points_car.shape[0]), float)
-    theta[valid_list] = np.arctan2(points_car[:, 0][valid_list], points_car[:, 2][valid_list])
+    points_sph = np.empty((points_car.shape[0], 2), float) if out is None else out
+    theta = points_sph[:, 0]
+    phi = points_sph[:, 1]
+    theta.fill(0)
+    np.arctan2(points_car[:, 0], points_car[:, 2], out=theta, where=valid_list)
 
-    phi = np.zeros((points_car.shape[0]), float)
-    phi[valid_list] = -np.arcsin(np.divide(points_car[:, 1][valid_list], radius[valid_list]))
+    phi.fill(0)
+    np.divide(points_car[:, 1], radius, out=phi, where=valid_list)
+    np.arcsin(phi, out=phi, where=valid_list)
+    np.negative(phi, out=phi, where=valid_list)
 
-    return np.stack((theta, phi), axis=1)
+    return points_sph
 
 
-def sph2car(theta, phi, radius=1.0):
+def sph2car(theta, phi, radius=1.0, out=None):
     """
     Transform the spherical coordinate to cartesian 3D point.
 
@@ -167,12 +259,27 @@ def sph2car(theta, phi, radius=1.0):
     :type phi: numpy
     :param radius: the radius of projection sphere
     :type radius: float
+    :param out: the output buffer, size is [3, point_number], it does not overlap the theta and phi.
+    :type out: numpy, optional
     :return: +x right, +y down, +z is froward, shape is [3, point_number]
     :rtype: numpy
     """
-    # points_cartesian_3d = np.array.zeros((theta.shape[0],3),float)
-    x = radius * np.cos(phi) * np.sin(theta)
-    z = radius * np.cos(phi) * np.cos(theta)
-    y = -radius * np.sin(phi)
-
-    return np.stack((x, y, z), axis=0)
+    if out is None:
+        points_car = np.empty((3,) + np.broadcast_shapes(np.shape(theta), np.shape(phi)), float_dtype(theta, phi))
+    else:
+        check_out_overlap((out,), (theta, phi), in_place=False)
+        points_car = out
+    x = points_car[0, ...]
+    y = points_car[1, ...]
+    z = points_car[2, ...]
+    # radius * cos(phi) is shared by x and z, y is the buffer until sin(phi) is needed
+    np.cos(phi, out=y)
+    np.multiply(y, radius, out=y)
+    np.sin(theta, out=x)
+    np.multiply(y, x, out=x)
+    np.cos(theta, out=z)
+    np.multiply(y, z, out=z)
+    np.sin(phi, out=y)
+    np.multiply(y, -radius, out=y)
+
+    return points_car
@@ -1,17 +1,28 @@
 import spherical_coordinates
 import projection_icosahedron as proj_ico
+import projection
 import gnomonic_projection as gp
+import serialization
 
 from scipy.spatial.transform import Rotation as R
 from PIL import Image, ImageDraw
 import numpy as np
 from colorsys import hsv_to_rgb
+import collections
+import json
+import os
 
 from logger import Logger
 
 log = Logger(__name__)
 log.logger.propagate = False
 
+# The pixels corresponding dictionaries and packed buffers of the recent geometries, keyed by pixels_corr_cache_key.
+# They depend on the faces' geometry only, so all panoramas of the same size share them.
+pixels_corr_cache = collections.OrderedDict()
+PIXELS_CORR_CACHE_SIZE = 8
+PIXELS_CORR_CACHE_VERSION = 3
+
 
 def draw_corresponding(src_image_data, tar_image_data, pixel_corresponding_array):
     """
@@ -117,20 +128,23 @@ def tangent_image_resolution(erp_image_width, padding_size):
     return int(tangent_image_width + 0.5), int(tangent_image_height + 0.5)
 
 
-def erp_ico_cam_intrparams(image_width, padding_size=0):
+def erp_ico_cam_intrparams(image_width, padding_size=0, projection_name="icosahedron"):
     """    
-    Compuate the camera intrinsic parameters for 20 faces of icosahedron.
+    Compuate the camera intrinsic parameters for 20 faces of icosahedron, or 6 faces of cubemap.
     It does not need camera parameters.
 
     :param image_width: Tangent image's width, the image height derive from image ratio.
     :type image_width: int
     :param padding_size: The tangent face padding size, defaults to 0
     :type padding_size: float, optional
+    :param projection_name: The tangent faces projection, "icosahedron" or "cubemap".
+    :type projection_name: str, optional
     :return: 20 faces camera parameters.
     :rtype: list
     """
     # camera intrinsic parameters
-    ico_param_list = proj_ico.get_icosahedron_parameters(7, padding_size)
+    ico_param_list = projection.get_face_parameters(projection_name, projection.reference_face(projection_name),
+                                                    padding_size)
     tangent_point = ico_param_list["tangent_point"]
     triangle_points_tangent = ico_param_list["triangle_points_tangent"]
 
@@ -156,7 +170,7 @@ def erp_ico_cam_intrparams(image_width, padding_size=0):
     # cy_up = 0.5 * (image_width - 1.0) / np.sin(np.radians(60.0)) + 10.0
 
     subimage_cam_param_list = []
-    for index in range(0, 20):
+    for index in range(0, projection.face_number(projection_name)):
         # intrinsic parameters
         # cy = None
         # if 0 <= index <= 4:
@@ -173,7 +187,7 @@ def erp_ico_cam_intrparams(image_width, padding_size=0):
                                      [0, 0, 1]])
 
         # rotation
-        ico_param_list = proj_ico.get_icosahedron_parameters(index, padding_size)
+        ico_param_list = projection.get_face_parameters(projection_name, index, padding_size)
         tangent_point = ico_param_list["tangent_point"]
         # print(tangent_point)
         rot_y = tangent_point[0]
@@ -244,25 +258,314 @@ def erp_ico_pixel_corr(subimage_sphcoor, next_tangent_point, padding_size, tange
     return np.hstack((pixel_index_src, pixel_index_tar)), pixels_sph
 
 
-def erp_ico_proj(erp_image, padding_size, tangent_image_width, corr_downsample_factor, opt = None):
+def gnomonic_range(tangent_polygon_gnom):
+    """The face image's gnomonic coordinate range, [x_min, x_max, y_min, y_max], of its padded polygon."""
+    tangent_polygon_gnom = np.array(tangent_polygon_gnom)
+    return [np.amin(tangent_polygon_gnom[:, 0], axis=0), np.amax(tangent_polygon_gnom[:, 0], axis=0),
+            np.amin(tangent_polygon_gnom[:, 1], axis=0), np.amax(tangent_polygon_gnom[:, 1], axis=0)]
+
+
+def erp_ico_overlap_faces(subimage_sphcoor_list, tangent_points, tangent_gnomonic_ranges, tangent_image_width):
+    """
+    Find the faces overlapping each face, the other faces have no pixel corresponding with it.
+
+    Each face image is in the spherical cap of its tangent point and its farthest pixel, two faces overlap only if
+    their caps do. The caps are enlarged by two pixels to keep the pixels rounded into the target face image.
+
+    :param subimage_sphcoor_list: each face image's pixels spherical coordinate, [2, height, width].
+    :type subimage_sphcoor_list: list
+    :param tangent_points: the faces' tangent points, [face_number, 2].
+    :type tangent_points: numpy
+    :param tangent_gnomonic_ranges: the faces' gnomonic coordinate ranges, [face_number, 4].
+    :type tangent_gnomonic_ranges: numpy
+    :param tangent_image_width: the face image width.
+    :type tangent_image_width: int
+    :return: the indices of the faces overlapping each face, and the faces' enlarged cap radius.
+    :rtype: tuple
+    """
+    face_number = len(subimage_sphcoor_list)
+    tangent_points_car = spherical_coordinates.sph2car(tangent_points[:, 0], tangent_points[:, 1])
+    cap_radius = np.empty(face_number, np.float64)
+    for face_index, subimage_sphcoor in enumerate(subimage_sphcoor_list):
+        pixels_car = spherical_coordinates.sph2car(subimage_sphcoor[0].ravel(), subimage_sphcoor[1].ravel())
+        cos_angle = np.dot(tangent_points_car[:, face_index], pixels_car)
+        cap_radius[face_index] = np.arccos(np.clip(np.amin(cos_angle), -1.0, 1.0))
+
+    # the angle of a pixel is not larger than its gnomonic size
+    pixel_size = np.amax(tangent_gnomonic_ranges[:, 1] - tangent_gnomonic_ranges[:, 0]) / (tangent_image_width - 1.0)
+    cap_radius += 2.0 * pixel_size
+    tangent_points_angle = np.arccos(np.clip(np.dot(tangent_points_car.T, tangent_points_car), -1.0, 1.0))
+    overlap = tangent_points_angle < cap_radius[:, None] + cap_radius[None, :]
+    np.fill_diagonal(overlap, False)
+    return [np.nonzero(overlap[face_index])[0].tolist() for face_index in range(0, face_number)], cap_radius
+
+
+def erp_ico_pixel_corr_faces(subimage_sphcoor, tangent_points, tangent_gnomonic_ranges, tangent_cap_radius,
+                             tangent_image_width, tangent_image_height):
+    """
+    Get the corresponding points from one face to several faces, see erp_ico_pixel_corr.
+
+    The source pixels in each target's cap are projected to all targets at once, with the same operations as
+    gnomonic_projection.gnomonic_projection and gnomonic_projection.gnomonic2pixel.
+
+    :param subimage_sphcoor: source subimage each pixel's spherical coordinate, [2, height, width].
+    :type subimage_sphcoor: numpy
+    :param tangent_points: the target faces' tangent points, [target_number, 2].
+    :type tangent_points: numpy
+    :param tangent_gnomonic_ranges: the target faces' gnomonic coordinate ranges, [target_number, 4].
+    :type tangent_gnomonic_ranges: numpy
+    :param tangent_cap_radius: the target faces' cap radius, see erp_ico_overlap_faces.
+    :type tangent_cap_radius: numpy
+    :return: each target's pixel corresponding relationship [current_pixel_y, current_pixel_x, target_pixel_y,
+        target_pixel_x], and the source pixels' flat indices.
+    :rtype: tuple
+    """
+    target_number = len(tangent_points)
+    theta = subimage_sphcoor[0].ravel()
+    phi = subimage_sphcoor[1].ravel()
+
+    # 0) the candidate source pixels in the target faces' caps
+    tangent_points_car = spherical_coordinates.sph2car(tangent_points[:, 0], tangent_points[:, 1])
+    pixels_car = spherical_coordinates.sph2car(theta, phi)
+    candidate = np.dot(tangent_points_car.T, pixels_car) > np.cos(tangent_cap_radius)[:, None]
+    target_index, pixel_index = np.nonzero(candidate)
+
+    theta_0 = tangent_points[target_index, 0]
+    sin_phi_0 = np.sin(tangent_points[:, 1])[target_index]
+    cos_phi_0 = np.cos(tangent_points[:, 1])[target_index]
+    theta = theta[pixel_index]
+    phi = phi[pixel_index]
+
+    # 1) the gnomonic coordinate on the target faces
+    delta_theta = theta - theta_0
+    cos_delta_theta = np.cos(delta_theta)
+    sin_delta_theta = np.sin(delta_theta)
+    cos_phi = np.cos(phi)
+    sin_phi = np.sin(phi)
+    gnom_y = cos_phi * sin_phi_0 * cos_delta_theta
+    gnom_x = cos_phi * sin_delta_theta
+    cos_c = sin_phi * sin_phi_0 + cos_phi * cos_phi_0 * cos_delta_theta
+    gnom_y = sin_phi * cos_phi_0 - gnom_y
+    # the pixels on the other hemisphere are invalid, so are the pixels 90 degrees away
+    hemisphere = cos_c > 0
+    cos_c[np.logical_not(hemisphere)] = 1.0
+    gnom_x /= cos_c
+    gnom_y /= cos_c
+
+    # 2) the pixel coordinate on the target faces
+    x_min, x_max, y_min, y_max = [tangent_gnomonic_ranges[target_index, index] for index in range(0, 4)]
+    gnom_image_x = ((gnom_x - x_min) * ((tangent_image_width - 1.0) / (x_max - x_min)) + 0.5).astype(int)
+    gnom_image_y = (-(gnom_y - y_max) * ((tangent_image_height - 1.0) / (y_max - y_min)) + 0.5).astype(int)
+    valid_pixel = np.logical_and.reduce((
+        gnom_image_x >= 0, gnom_image_x < tangent_image_width,
+        gnom_image_y >= 0, gnom_image_y < tangent_image_height, hemisphere))
+
+    # 3) get the src and tar's subimage pixel coordinate, the candidates are sorted by target
+    target_index = target_index[valid_pixel]
+    pixel_index = pixel_index[valid_pixel]
+    pixels_src_y, pixels_src_x = np.divmod(pixel_index, tangent_image_width)
+    pixels_corr = np.stack((pixels_src_y, pixels_src_x, gnom_image_y[valid_pixel], gnom_image_x[valid_pixel]),
+                           axis=1).astype(np.float64)
+    target_offsets = np.searchsorted(target_index, np.arange(0, target_number + 1))
+    pixels_corr_list = [pixels_corr[target_offsets[index]:target_offsets[index + 1]]
+                        for index in range(0, target_number)]
+    valid_pixel_index_list = [pixel_index[target_offsets[index]:target_offsets[index + 1]]
+                              for index in range(0, target_number)]
+    return pixels_corr_list, valid_pixel_index_list
+
+
+def pixels_corr_cache_key(erp_image_size, padding_size, tangent_image_width, corr_downsample_factor, opt=None,
+                          dtype=np.float64, projection_name="icosahedron"):
+    """The geometry parameters of the pixels corresponding, as a JSON string.
+
+    :param erp_image_size: The ERP image's height and width.
+    :type erp_image_size: tuple
+    :return: The cache key of erp_ico_proj's pixels corresponding.
+    :rtype: str
+    """
+    key = {"version": PIXELS_CORR_CACHE_VERSION,
+           "projection": projection_name,
+           "erp_image_size": [int(size) for size in erp_image_size[:2]],
+           "padding_size": float(padding_size),
+           "tangent_image_width": int(tangent_image_width),
+           "corr_downsample_factor": float(corr_downsample_factor),
+           "dtype": np.dtype(dtype).name}
+    if opt is not None and projection_name == "icosahedron" and opt.dataset_matterport_hexagon_mask_enable:
+        key["matterport_blur_area_height"] = float(opt.dataset_matterport_blur_area_height)
+        key["matterport_blurarea_shape"] = opt.dataset_matterport_blurarea_shape
+    return json.dumps(key, sort_keys=True)
+
+
+def pixels_corr_cache_filepath(cache_dir, key):
+    return os.path.join(cache_dir, "pixelcorr_{}.npz".format(serialization.get_sha256(key)[:16]))
+
+
+def pack_pixels_corr(pixels_corr_dict):
+    """Pack the pixels corresponding into contiguous buffers, the input of depthmapAlign.depthmap_stitch.
+
+    The pixels corresponding of all faces pairs are the rows of one array, the CSR offsets give each pair's rows.
+    The buffers of the cached geometries are packed once and shared.
+
+    :param pixels_corr_dict: The pixels corresponding, pixels_corr_dict[src][tar] is a [corr_number, 4] array.
+    :type pixels_corr_dict: dict
+    :return: the faces pairs' [src, tar] index [pair_number, 2] int32, the pairs' rows offsets [pair_number + 1] int64
+        and the pixels corresponding of all pairs [corr_number, 4] float64, each row is
+        [src_y, src_x, tar_y, tar_x].
+    :rtype: tuple
+    """
+    for cached_pixels_corr_dict, pixels_corr_packed in pixels_corr_cache.values():
+        if cached_pixels_corr_dict is pixels_corr_dict:
+            return pixels_corr_packed
+
+    pairs = []
+    pixels_corr_list = []
+    for index_src, pixels_corr_src in pixels_corr_dict.items():
+        for index_tar, pixels_corr in pixels_corr_src.items():
+            if index_src != index_tar and pixels_corr.shape[0] > 0:
+                pairs.append([index_src, index_tar])
+                pixels_corr_list.append(pixels_corr)
+    offsets = np.zeros(len(pairs) + 1, np.int64)
+    np.cumsum([pixels_corr.shape[0] for pixels_corr in pixels_corr_list], out=offsets[1:])
+    pixels_corr_all = np.empty((offsets[-1], 4), np.float64)
+    for index, pixels_corr in enumerate(pixels_corr_list):
+        pixels_corr_all[offsets[index]:offsets[index + 1]] = pixels_corr
+    return np.array(pairs, np.int32).reshape(-1, 2), offsets, pixels_corr_all
+
+
+def unpack_pixels_corr(pixels_corr_packed, face_number, dtype=np.float64):
+    """The pixels corresponding dictionary of the packed buffers, see pack_pixels_corr.
+
+    The float64 arrays are views of the packed buffer, the pairs without pixels corresponding are empty.
+    """
+    pairs, offsets, pixels_corr_all = pixels_corr_packed
+    pixels_corr_dict = {}
+    for index_src in range(0, face_number):
+        pixels_corr_dict[index_src] = {}
+        for index_tar in range(0, face_number):
+            if index_src == index_tar:
+                pixels_corr_dict[index_src][index_tar] = np.empty(shape=(0, 0))
+            else:
+                pixels_corr_dict[index_src][index_tar] = np.empty(shape=(0, 4), dtype=dtype)
+    for index, (index_src, index_tar) in enumerate(pairs):
+        pixels_corr_dict[int(index_src)][int(index_tar)] = \
+            pixels_corr_all[offsets[index]:offsets[index + 1]].astype(dtype, copy=False)
+    return pixels_corr_dict
+
+
+def save_pixels_corr_cache(cache_dir, key, pixels_corr_packed, face_number):
+    """Save the packed pixels corresponding of all faces pairs to the cache directory.
+
+    :param cache_dir: The cache directory.
+    :type cache_dir: str
+    :param key: The geometry key, see pixels_corr_cache_key.
+    :type key: str
+    :param pixels_corr_packed: The packed pixels corresponding, see pack_pixels_corr.
+    :type pixels_corr_packed: tuple
+    :param face_number: The faces number.
+    :type face_number: int
+    """
+    pairs, offsets, pixels_corr_all = pixels_corr_packed
+    data = {"key": np.array(key), "face_number": np.array(face_number),
+            "pairs": pairs, "offsets": offsets, "pixels_corr": pixels_corr_all}
+
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_filepath = pixels_corr_cache_filepath(cache_dir, key)
+    # write to a temporary file first, so the other processes never read a partial cache file
+    temp_filepath = "{}.{}.tmp".format(cache_filepath, os.getpid())
+    with open(temp_filepath, "wb") as cache_file:
+        np.savez(cache_file, **data)
+    os.replace(temp_filepath, cache_filepath)
+    log.info("Save the pixels corresponding to cache {}".format(cache_filepath))
+
+
+def load_pixels_corr_cache(cache_dir, key):
+    """Load the packed pixels corresponding of the geometry from the cache directory.
+
+    :param cache_dir: The cache directory.
+    :type cache_dir: str
+    :param key: The geometry key, see pixels_corr_cache_key.
+    :type key: str
+    :return: The packed pixels corresponding and the faces number, None if the geometry is not cached.
+    :rtype: tuple
     """
-    Using Icosahedron sample the ERP image to generate subimage, pixel corresponding and camera parameter.
+    cache_filepath = pixels_corr_cache_filepath(cache_dir, key)
+    if not os.path.isfile(cache_filepath):
+        return None
+
+    try:
+        with np.load(cache_filepath, allow_pickle=False) as data:
+            if str(data["key"]) != key:
+                log.warn("The pixels corresponding cache {} is stale, recompute it.".format(cache_filepath))
+                return None
+            face_number = int(data["face_number"])
+            pixels_corr_packed = (data["pairs"], data["offsets"], data["pixels_corr"])
+    except (OSError, ValueError, KeyError) as error:
+        log.warn("Can not load the pixels corresponding cache {}: {}".format(cache_filepath, error))
+        return None
+
+    log.info("Load the pixels corresponding from cache {}".format(cache_filepath))
+    return pixels_corr_packed, face_number
+
+
+def add_pixels_corr_cache(key, pixels_corr_cached):
+    """Cache the pixels corresponding dictionary and its packed buffers, and drop the least recently used ones."""
+    pixels_corr_cache[key] = pixels_corr_cached
+    while len(pixels_corr_cache) > PIXELS_CORR_CACHE_SIZE:
+        pixels_corr_cache.popitem(last=False)
+
+
+def erp_ico_proj(erp_image, padding_size, tangent_image_width, corr_downsample_factor, opt = None, dtype=np.float64,
+                 projection_name="icosahedron", cache_dir=None):
     """
+    Using Icosahedron, or the cubemap of projection_name, sample the ERP image to generate subimage,
+    pixel corresponding and camera parameter.
+
+    The pixel corresponding arrays are stored in `dtype`, the pixel coordinates are integer so float32 is lossless.
+
+    The pixels corresponding depend on the geometry only, they are cached in memory and in the cache_dir for each
+    ERP image size, face width, padding and down sample ratio. When they are cached the ERP image is not sampled and
+    the returned subimage list is None. The cached arrays are shared, do not modify them.
+
+    :param cache_dir: The folder of the pixels corresponding cache files, None to cache them in memory only.
+    :type cache_dir: str, optional
+    """
+    cache_key = pixels_corr_cache_key(erp_image.shape, padding_size, tangent_image_width, corr_downsample_factor,
+                                      opt, dtype, projection_name)
+    pixels_corr_cached = pixels_corr_cache.get(cache_key)
+    if pixels_corr_cached is None and cache_dir is not None:
+        pixels_corr_loaded = load_pixels_corr_cache(cache_dir, cache_key)
+        if pixels_corr_loaded is not None:
+            pixels_corr_packed, face_number = pixels_corr_loaded
+            pixels_corr_cached = (unpack_pixels_corr(pixels_corr_packed, face_number, dtype), pixels_corr_packed)
+            add_pixels_corr_cache(cache_key, pixels_corr_cached)
+    if pixels_corr_cached is not None:
+        pixels_corr_cache.move_to_end(cache_key)
+        pixels_corr_dict = pixels_corr_cached[0]
+        subimage_cam_param_list = erp_ico_cam_intrparams(tangent_image_width, padding_size, projection_name)
+        return None, subimage_cam_param_list, pixels_corr_dict
+
     if corr_downsample_factor != 1.0:
         log.info("Down sample the pixels corresponding, keep {}%.".format(corr_downsample_factor * 100))
         
     # 0) generate subimage
-    subimage_list, subimage_sphcoor_list, _ = proj_ico.erp2ico_image(erp_image, tangent_image_width, padding_size, full_face_image=True)
+    subimage_list, subimage_sphcoor_list, _ = projection.erp2face_image(projection_name, erp_image, tangent_image_width,
+                                                                        padding_size, full_face_image=True, dtype=dtype)
     tangent_image_height = subimage_list[0].shape[0]
 
-    # 1) compute current image overlap are with others subimage
-    pixels_corr_dict = {}
+    # 1) find the overlapping faces pairs
+    face_number = len(subimage_list)
     ico_param_list = []
-    for index in range(0, len(subimage_list)):
-        ico_param_list.append(proj_ico.get_icosahedron_parameters(index, padding_size))
-
-    # set the matterport dataset flag
-    if opt is None:
+    for index in range(0, face_number):
+        ico_param_list.append(projection.get_face_parameters(projection_name, index, padding_size))
+    tangent_points = np.array([ico_param["tangent_point"] for ico_param in ico_param_list], np.float64)
+    tangent_gnomonic_ranges = np.array([gnomonic_range(ico_param["triangle_points_tangent"])
+                                        for ico_param in ico_param_list])
+    overlap_face_list, cap_radius = erp_ico_overlap_faces(subimage_sphcoor_list, tangent_points,
+                                                          tangent_gnomonic_ranges, tangent_image_width)
+    log.debug("The overlapping faces pairs number is {}.".format(sum(len(faces) for faces in overlap_face_list)))
+
+    # set the matterport dataset flag, the blurred area mask is of the icosahedron's top and bottom faces
+    if opt is None or projection_name != "icosahedron":
         matterport_hexagon_mask_enable = False
         matterport_hexagon_circumradius = -1
     else:
@@ -273,30 +576,32 @@ def erp_ico_proj(erp_image, padding_size, tangent_image_width, corr_downsample_f
         log.info(f"The image height is {erp_image_height}, margin height is {opt.dataset_matterport_blur_area_height}, circumradius is {matterport_hexagon_circumradius}")
         matterport_blurarea_shape = opt.dataset_matterport_blurarea_shape   # "hexagon",  "circle"
 
-
-    # source subimage index
-    def subimage_corr_fun(ico_param_list, pixels_corr_dict, subimage_index_src):
+    # 2) compute the pixels corresponding of each source face to all its overlapping faces at once
+    pixels_corr_dict = {}
+    for subimage_index_src in range(0, face_number):
         subimage_sphcoor = subimage_sphcoor_list[subimage_index_src]
+        subimage_index_tar_list = overlap_face_list[subimage_index_src]
+        pixels_corr_list, valid_pixel_index_list = erp_ico_pixel_corr_faces(
+            subimage_sphcoor, tangent_points[subimage_index_tar_list], tangent_gnomonic_ranges[subimage_index_tar_list],
+            cap_radius[subimage_index_tar_list], tangent_image_width, tangent_image_height)
 
-        # target subimage index, and compute the corresponding computing with multi-threads
         pixels_corr_dict_subimage = {}
-        for subimage_index_tar in range(0, len(subimage_list)):
-            # find the corresponding pixel from all subimage
+        for subimage_index_tar in range(0, face_number):
             if subimage_index_src == subimage_index_tar:
                 pixels_corr_dict_subimage[subimage_index_tar] = np.empty(shape=(0, 0))
-                continue
-            # compute the corresponding
-            ico_param = ico_param_list[subimage_index_tar]
-            heightbout_tangent_point = ico_param["tangent_point"]
-            tangent_triangle_vertices_gnom = np.array(ico_param["triangle_points_tangent"])
-            pixels_corr_src2tar, pixels_sph = erp_ico_pixel_corr(
-                subimage_sphcoor, heightbout_tangent_point, padding_size, tangent_image_width, tangent_image_height, tangent_triangle_vertices_gnom)
-            pixels_corr_src2tar = pixels_corr_src2tar.astype(np.float64)
+            else:
+                # the faces without overlap have no pixels corresponding
+                pixels_corr_dict_subimage[subimage_index_tar] = np.empty(shape=(0, 4), dtype=dtype)
+
+        for pixels_corr_src2tar, valid_pixel_index, subimage_index_tar in \
+                zip(pixels_corr_list, valid_pixel_index_list, subimage_index_tar_list):
+            pixels_corr_src2tar = pixels_corr_src2tar.astype(dtype)
 
             # remove the pixel at top and bottom
             if matterport_hexagon_mask_enable and \
                 ((0 <= subimage_index_src <= 4 and 0 <= subimage_index_tar <= 4)
                  or (15 <= subimage_index_src <= 19 and 15 <= subimage_index_tar <= 19)):
+                pixels_sph = subimage_sphcoor.reshape(2, -1)[:, valid_pixel_index]
 
                 # 1) get the src and tar pixel coordinate on the top/bottom tangent image
                 if 0 <= subimage_index_src <= 4:
@@ -319,43 +624,31 @@ def erp_ico_proj(erp_image, padding_size, tangent_image_width, corr_downsample_f
                     outside_hexagon = np.logical_not(inside_hexagon)
                     pixels_corr_src2tar = pixels_corr_src2tar[outside_hexagon]
                 elif matterport_blurarea_shape == "circle":
-                    # import ipdb; ipdb.set_trace()
-                    # outside_circle = np.logical_and(pixels_sph[1, :] <= np.pi-matterport_circle_phi, pixels_sph[1, :] >= matterport_circle_phi)
                     outside_circle = np.logical_and(pixels_sph[1, :] <= np.pi * 0.5 - matterport_circle_phi, pixels_sph[1, :] >= - np.pi * 0.5 + matterport_circle_phi)
                     pixels_corr_src2tar = pixels_corr_src2tar[outside_circle]
 
-            # assign the value
-            pixels_corr_dict_subimage[subimage_index_tar] = pixels_corr_src2tar
-
             # down-sample the pixel corresponding relationship
-            if corr_downsample_factor != 1.0 and pixels_corr_dict_subimage[subimage_index_tar] is not None:
-                corr_number = pixels_corr_dict_subimage[subimage_index_tar].shape[0]
+            if corr_downsample_factor != 1.0:
+                corr_number = pixels_corr_src2tar.shape[0]
                 corr_index = np.linspace(0, corr_number -1, num = int(corr_number * corr_downsample_factor)).astype(int)
                 corr_index = np.unique(corr_index)
-                pixels_corr_dict_subimage[subimage_index_tar]  = pixels_corr_dict_subimage[subimage_index_tar][corr_index,:]
-            
-        pixels_corr_dict[subimage_index_src] = pixels_corr_dict_subimage
-        return subimage_index_src
-
-    # get the corresponding relationship with multi-thread
-    from concurrent.futures import ThreadPoolExecutor, as_completed
-    with ThreadPoolExecutor(max_workers=opt.dispalign_corr_thread_number) as executor:
-        log.debug("Start generating imagepixels corresponding:")
-        feature_list = []
-        for subimage_index in range(0, len(subimage_list)):
-            # log.debug("Generate image {} pixels corresponding: start ".format(subimage_index))
-            feature_list.append(executor.submit(subimage_corr_fun, ico_param_list, pixels_corr_dict, subimage_index))
-
-        for future in as_completed(feature_list):
-            try:
-                result = future.result()
-            except Exception as exc:
-                print('Computing subimage {} pixels corresponding error! Exception: {}' % (result, exc))
-            else:
-                log.debug("Generate image {} pixels corresponding: done ".format(result))
+                pixels_corr_src2tar = pixels_corr_src2tar[corr_index, :]
+
+            pixels_corr_dict_subimage[subimage_index_tar] = pixels_corr_src2tar
 
-    # 2) camera parameters
-    subimage_cam_param_list = erp_ico_cam_intrparams(tangent_image_width, padding_size)
+        pixels_corr_dict[subimage_index_src] = pixels_corr_dict_subimage
+        log.debug("Generate image {} pixels corresponding: done ".format(subimage_index_src))
+
+    # 3) cache the pixels corresponding of the geometry
+    # the float64 pixels corresponding are views of the packed buffer
+    pixels_corr_packed = pack_pixels_corr(pixels_corr_dict)
+    pixels_corr_dict = unpack_pixels_corr(pixels_corr_packed, face_number, dtype)
+    add_pixels_corr_cache(cache_key, (pixels_corr_dict, pixels_corr_packed))
+    if cache_dir is not None:
+        save_pixels_corr_cache(cache_dir, cache_key, pixels_corr_packed, face_number)
+
+    # 4) camera parameters
+    subimage_cam_param_list = erp_ico_cam_intrparams(tangent_image_width, padding_size, projection_name)
     return subimage_list, subimage_cam_param_list, pixels_corr_dict
 
 